@@ -0,0 +1,19 @@
+"""serve.py's server, one module per concern.
+
+    config       the SERVE_* knobs (documented in DEPLOY.md)
+    files        ServedFile: validators and the ready-made 200 header block
+    negotiation  sidecars, image formats and lite media per request
+    ranges       Range / If-Range and the 304 test
+    artifact     startup indexes of an artifact tree or pack, SERVE_REVISIONS
+    preload      Link preload hints for an artifact's pages
+    watch        the dev watcher, stat cache and live reload
+    metrics      Prometheus counters (SERVE_METRICS)
+    accesslog    the JSON-lines access log (SERVE_ACCESS_LOG)
+    handler      NoCacheHandler, which writes every response header
+    engines      the thread-pool and asyncio engines, --workers
+    main         the command line
+
+Stdlib only: it ships in the artifact beside serve.py. Module state that
+main() fills in at startup (artifact.INDEX, watch.LIVE, ...) is read
+through its module, never imported by name.
+"""
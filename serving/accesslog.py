@@ -0,0 +1,124 @@
+"""The JSON-lines request log (SERVE_ACCESS_LOG)."""
+import atexit, collections, datetime, json, os, random, re, select, sys, threading, time
+
+from .artifact import REVISIONS
+
+# SERVE_ACCESS_LOG=<file> (or '-' for stdout, which is what Railway keeps)
+# writes one JSON line per request. SERVE_ACCESS_LOG_SAMPLE keeps that
+# fraction of the 1xx-3xx lines — errors are always kept — and a file is
+# rotated to .1 .. .SERVE_ACCESS_LOG_KEEP past SERVE_ACCESS_LOG_MB.
+ACCESS_LOG_PATH = os.environ.get('SERVE_ACCESS_LOG', '')
+ACCESS_LOG_SAMPLE = min(1.0, max(0.0, float(os.environ.get('SERVE_ACCESS_LOG_SAMPLE', 1))))
+ACCESS_LOG_ROTATE = int(float(os.environ.get('SERVE_ACCESS_LOG_MB', 64)) * (1 << 20))
+ACCESS_LOG_KEEP = int(os.environ.get('SERVE_ACCESS_LOG_KEEP', 3))
+ACCESS_LOG_FLUSH = 0.5      # seconds between batches
+ACCESS_LOG_BACKLOG = 65536  # records held for the writer; past that, counted and dropped
+UA_CLASSES = (('bot', re.compile(r'(?i)bot\b|crawl|spider|slurp|facebookexternalhit|preview')),
+              ('tool', re.compile(r'(?i)^(curl|wget|python|go-http|okhttp|node|axios|java)')),
+              ('mobile', re.compile(r'Mobi|Android|iPhone|iPad')),
+              ('browser', re.compile(r'^Mozilla/')))
+
+
+def ua_class(agent):
+    if not agent:
+        return '-'
+    return next((name for name, pattern in UA_CLASSES if pattern.search(agent)), 'other')
+
+
+class AccessLog:
+    """Batched JSON-lines access log that never blocks a request.
+
+    A handler only appends a tuple to a deque — atomic under the GIL, no
+    lock, no formatting, no I/O. One writer thread wakes every
+    ACCESS_LOG_FLUSH seconds, drains the deque, formats the batch and
+    writes it with a single write(2); a full backlog drops records and
+    the next batch says how many. With --workers each worker writes its
+    own file (name.N.log), since rotation cannot be shared across
+    processes; '-' writes PIPE_BUF-sized chunks so workers' lines do not
+    interleave on a shared stdout."""
+
+    def __init__(self, path):
+        self.path = path
+        self.sample = ACCESS_LOG_SAMPLE
+        self.dropped = 0
+        self._records = collections.deque()
+        self._lock = threading.Lock()        # the writer vs the exit flush
+        self._fd = None
+        self._size = 0
+        if path != '-':
+            self._open()
+        threading.Thread(target=self._run, daemon=True).start()
+        atexit.register(self.flush)
+
+    def record(self, handler, duration):
+        status = handler._status
+        if status < 400 and self.sample < 1.0 and random.random() >= self.sample:
+            return
+        if len(self._records) >= ACCESS_LOG_BACKLOG:
+            self.dropped += 1
+            return
+        headers = getattr(handler, 'headers', None)
+        self._records.append((
+            time.time(), handler.client_address[0], handler.command,
+            getattr(handler, 'path', None), status, handler._sent,
+            headers.get('Range') if headers is not None else None,
+            duration, headers.get('User-Agent') if headers is not None else None,
+            handler._revision if REVISIONS else None))
+
+    def _run(self):
+        while True:
+            time.sleep(ACCESS_LOG_FLUSH)
+            try:
+                self.flush()
+            except OSError as error:
+                print(f'serve.py: access log: {error}', file=sys.stderr, flush=True)
+
+    def flush(self):
+        with self._lock:
+            lines = []
+            records = self._records
+            while records:
+                (when, remote, method, path, status, sent, byte_range,
+                 duration, agent, revision) = records.popleft()
+                line = {'ts': datetime.datetime.fromtimestamp(when, datetime.timezone.utc)
+                              .isoformat(timespec='milliseconds').replace('+00:00', 'Z'),
+                        'remote': remote, 'method': method, 'path': path,
+                        'status': status, 'bytes': sent, 'range': byte_range,
+                        'ms': round(duration * 1000, 3), 'ua': ua_class(agent)}
+                if revision is not None:
+                    line['revision'] = revision
+                if status < 400 and self.sample < 1.0:
+                    line['sample'] = self.sample     # weight = 1 / sample
+                lines.append(json.dumps(line, separators=(',', ':')) + '\n')
+            if self.dropped:
+                dropped, self.dropped = self.dropped, 0
+                lines.append(json.dumps({'dropped': dropped}) + '\n')
+            if lines:
+                self._write(''.join(lines).encode('utf-8', 'replace'))
+
+    def _write(self, data):
+        if self._fd is None:                 # stdout, shared between workers
+            while data:
+                cut = data.rfind(b'\n', 0, select.PIPE_BUF) + 1 or len(data)
+                os.write(sys.stdout.fileno(), data[:cut])
+                data = data[cut:]
+            return
+        os.write(self._fd, data)
+        self._size += len(data)
+        if self._size >= ACCESS_LOG_ROTATE:
+            os.close(self._fd)
+            for n in range(ACCESS_LOG_KEEP - 1, 0, -1):
+                if os.path.exists(f'{self.path}.{n}'):
+                    os.replace(f'{self.path}.{n}', f'{self.path}.{n + 1}')
+            if ACCESS_LOG_KEEP > 0:
+                os.replace(self.path, f'{self.path}.1')
+            else:
+                os.unlink(self.path)
+            self._open()
+
+    def _open(self):
+        self._fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        self._size = os.fstat(self._fd).st_size
+
+
+ACCESS = None   # AccessLog in each serving process (SERVE_ACCESS_LOG)
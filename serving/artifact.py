@@ -0,0 +1,198 @@
+"""Startup indexes of a package-public.py artifact (a tree or a --pack) and
+the SERVE_REVISIONS artifacts mounted beside it."""
+import collections, json, mmap, os, struct, sys, threading
+
+from .config import CACHE_CEILING, CACHE_INLINE, CACHING, PACK_ALIGN, PACK_MAGIC, PACK_NAME
+from .files import ServedFile, content_etag, guess_type
+from .negotiation import IMAGE_FORMATS, SIDECARS, lite_path
+
+
+class ArtifactCache:
+    """Filesystem path -> ServedFile for every file under the served root.
+
+    Files up to CACHE_INLINE are read into RAM once; larger ones (the
+    geometry bins, captures, card mp4s) are mmapped, preloaded in size
+    order while the CACHE_CEILING allows, and on demand after that. The
+    mapped tail is LRU: mapping one more file past the ceiling drops the
+    least recently served mapping. Dropping only forgets our reference — a
+    response still writing from that map keeps it alive until it finishes.
+    """
+
+    def __init__(self, root, ceiling, inline):
+        self.entries = {}
+        self.ceiling = ceiling
+        self.inline_bytes = 0
+        self.mapped_bytes = 0
+        self._maps = collections.OrderedDict()
+        self._lock = threading.Lock()
+        root = os.path.abspath(root)
+        self.files = 0
+        large = []
+        linked = {}   # (st_dev, st_ino) -> (data, etag): --fingerprint hardlinks
+        for dirpath, dirnames, filenames in os.walk(root):
+            dirnames.sort()
+            for name in sorted(filenames):
+                path = os.path.join(dirpath, name)
+                st = os.stat(path)
+                ctype = guess_type(path)
+                known = linked.get((st.st_dev, st.st_ino))
+                if known is not None:
+                    data, etag = known   # another name for bytes already held
+                else:
+                    data = None
+                    if st.st_size <= inline and self.inline_bytes + st.st_size <= ceiling:
+                        with open(path, 'rb') as fh:
+                            data = memoryview(fh.read())
+                        self.inline_bytes += st.st_size
+                    etag = None
+                    if CACHING != 'no-store':
+                        etag = content_etag(data=data) if data is not None \
+                            else content_etag(path=path)
+                    linked[(st.st_dev, st.st_ino)] = (data, etag)
+                entry = ServedFile(path, st.st_size, st.st_mtime, ctype, etag,
+                                   cache=self)
+                entry.data = data
+                self.entries[path] = entry
+                self.files += 1
+                if name in ('index.htm', 'index.html'):
+                    # translate_path keeps a directory URL's trailing slash;
+                    # sorted order lets index.html win, as in send_head.
+                    self.entries[dirpath + '/'] = entry
+                if data is None:
+                    large.append(entry)
+        _link_sidecars(self.entries, self)
+        for entry in sorted(large, key=lambda e: e.size):
+            if self.inline_bytes + self.mapped_bytes + entry.size > ceiling:
+                break
+            self.view(entry)
+
+    def get(self, path):
+        return self.entries.get(path)
+
+    def view(self, entry):
+        """The entry's bytes as a memoryview, mapping (and evicting) as needed."""
+        if entry.data is not None:
+            return entry.data
+        with self._lock:
+            mm = self._maps.get(entry)
+            if mm is not None:
+                self._maps.move_to_end(entry)
+                return memoryview(mm)
+            with open(entry.path, 'rb') as fh:
+                mm = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+            self._maps[entry] = mm
+            self.mapped_bytes += entry.size
+            while (self.inline_bytes + self.mapped_bytes > self.ceiling
+                   and len(self._maps) > 1):
+                old, _ = self._maps.popitem(last=False)
+                self.mapped_bytes -= old.size
+            return memoryview(mm)
+
+    def summary(self):
+        return (f'{self.files} files indexed, '
+                f'{self.inline_bytes / 1e6:.1f} MB inline, '
+                f'{self.mapped_bytes / 1e6:.1f} MB mapped')
+
+
+def _link_sidecars(entries, cache):
+    """Attach each indexed name.js.br / name.js.gz to name.js as a variant,
+    each name.lite.mp4 to name.mp4 and each name.png.avif / .webp to
+    name.png."""
+    for entry in list(entries.values()):
+        lite = entries.get(lite_path(entry.path))
+        if lite is not None:
+            entry.add_lite(lite)
+        if entry.ctype.startswith('image/'):
+            for suffix, ctype in IMAGE_FORMATS:
+                side = entries.get(entry.path + suffix)
+                if side is None:
+                    continue
+                image = ServedFile(side.path, side.size, side.mtime, ctype,
+                                   side.etag, cache=cache)
+                image.data = side.data
+                entry.add_format(image)
+        for suffix, coding in SIDECARS:
+            side = entries.get(entry.path + suffix)
+            if side is None:
+                continue
+            variant = ServedFile(side.path, side.size, side.mtime, entry.ctype,
+                                 side.etag, cache=cache, encoding=coding)
+            variant.data = side.data
+            entry.add_variant(variant)
+
+
+class PackedArtifact:
+    """ArtifactCache's interface over a package-public.py --pack file.
+
+    The pack is mapped once, whole, and every entry's `data` is a slice of
+    that one map: nothing is read or stat'ed per request, the page cache
+    holds each byte once however many workers fork from here, and the
+    MIME types and ETags come ready-made from the packer's index."""
+
+    def __init__(self, root, pack):
+        root = os.path.abspath(root)
+        with open(pack, 'rb') as fh:
+            self._map = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._map[:len(PACK_MAGIC)] != PACK_MAGIC:
+            raise ValueError(f'{pack} is not a package-public.py pack')
+        if hasattr(self._map, 'madvise'):
+            self._map.madvise(mmap.MADV_WILLNEED)
+        start = len(PACK_MAGIC) + 8
+        (length,) = struct.unpack_from('<Q', self._map, len(PACK_MAGIC))
+        index = json.loads(self._map[start:start + length])
+        base = start + length + -(start + length) % PACK_ALIGN
+        view = memoryview(self._map)
+        self.entries = {}
+        self.revision = index['revision']
+        self.files = len(index['files'])
+        self.inline_bytes = 0
+        self.mapped_bytes = len(self._map)
+        for name, packed in sorted(index['files'].items()):
+            path = os.path.join(root, *name.split('/'))
+            offset = base + packed['offset']
+            entry = ServedFile(path, packed['length'], packed['mtime'],
+                               packed['type'],
+                               packed['etag'] if CACHING != 'no-store' else None,
+                               cache=self)
+            entry.data = view[offset:offset + packed['length']]
+            self.entries[path] = entry
+            if name.rsplit('/', 1)[-1] in ('index.htm', 'index.html'):
+                self.entries[os.path.dirname(path) + '/'] = entry
+        _link_sidecars(self.entries, self)
+
+    def get(self, path):
+        return self.entries.get(path)
+
+    def view(self, entry):
+        return entry.data
+
+    def summary(self):
+        return (f'{self.files} files packed (revision {self.revision}), '
+                f'{self.mapped_bytes / 1e6:.1f} MB mapped')
+
+
+INDEX = None   # ArtifactCache or PackedArtifact once main() builds it
+
+
+class Revision:
+    """A tree requests can be answered from: the one serve.py runs from
+    (DEFAULT_REVISION, with INDEX) or a mounted artifact with its own."""
+
+    def __init__(self, name, root, index):
+        self.name = name
+        self.root = root
+        self.index = index
+
+
+def mount_revision(name, root):
+    """Index a package-public.py artifact (tree or pack) for SERVE_REVISIONS."""
+    root = os.path.abspath(root)
+    if not os.path.isfile(os.path.join(root, 'release-revision.txt')):
+        sys.exit(f'serve.py: SERVE_REVISIONS {name}={root} is not a package-public.py artifact')
+    pack = os.path.join(root, PACK_NAME)
+    index = PackedArtifact(root, pack) if os.path.isfile(pack) \
+        else ArtifactCache(root, CACHE_CEILING, CACHE_INLINE)
+    return Revision(name, root, index)
+
+
+REVISIONS = {}  # name -> Revision (DEFAULT_REVISION included) when SERVE_REVISIONS is set
@@ -0,0 +1,130 @@
+"""The server's knobs: environment variables read once at startup, and the
+constants the modules share. DEPLOY.md lists what each one does; the
+comments here say why it has the value it has."""
+import os, re, sys, threading
+
+KEEPALIVE = os.environ.get('SERVE_KEEPALIVE', '1') != '0'
+# Seconds a kept-alive connection may wait for its next request line, and
+# seconds a request (or a response write) may stall once it has started.
+IDLE_TIMEOUT = float(os.environ.get('SERVE_IDLE_TIMEOUT', 15))
+READ_TIMEOUT = float(os.environ.get('SERVE_READ_TIMEOUT', 30))
+# Zero-copy bodies via sendfile(2); SERVE_SENDFILE=0 forces the buffered
+# read/write loop (for comparison, or a platform where it misbehaves).
+SENDFILE = os.environ.get('SERVE_SENDFILE', '1') != '0'
+# Errors answered on a connection that stays open; every other error closes.
+KEEPALIVE_ERRORS = frozenset((403, 404, 416))
+# Admission control (threads engine): at most SERVE_THREADS connections are
+# served at once and SERVE_QUEUE more wait for a thread; past that a new
+# connection is answered 503 + Retry-After straight from the accept loop.
+# Media streams (either engine) may hold only SERVE_MEDIA_SHARE of the
+# threads, so a burst of <video> ranges cannot starve the module graph.
+POOL_THREADS = max(1, int(os.environ.get('SERVE_THREADS', 128)))
+POOL_QUEUE = max(1, int(os.environ.get('SERVE_QUEUE', 64)))
+MEDIA_SLOTS = threading.BoundedSemaphore(max(1, int(
+    POOL_THREADS * float(os.environ.get('SERVE_MEDIA_SHARE', 0.5)))))
+RETRY_AFTER = 1   # seconds; a shed burst is over by then or the client backs off
+# Seconds between looks at the wait queue while a connection sits idle: a
+# parked keep-alive gives its thread up once others are queued for one.
+POOL_RECHECK = 1.0
+# A package-public.py artifact is immutable once written, and it is the only
+# tree that carries the release marker — the repository checkout never does.
+ARTIFACT = os.path.isfile('release-revision.txt')
+# Startup index of the served tree: on by default for an artifact only (the
+# checkout changes under the server, which is the whole point of no-store).
+CACHE = os.environ.get('SERVE_CACHE', '1' if ARTIFACT else '0') != '0'
+CACHE_CEILING = int(float(os.environ.get('SERVE_CACHE_MB', 256)) * (1 << 20))
+CACHE_INLINE = int(float(os.environ.get('SERVE_CACHE_INLINE_KB', 256)) * (1 << 10))
+# package-public.py --pack leaves the tree in one file instead: PACK_MAGIC,
+# a u64 LE index length, the JSON index, zero padding to PACK_ALIGN, then
+# every file's bytes. When it is present it is the index, mapped whole.
+PACK_NAME = 'public.pack'
+PACK_MAGIC = b'GSPACK1\n'
+PACK_ALIGN = 4096
+# Link preload hints on HTML pages, from the module graph scanned at startup
+# (on for an artifact; the checkout's graph changes under the server).
+# SERVE_EARLY_HINTS=1 also sends them ahead as 103 Early Hints — opt-in, since
+# http.client and other HTTP/1.1 clients that only skip 100 choke on a 103.
+PRELOAD = os.environ.get('SERVE_PRELOAD', '1' if ARTIFACT else '0') != '0'
+EARLY_HINTS = os.environ.get('SERVE_EARLY_HINTS', '0') != '0'
+# Proxies commonly cap a response header block at 8 KB; the hint list is cut
+# to stay well inside it — deepest modules first, the few (and largest)
+# geometry fetches last.
+PRELOAD_HEADER_MAX = 6 << 10
+# The geometry manifest's chapters whose bins are hinted: the first one the
+# journey reaches (journey/route.js). The rest stay behind the boot path.
+PRELOAD_CHAPTERS = ('inspire',)
+# A/B: SERVE_REVISIONS=candidate=/tmp/public-b[,name=dir...] mounts more
+# package-public.py artifacts beside the served tree, each indexed at
+# startup. A request is answered from the one its X-Serve-Revision header
+# or serve_revision cookie names (/__revision/<name>/<path> sets the cookie
+# and continues at /<path>), else from DEFAULT_REVISION, the tree serve.py
+# runs from. Metrics and the access log then carry a revision label.
+REVISIONS_SPEC = os.environ.get('SERVE_REVISIONS', '')
+DEFAULT_REVISION = 'default'
+REVISION_PATH = '/__revision/'
+REVISION_HEADER = 'X-Serve-Revision'
+REVISION_COOKIE = 'serve_revision'
+# Two revisions answer the same URL differently: shared caches must key on both.
+REVISION_VARY = f'Vary: Cookie, {REVISION_HEADER}\r\n'.encode('latin-1')
+
+
+# 'no-store' (the checkout: every response uncacheable, as above) or
+# 'production' (an artifact: strong content-hash ETags, Cache-Control:
+# no-cache, conditional requests answered 304). Without content-hashed file
+# names any max-age would reopen the mixed-module-graph trap after a deploy,
+# so production caches nothing blind: every response — HTML first of all —
+# revalidates, and an unchanged file costs a 304 instead of its bytes.
+# 'dev' (opt-in for the checkout): no-cache too, with a weak ETag from
+# mtime/inode/size answered from a watched stat cache — a reload re-asks for
+# every module, as under no-store, but an unchanged one costs a 304.
+CACHING = os.environ.get('SERVE_CACHING', 'production' if ARTIFACT else 'no-store')
+if CACHING not in ('no-store', 'dev', 'production'):
+    sys.exit(f"serve.py: unknown SERVE_CACHING {CACHING!r} (no-store|dev|production)")
+# The exception: package-public.py --fingerprint also writes each module,
+# stylesheet and media file as name.<12 hex digits of its sha256>.ext and
+# points the pages at those names. Such a name changes whenever its bytes
+# do, so production lets browsers and CDNs keep it a year without asking
+# (an error response on one still revalidates); the original names, and
+# the pages naming the fingerprinted ones, stay no-cache.
+FINGERPRINT_RE = re.compile(r'\.[0-9a-f]{12}(?:\.lite)?\.[0-9a-z]+$')
+IMMUTABLE = 'public, max-age=31536000, immutable'
+# How the dev stat cache and live reload notice edits: 'inotify' where libc
+# has it, else (or with SERVE_WATCH=poll — e.g. a Docker bind mount, where
+# host-side edits raise no inotify events) a re-stat of the tree's files
+# every WATCH_POLL s, relisting only directories whose mtime moved.
+WATCH = os.environ.get('SERVE_WATCH', 'inotify')
+WATCH_POLL = float(os.environ.get('SERVE_WATCH_POLL', 0.5))
+# SERVE_LIVERELOAD=1: HTML pages get a tiny EventSource client and the
+# watcher pushes changed URLs to them over Server-Sent Events, batched once
+# the tree has been quiet for LIVERELOAD_DEBOUNCE seconds. For the checkout:
+# pages an artifact's startup index holds are served as indexed.
+LIVERELOAD = os.environ.get('SERVE_LIVERELOAD', '0') != '0'
+LIVERELOAD_PATH = '/__livereload'
+LIVERELOAD_DEBOUNCE = 0.15
+LIVERELOAD_HEARTBEAT = 15.0
+# A browser fetching a service worker script sends Service-Worker: script.
+# Where this tree has no such file, the one installed from an earlier
+# --service-worker artifact gets RETIRED_WORKER instead of a 404 (which
+# would leave it serving its cached revision). Its cache names are
+# tools/public-sw.js's; keep the two in step.
+RETIRED_WORKER = b"""/* serve.py: no service worker here; retire the one installed */
+self.addEventListener('install', () => self.skipWaiting());
+self.addEventListener('activate', (event) => event.waitUntil((async () => {
+  const prefix = `precache ${new URL(self.registration.scope).pathname} `;
+  for (const name of await caches.keys()) if (name.startsWith(prefix)) await caches.delete(name);
+  await self.registration.unregister();
+  for (const client of await self.clients.matchAll({ type: 'window' })) client.navigate(client.url);
+})()));
+"""
+
+# :8137 by default (capture.py, pre-commit and the docs all say so), but a
+# $PORT wins — multiple Claude sessions each run their own copy of this
+# server, and only one of them can hold the canonical port.
+PORT = int(os.environ.get('PORT', 8137))
+
+# 'threads' (default) or 'asyncio'. The thread-per-connection engine is the
+# one every tool and doc assumes; the asyncio engine trades it for one event
+# loop holding thousands of kept-alive sockets without a thread each (an
+# announcement unfurl sends that many at once). File stats and opens stay
+# synchronous on the loop: the served tree is small and page-cached.
+ENGINE = os.environ.get('SERVE_ENGINE', 'threads')
@@ -0,0 +1,456 @@
+"""The two engines that run NoCacheHandler — a bounded thread pool, or one
+asyncio loop — and the --workers supervisor that pre-forks either."""
+import asyncio, http.server, io, os, queue, signal, socket, sys, threading, time, traceback
+
+from . import accesslog, artifact, watch
+from .config import (ENGINE, IDLE_TIMEOUT, LIVERELOAD_HEARTBEAT, POOL_QUEUE, POOL_THREADS, PORT,
+                     READ_TIMEOUT, RETRY_AFTER, SENDFILE)
+from .handler import NoCacheHandler, body_parts
+from .metrics import METRICS
+
+ASYNC_BACKLOG = 1024
+ASYNC_SEND_SLICE = 1 << 20
+ASYNC_INLINE_BODY = 64 << 10
+MAX_HEADER_LINES = 101   # http.client refuses more than 100 headers anyway
+# Seconds workers get to finish after SIGTERM before they are killed.
+WORKER_GRACE = 10
+
+WORKER = None   # this process's worker number under --workers
+
+
+class ParallelHTTPServer(http.server.ThreadingHTTPServer):
+    """ThreadingHTTPServer on a bounded pool: threads are started on demand
+    up to POOL_THREADS and then reused; accepted connections wait in a
+    POOL_QUEUE-deep queue, and once that is full the accept loop answers
+    503 itself instead of growing without limit."""
+    allow_reuse_address = True
+    daemon_threads = True
+    # TCPServer defaults to five queued sockets. Chrome can churn through more
+    # than that while expanding the module graph and issuing media ranges.
+    request_queue_size = 128
+    SHED = (b'HTTP/1.1 503 Service Unavailable\r\n'
+            b'Retry-After: %d\r\n'
+            b'Cache-Control: no-store\r\n'
+            b'Content-Length: 0\r\n'
+            b'Connection: close\r\n\r\n' % RETRY_AFTER)
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._pending = queue.SimpleQueue()
+        self._pool_lock = threading.Lock()
+        self._threads_started = 0
+        self._idle = 0       # threads parked in get() with nothing queued for them
+        self._waiting = 0    # queued connections no thread has been set aside for
+
+    def load(self):
+        """(threads busy with a connection, connections waiting for one)."""
+        return self._threads_started - self._idle, self._waiting
+
+    def process_request(self, request, client_address):
+        with self._pool_lock:
+            admitted = True
+            if self._idle:
+                self._idle -= 1
+            elif self._threads_started < POOL_THREADS:
+                self._threads_started += 1
+                threading.Thread(target=self._pool_worker, daemon=True).start()
+            elif self._waiting < POOL_QUEUE:
+                self._waiting += 1
+            else:
+                admitted = False
+            if admitted:
+                self._pending.put((request, client_address))
+        if not admitted:
+            self._shed(request)
+
+    def _pool_worker(self):
+        while True:
+            request, client_address = self._pending.get()
+            try:
+                self.process_request_thread(request, client_address)
+            finally:
+                with self._pool_lock:
+                    if self._waiting:
+                        self._waiting -= 1    # next get() takes a queued one
+                    else:
+                        self._idle += 1
+
+    def _shed(self, request):
+        """Refuse without a thread: swallow whatever request bytes already
+        arrived (closing on unread data would reset the connection before
+        the client reads the 503), answer, close."""
+        if METRICS is not None:
+            METRICS.shedding('queue')
+        try:
+            request.setblocking(False)
+            try:
+                request.recv(65536)
+            except BlockingIOError:
+                pass
+            request.send(self.SHED)
+        except OSError:
+            pass
+        self.shutdown_request(request)
+
+    def handle_error(self, request, client_address):
+        # A browser cancelling an obsolete image/range request is routine and
+        # should not flood the terminal with a traceback.
+        if isinstance(sys.exc_info()[1], (BrokenPipeError, ConnectionResetError)):
+            return
+        super().handle_error(request, client_address)
+
+
+class BufferedExchange(NoCacheHandler):
+    """One request answered by NoCacheHandler without a socket of its own.
+
+    The asyncio engine reads the request head off the wire, replays it here
+    through the stock handle_one_request, and gets back the exact bytes the
+    threaded engine would have written before the body (end_headers,
+    _range_body, send_error and all), plus the body still to stream. Both
+    engines therefore share one definition of every response header."""
+
+    def __init__(self, head, client_address):
+        self.rfile = io.BytesIO(head)
+        self.wfile = io.BytesIO()
+        self.client_address = client_address
+        self.directory = os.getcwd()
+        self.body = None
+        self.close_connection = True
+        try:
+            self.handle_one_request()
+        except BaseException:
+            self.done(0)      # no exchange reaches the engine: give the slot back now
+            raise
+
+    def do_GET(self):
+        self.body = self.send_head()
+
+    def _finished(self, started):
+        self._started = started   # the engine calls done() after the body
+
+    def _live_stream(self):
+        self._live_headers()
+        return LIVE_STREAM        # the engine streams it (_live_stream_async)
+
+    def done(self, sent):
+        self._sent += sent
+        NoCacheHandler._finished(self, self._started)
+
+
+async def _within(seconds, awaitable):
+    """await with a deadline; asyncio.timeout (3.11+) avoids the extra task
+    wait_for spawns per call, which is most of a small response's cost."""
+    if not hasattr(asyncio, 'timeout'):
+        return await asyncio.wait_for(awaitable, seconds)
+    async with asyncio.timeout(seconds):
+        return await awaitable
+
+
+async def _read_head(reader, first_timeout):
+    """Request line plus header lines, or b'' when the client went away.
+    The first line waits up to first_timeout (the idle timeout between
+    kept-alive requests); the rest of the head must follow within
+    READ_TIMEOUT."""
+    line = await _within(first_timeout, reader.readline())
+    if not line:
+        return b''
+    head = [line]
+
+    async def rest():
+        for _ in range(MAX_HEADER_LINES):
+            header = await reader.readline()
+            head.append(header)
+            if header in (b'\r\n', b'\n', b''):
+                return
+    await _within(READ_TIMEOUT, rest())
+    return b''.join(head)
+
+
+async def _send_file(writer, fh, offset, count):
+    """sendfile(2) through the transport in slices, so READ_TIMEOUT bounds a
+    stalled client without cutting off a slow one that is still draining.
+    With SERVE_SENDFILE=0 the slices are read and written instead."""
+    loop = asyncio.get_running_loop()
+    while count is None or count > 0:
+        step = ASYNC_SEND_SLICE if count is None else min(count, ASYNC_SEND_SLICE)
+        if SENDFILE:
+            sent = await _within(
+                READ_TIMEOUT, loop.sendfile(writer.transport, fh, offset, step))
+        else:
+            fh.seek(offset)
+            chunk = fh.read(step)
+            writer.write(chunk)
+            await _within(READ_TIMEOUT, writer.drain())
+            sent = len(chunk)
+        if not sent:
+            return count in (None, 0)
+        offset += sent
+        if count is not None:
+            count -= sent
+    return True
+
+
+LIVE_STREAM = object()
+
+
+async def _live_stream_async(writer):
+    """The asyncio engine's side of NoCacheHandler._live_stream."""
+    loop = asyncio.get_running_loop()
+    events = asyncio.Queue()
+
+    def deliver(payload):
+        loop.call_soon_threadsafe(events.put_nowait, payload)
+
+    watch.LIVE.add(deliver)
+    try:
+        while True:
+            try:
+                payload = await _within(LIVERELOAD_HEARTBEAT, events.get())
+            except asyncio.TimeoutError:
+                payload = b': ping\n\n'
+            writer.write(payload)
+            await _within(READ_TIMEOUT, writer.drain())
+    finally:
+        watch.LIVE.discard(deliver)
+
+
+async def _send_body(writer, f):
+    """Write what BufferedExchange.body holds; returns (bytes sent, complete)."""
+    if f is None:
+        return 0, True
+    if f is LIVE_STREAM:
+        await _live_stream_async(writer)
+        return 0, False
+    parts, files = body_parts(f)
+    sent = 0
+    try:
+        for part in parts:
+            if not isinstance(part, tuple):
+                writer.write(part)
+                sent += len(part)
+                continue
+            fh, start, count = part
+            # Modules are mostly a few KB: one read joined to the head beats
+            # a sendfile round through the transport.
+            if count <= ASYNC_INLINE_BODY:
+                fh.seek(start)
+                data = fh.read(count)
+                writer.write(data)
+                sent += len(data)
+                if len(data) < count:
+                    return sent, False
+            elif await _send_file(writer, fh, start, count):
+                sent += count
+            else:
+                return sent, False
+        return sent, True
+    finally:
+        for fh in files:
+            fh.close()
+
+
+async def _serve_connection(reader, writer):
+    peer = writer.get_extra_info('peername')
+    timeout = READ_TIMEOUT
+    if METRICS is not None:
+        METRICS.opened()
+    try:
+        while True:
+            try:
+                head = await _read_head(reader, timeout)
+            except ValueError:
+                return            # a line past the reader's limit
+            if not head:
+                return
+            exchange = BufferedExchange(head, peer)
+            sent = 0
+            try:
+                writer.write(exchange.wfile.getvalue())
+                sent, complete = await _send_body(writer, exchange.body)
+                if writer.transport.get_write_buffer_size():
+                    await _within(READ_TIMEOUT, writer.drain())
+            finally:
+                exchange.done(sent)
+            if exchange.close_connection or not complete:
+                return
+            timeout = IDLE_TIMEOUT
+    except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError):
+        pass                      # idle/stalled client, reset
+    except asyncio.CancelledError:
+        pass                      # shutdown: a held stream or idle keep-alive
+    except Exception:
+        traceback.print_exc()
+    finally:
+        if METRICS is not None:
+            METRICS.closed()
+        writer.close()
+
+
+async def _serve_asyncio(port, sock=None):
+    if sock is not None:
+        server = await asyncio.start_server(_serve_connection, sock=sock)
+    else:
+        server = await asyncio.start_server(
+            _serve_connection, None, port, backlog=ASYNC_BACKLOG,
+            reuse_address=True)
+    if METRICS is not None:
+        METRICS.listeners = list(server.sockets)
+    # SIGTERM (Railway redeploys, the --workers supervisor) cancels the
+    # serving task from inside the loop rather than raising SystemExit in
+    # whatever callback happens to be running.
+    loop = asyncio.get_running_loop()
+    try:
+        loop.add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)
+    except (NotImplementedError, RuntimeError):
+        pass
+    async with server:
+        await server.serve_forever()
+
+
+def _raise_fd_limit():
+    """One open socket per kept-alive visitor: lift the soft RLIMIT_NOFILE to
+    the hard limit so thousands of idle connections do not hit EMFILE."""
+    try:
+        import resource
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if hard == resource.RLIM_INFINITY or soft < hard:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    except (ImportError, ValueError, OSError):
+        pass
+
+
+def serve(sock=None):
+    """Run the configured engine until interrupted, on `sock` (a worker's
+    listening socket) or on a fresh bind of PORT."""
+    if watch.WATCHER is None:                    # per process: threads do not fork
+        watch.start_watching(artifact.INDEX is not None)
+    if accesslog.ACCESS_LOG_PATH and accesslog.ACCESS is None:
+        path = accesslog.ACCESS_LOG_PATH
+        if WORKER is not None and path != '-':
+            root, ext = os.path.splitext(path)
+            path = f'{root}.{WORKER}{ext}'
+        accesslog.ACCESS = accesslog.AccessLog(path)
+        if signal.getsignal(signal.SIGTERM) is signal.SIG_DFL:
+            # Exit through the interpreter so atexit writes the last batch.
+            signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    if ENGINE == 'asyncio':
+        _raise_fd_limit()
+        try:
+            asyncio.run(_serve_asyncio(PORT, sock))
+        except (KeyboardInterrupt, asyncio.CancelledError):
+            pass
+        return
+    # Browsers fetch the ES-module graph, images and media in parallel.  A
+    # plain TCPServer handles only one request at a time; under Chrome's
+    # eager parallel loader its tiny listen backlog can reset a module
+    # connection while another response is still being written.
+    # ThreadingHTTPServer exists specifically for browsers that pre-open
+    # sockets, and daemon threads keep Ctrl-C/restarts prompt during local
+    # development.
+    httpd = ParallelHTTPServer(('', PORT), NoCacheHandler,
+                               bind_and_activate=sock is None)
+    if sock is not None:
+        httpd.socket.close()
+        httpd.socket = sock
+        httpd.server_address = sock.getsockname()[:2]
+        httpd.server_name, httpd.server_port = 'localhost', httpd.server_address[1]
+    if METRICS is not None:
+        METRICS.listeners = [httpd.socket]
+        METRICS.pool = httpd
+    with httpd:
+        try:
+            httpd.serve_forever()
+        except KeyboardInterrupt:
+            pass
+
+
+def _listener(reuse_port):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind(('', PORT))
+    return sock
+
+
+def run_workers(count):
+    """Pre-fork `count` worker processes, each a complete server (its own
+    GIL, its own engine), and supervise them: SIGTERM/SIGINT is fanned out
+    to every worker, a worker that dies on its own is replaced.
+
+    With SO_REUSEPORT (Linux, macOS) every worker listens on its own socket
+    and the kernel spreads new connections across them; elsewhere the
+    workers inherit one pre-bound listening socket. Either way the parent
+    binds PORT first, so a taken port fails once instead of crash-looping
+    every worker. The startup index is built before the fork, so workers
+    share its pages copy-on-write."""
+    reuse_port = hasattr(socket, 'SO_REUSEPORT')
+    backlog = ASYNC_BACKLOG if ENGINE == 'asyncio' else ParallelHTTPServer.request_queue_size
+    reserved = _listener(reuse_port)
+    if not reuse_port:
+        reserved.listen(backlog)
+    children = {}          # pid -> (spawn time, worker number)
+    stopping = False
+
+    def spawn(number):
+        global WORKER
+        pid = os.fork()
+        if pid:
+            children[pid] = (time.monotonic(), number)
+            return
+        code = 0
+        WORKER = number
+        try:
+            signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+            signal.signal(signal.SIGINT, signal.default_int_handler)
+            sock = reserved
+            if reuse_port:
+                reserved.close()
+                sock = _listener(True)
+                sock.listen(backlog)
+            serve(sock)
+        except SystemExit as stop:
+            code = stop.code if isinstance(stop.code, int) else 0
+        except BaseException:
+            traceback.print_exc()
+            code = 1
+        finally:
+            os._exit(code)
+
+    def stop(signum, frame):
+        nonlocal stopping
+        if stopping:       # second signal: stop waiting for stragglers
+            for pid in children:
+                _kill(pid, signal.SIGKILL)
+            return
+        stopping = True
+        for pid in children:
+            _kill(pid, signal.SIGTERM)
+        signal.alarm(WORKER_GRACE)
+
+    def _kill(pid, sig):
+        try:
+            os.kill(pid, sig)
+        except ProcessLookupError:
+            pass
+
+    for number in range(count):
+        spawn(number)
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGALRM, lambda *_: stop(None, None))
+    while children:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        child = children.pop(pid, None)
+        if stopping or child is None:
+            continue
+        started, number = child
+        print(f'serve.py: worker {pid} exited ({status:#x}); restarting',
+              file=sys.stderr, flush=True)
+        if time.monotonic() - started < 1:
+            time.sleep(1)      # crash loop: do not spin
+        spawn(number)
+    reserved.close()
@@ -0,0 +1,114 @@
+"""One file as served: its validators and ready-made 200 header block."""
+import email.utils, hashlib, http.server
+
+from .config import CACHING
+from .negotiation import MEDIA_HINTS
+
+
+def guess_type(path):
+    """MIME type by extension; guess_type only reads the class-level
+    extensions_map, so no handler instance is needed."""
+    return http.server.SimpleHTTPRequestHandler.guess_type(
+        http.server.SimpleHTTPRequestHandler, path)
+
+
+def content_etag(data=None, path=None):
+    """Strong ETag: the first 128 bits of the content's sha256."""
+    digest = hashlib.sha256()
+    if data is not None:
+        digest.update(data)
+    else:
+        with open(path, 'rb') as fh:
+            for chunk in iter(lambda: fh.read(1 << 20), b''):
+                digest.update(chunk)
+    return f'"{digest.hexdigest()[:32]}"'
+
+
+def stat_etag(st):
+    """Weak ETag from the stat alone: any write, replace or touch changes it."""
+    return f'W/"{st.st_mtime_ns:x}-{st.st_ino:x}-{st.st_size:x}"'
+
+
+_ETAGS = {}   # (path, size, mtime_ns, inode) -> content_etag, unindexed files
+
+
+def file_etag(path, st):
+    """ETag for a file outside the startup index (memoized per stat)."""
+    if CACHING == 'no-store':
+        return None
+    if CACHING == 'dev':
+        return stat_etag(st)
+    key = (path, st.st_size, st.st_mtime_ns, st.st_ino)
+    etag = _ETAGS.get(key)
+    if etag is None:
+        etag = _ETAGS[key] = content_etag(path=path)
+    return etag
+
+
+class ServedFile:
+    """One regular file as about to be served: size, MIME type, validators,
+    and `head`, the ready-made Content-type/Content-Length/Last-Modified
+    (/ETag/Vary) block of its 200 response. `cache` is the ArtifactCache
+    that holds its bytes, or None when the body is read from disk per
+    request; `data` holds the bytes of an inline (small) indexed file.
+
+    A precompressed sidecar (name.js.gz next to name.js) is a ServedFile
+    too, with the original's MIME type and its `encoding` set; the
+    original lists its sidecars in `variants` (coding -> ServedFile).
+    A media file's lower-bitrate encoding (name.lite.mp4) hangs off it as
+    `lite`; both are then `hinted` — chosen per request by client hints.
+    An image's AVIF/WebP transcodes (name.png.avif) are its `formats`
+    (MIME type -> ServedFile), all of them `typed` — chosen by Accept."""
+    __slots__ = ('path', 'size', 'mtime', 'ctype', 'etag', 'modified', 'head', 'data',
+                 'cache', 'encoding', 'variants', 'lite', 'hinted', 'formats', 'typed')
+
+    def __init__(self, path, size, mtime, ctype, etag=None, cache=None,
+                 encoding=None):
+        self.path = path
+        self.size = size
+        self.mtime = mtime
+        self.ctype = ctype
+        self.etag = etag
+        self.modified = email.utils.formatdate(mtime, usegmt=True)
+        self.data = None
+        self.cache = cache
+        self.encoding = encoding
+        self.variants = {}
+        self.lite = None
+        self.hinted = False
+        self.formats = {}
+        self.typed = False
+        self._build_head()
+
+    def add_variant(self, variant):
+        self.variants[variant.encoding] = variant
+        self._build_head()
+
+    def add_lite(self, lite):
+        self.lite = lite
+        self.hinted = lite.hinted = True
+        self._build_head()
+        lite._build_head()
+
+    def add_format(self, image):
+        self.formats[image.ctype] = image
+        self.typed = image.typed = True
+        self._build_head()
+        image._build_head()
+
+    @property
+    def vary(self):
+        """The Vary header value, None when the URL has one representation."""
+        fields = (['Accept'] if self.typed else []) \
+            + (['Accept-Encoding'] if self.encoding or self.variants else []) \
+            + ([MEDIA_HINTS] if self.hinted else [])
+        return ', '.join(fields) or None
+
+    def _build_head(self):
+        self.head = (f'Content-type: {self.ctype}\r\n'
+                     + (f'Content-Encoding: {self.encoding}\r\n' if self.encoding else '')
+                     + f'Content-Length: {self.size}\r\n'
+                     f'Last-Modified: {self.modified}\r\n'
+                     + (f'ETag: {self.etag}\r\n' if self.etag else '')
+                     + (f'Vary: {self.vary}\r\n' if self.vary else '')
+                     ).encode('latin-1')
@@ -0,0 +1,536 @@
+"""NoCacheHandler: every response header either engine sends."""
+import html, http.cookies, http.server, io, ipaddress, os, queue, re, select, socket, stat
+import time, urllib.parse
+
+from . import accesslog, artifact, watch
+from .artifact import REVISIONS
+from .config import (ARTIFACT, CACHING, DEFAULT_REVISION, EARLY_HINTS, FINGERPRINT_RE,
+                     IDLE_TIMEOUT, IMMUTABLE, KEEPALIVE, KEEPALIVE_ERRORS, LIVERELOAD_HEARTBEAT,
+                     LIVERELOAD_PATH, MEDIA_SLOTS, POOL_RECHECK, READ_TIMEOUT, RETIRED_WORKER,
+                     RETRY_AFTER, REVISION_COOKIE, REVISION_HEADER, REVISION_PATH, REVISION_VARY,
+                     SENDFILE)
+from .files import ServedFile, file_etag
+from .metrics import METRICS, METRICS_PATH, route_class
+from .negotiation import (ACCEPT_CH, IMAGE_FORMATS, SIDECARS, encoding_variant, image_format,
+                          lite_path, media_variant)
+from .preload import PRELOADS
+from .ranges import byte_ranges, if_range_holds, not_modified
+
+
+def body_parts(body):
+    """A send_head body as (parts, files): parts are bytes-like chunks or
+    (fh, offset, count) spans in wire order, files the handles to close."""
+    parts, files = [], []
+    for part in body if isinstance(body, list) else (body,):
+        if isinstance(part, (bytes, memoryview)):
+            parts.append(part)
+        elif isinstance(part, io.BytesIO):
+            parts.append(part.getvalue())
+        elif isinstance(part, tuple):
+            fh, start, end = part
+            parts.append((fh, start, end - start + 1))
+            if fh not in files:
+                files.append(fh)
+        else:                              # a file SimpleHTTPRequestHandler opened
+            start = part.tell()
+            parts.append((part, start, os.fstat(part.fileno()).st_size - start))
+            files.append(part)
+    return parts, files
+
+
+class NoCacheHandler(http.server.SimpleHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1' if KEEPALIVE else 'HTTP/1.0'
+    timeout = READ_TIMEOUT
+    # Headers and body go out as separate writes; on a reused connection
+    # Nagle holds the body back for the client's delayed ACK (~40 ms per
+    # response), which would cost more than the handshakes saved.
+    disable_nagle_algorithm = True
+    _range_size = None
+    _immutable = False
+
+    def end_headers(self):
+        if CACHING == 'no-store':
+            self.send_header('Cache-Control', 'no-store, must-revalidate')
+            self.send_header('Pragma', 'no-cache')
+            self.send_header('Expires', '0')
+        else:
+            self.send_header('Cache-Control', IMMUTABLE if self._immutable else 'no-cache')
+        super().end_headers()
+
+    def handle(self):
+        if METRICS is not None:
+            METRICS.opened()
+        try:
+            self.close_connection = True
+            if not self._await_next_request(first=True):
+                return
+            self.handle_one_request()
+            while not self.close_connection and self._await_next_request():
+                self.handle_one_request()
+        finally:
+            if METRICS is not None:
+                METRICS.closed()
+
+    def handle_one_request(self):
+        self._status = None
+        self._sent = 0
+        self._media_slot = False
+        self._revision = DEFAULT_REVISION
+        self._immutable = False
+        started = time.perf_counter()
+        try:
+            super().handle_one_request()
+        finally:
+            self._finished(started)
+
+    def _finished(self, started):
+        """The response is on the wire: give back its media slot, record it."""
+        if self._media_slot:
+            self._media_slot = False
+            MEDIA_SLOTS.release()
+        if self._status is None:
+            return
+        duration = time.perf_counter() - started
+        if METRICS is not None:
+            METRICS.observe(getattr(self, 'path', ''), self._status, self._sent, duration,
+                            self._revision if REVISIONS else '')
+        if accesslog.ACCESS is not None:
+            accesslog.ACCESS.record(self, duration)
+
+    def send_response(self, code, message=None):
+        self._status = code
+        super().send_response(code, message)
+
+    def _await_next_request(self, first=False):
+        """Park a connection until its next request starts.
+
+        The read timeout guards a request in flight; between requests the
+        (shorter) idle timeout applies, so a tab that keeps its sockets open
+        but stops asking does not pin a server thread. While it waits the
+        connection checks the pool every POOL_RECHECK seconds: with others
+        queued for a thread it closes (clients retry on a fresh connection)
+        unless its next request is already here."""
+        load = getattr(self.server, 'load', None)
+        deadline = time.monotonic() + (READ_TIMEOUT if first else IDLE_TIMEOUT)
+        try:
+            poller = select.poll()
+            poller.register(self.connection, select.POLLIN)
+            while True:
+                if self._request_ready():
+                    return True
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                if load is not None and load()[1] and not first:
+                    return False
+                if poller.poll(min(remaining, POOL_RECHECK) * 1000):
+                    return bool(self.rfile.peek(1))     # request or EOF
+                first = False
+        except OSError:                   # reset, closed
+            return False
+
+    def _request_ready(self):
+        """Bytes already buffered or on the socket, without blocking."""
+        self.connection.setblocking(False)
+        try:
+            return bool(self.rfile.peek(1))
+        finally:
+            self.connection.settimeout(self.timeout)
+
+    def send_error(self, code, message=None, explain=None):
+        """BaseHTTPRequestHandler.send_error always adds Connection: close.
+        A 404 for a probed favicon or a 416 for a player's overshooting
+        seek is not a reason to drop a warm connection, so those keep it
+        open — unless the request carried a body we never read, which would
+        otherwise be parsed as the next request line. Anything else (parse
+        errors, oversized lines, unsupported methods) still closes."""
+        try:
+            shortmsg, longmsg = self.responses[code]
+        except KeyError:
+            shortmsg, longmsg = '???', '???'
+        message = shortmsg if message is None else message
+        explain = longmsg if explain is None else explain
+        self._immutable = False          # an error on a fingerprinted URL revalidates
+        body = (self.error_message_format % {
+            'code': code,
+            'message': html.escape(message, quote=False),
+            'explain': html.escape(explain, quote=False),
+        }).encode('UTF-8', 'replace')
+        self.send_response(code, message)
+        if code not in KEEPALIVE_ERRORS or self._has_request_body():
+            self.send_header('Connection', 'close')
+        if code == 416 and self._range_size is not None:
+            self.send_header('Content-Range', f'bytes */{self._range_size}')
+        if code == 503:
+            self.send_header('Retry-After', str(RETRY_AFTER))
+        self.send_header('Content-Type', self.error_content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+            self._sent = len(body)
+
+    def _has_request_body(self):
+        headers = getattr(self, 'headers', None)
+        return (headers is None
+                or headers.get('Content-Length', '0').strip() != '0'
+                or 'Transfer-Encoding' in headers)
+
+    def send_head(self):
+        self._range_size = None
+        if METRICS is not None and self.path == METRICS_PATH \
+                and ipaddress.ip_address(self.client_address[0]).is_loopback:
+            return self._metrics_head()
+        if watch.LIVE is not None and self.path == LIVERELOAD_PATH and self.command == 'GET':
+            return self._live_stream()
+        if route_class(self.path) == 'media':
+            if not MEDIA_SLOTS.acquire(blocking=False):
+                if METRICS is not None:
+                    METRICS.shedding('media')
+                self.send_error(503, 'Media streams at capacity')
+                return None
+            self._media_slot = True
+        index = artifact.INDEX
+        if REVISIONS:
+            if self.path.startswith(REVISION_PATH):
+                return self._switch_revision()
+            revision = self._choose_revision()
+            self._revision = revision.name
+            self.directory = revision.root
+            index = revision.index
+        path = self.translate_path(self.path)
+        entry = index.get(path) if index is not None else None
+        stat_cache = watch.STAT_CACHE
+        if entry is None and stat_cache is not None and index is artifact.INDEX:
+            key, generation = path, stat_cache.generation
+            entry = stat_cache.get(key)
+            if entry is None:
+                entry = self._stat_entry(path)
+                if entry is None:
+                    return self._missing_head()
+                stat_cache.put(key, entry, generation)
+        elif entry is None:
+            if index is not None and index.get(path + '/') is not None:
+                return self._redirect_to_directory()    # a pack has no dirs
+            entry = self._stat_entry(path)
+            if entry is None:
+                return self._missing_head()
+        return self._file_head(entry)
+
+    def _missing_head(self):
+        """No such file: redirects, listings and 404s as usual, except
+        RETIRED_WORKER for a service worker update check."""
+        if self.headers.get('Service-Worker') != 'script' \
+                or not urllib.parse.urlsplit(self.path).path.endswith('.js'):
+            try:
+                return super().send_head()
+            except ValueError:                 # open() on a %00 path
+                self.send_error(404, 'File not found')
+                return None
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/javascript')
+        self.send_header('Content-Length', str(len(RETIRED_WORKER)))
+        self.end_headers()
+        return io.BytesIO(RETIRED_WORKER)
+
+    def _choose_revision(self):
+        """The mounted revision this request asked for (header, then
+        cookie), else the tree serve.py runs from."""
+        name = self.headers.get(REVISION_HEADER)
+        if name is None:
+            cookies = http.cookies.SimpleCookie()
+            try:
+                cookies.load(self.headers.get('Cookie', ''))
+            except http.cookies.CookieError:
+                pass
+            morsel = cookies.get(REVISION_COOKIE)
+            name = morsel.value if morsel is not None else None
+        return REVISIONS.get(name.strip() if name else DEFAULT_REVISION,
+                             REVISIONS[DEFAULT_REVISION])
+
+    def _switch_revision(self):
+        """/__revision/<name>/<path>: pin this browser to a revision (a
+        session cookie) and continue at /<path>. A prefix cannot simply
+        mount the tree — the pages load /main.js, /journey/... and the
+        import map by absolute URL, which would fall back to the default
+        revision and mix two module graphs."""
+        name, _, rest = self.path[len(REVISION_PATH):].partition('/')
+        if name not in REVISIONS:
+            self.send_error(404, 'No such revision')
+            return None
+        self.send_response(302)
+        self.send_header('Set-Cookie', f'{REVISION_COOKIE}={name}; Path=/; SameSite=Lax')
+        self.send_header('Location', '/' + rest)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+        return None
+
+    def _redirect_to_directory(self):
+        """The 301 SimpleHTTPRequestHandler sends for a directory URL
+        without its trailing slash, for an indexed directory."""
+        parts = urllib.parse.urlsplit(self.path)
+        self.send_response(301)
+        self.send_header('Location', urllib.parse.urlunsplit(
+            (parts[0], parts[1], parts[2] + '/', parts[3], parts[4])))
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+        return None
+
+    def _stat_entry(self, path):
+        """ServedFile for a regular file outside the index (and its
+        sidecars in an artifact); None leaves the request to
+        SimpleHTTPRequestHandler — redirects, listings, 404."""
+        if path.endswith('/') and os.path.isdir(path):
+            path = next((path + index for index in ('index.html', 'index.htm')
+                         if os.path.isfile(path + index)), path)
+        if path.endswith('/'):
+            return None
+        try:
+            st = os.stat(path)
+        except (OSError, ValueError):      # ValueError: a %00 in the URL
+            return None
+        if not stat.S_ISREG(st.st_mode):
+            return None
+        ctype = self.guess_type(path)
+        entry = ServedFile(path, st.st_size, st.st_mtime, ctype, file_etag(path, st))
+        if watch.LIVE is not None and ctype == 'text/html':
+            return self._live_html(entry)
+        if ARTIFACT:
+            for suffix, coding in SIDECARS:
+                try:
+                    side = os.stat(path + suffix)
+                except (OSError, ValueError):
+                    continue
+                entry.add_variant(ServedFile(
+                    path + suffix, side.st_size, side.st_mtime, ctype,
+                    file_etag(path + suffix, side), encoding=coding))
+            lite = lite_path(path)
+            try:
+                side = os.stat(lite) if lite is not None else None
+            except (OSError, ValueError):
+                side = None
+            if side is not None:
+                entry.add_lite(ServedFile(lite, side.st_size, side.st_mtime,
+                                          ctype, file_etag(lite, side)))
+            if ctype.startswith('image/'):
+                for suffix, image_type in IMAGE_FORMATS:
+                    try:
+                        side = os.stat(path + suffix)
+                    except (OSError, ValueError):
+                        continue
+                    entry.add_format(ServedFile(
+                        path + suffix, side.st_size, side.st_mtime, image_type,
+                        file_etag(path + suffix, side)))
+        return entry
+
+    def _live_headers(self):
+        self.close_connection = True         # the stream ends with the socket
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        self.wfile.write(b'retry: 1000\n\n')
+
+    def _live_stream(self):
+        """Hold the connection (and its thread) open as an event stream
+        until the page goes away; a comment every LIVERELOAD_HEARTBEAT
+        notices a vanished peer."""
+        self._live_headers()
+        events = queue.SimpleQueue()
+        deliver = events.put
+        watch.LIVE.add(deliver)
+        try:
+            while True:
+                try:
+                    payload = events.get(timeout=LIVERELOAD_HEARTBEAT)
+                except queue.Empty:
+                    payload = b': ping\n\n'
+                self.wfile.write(payload)
+        except OSError:
+            pass
+        finally:
+            watch.LIVE.discard(deliver)
+        return None
+
+    def _live_html(self, entry):
+        """The page with LIVERELOAD_CLIENT after its <head> tag, as an
+        in-memory entry with its own validator."""
+        try:
+            with open(entry.path, 'rb') as fh:
+                page = fh.read()
+        except (OSError, ValueError):
+            return entry
+        m = re.search(rb'<head[^>]*>', page, re.I)
+        at = m.end() if m else 0
+        page = page[:at] + watch.LIVERELOAD_CLIENT + page[at:]
+        etag = entry.etag and entry.etag[:-1] + '-lr"'
+        live = ServedFile(entry.path, len(page), entry.mtime, entry.ctype, etag)
+        live.data = memoryview(page)
+        return live
+
+    def _metrics_head(self):
+        body = METRICS.render()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        return io.BytesIO(body)
+
+    def _file_head(self, entry):
+        """Headers for a regular file; returns the body for send_body —
+        a memoryview for an indexed file, otherwise (fh, start, end); a list
+        of parts for multipart/byteranges — or None when the response is
+        complete."""
+        links = PRELOADS.get(entry.path)
+        page = (ARTIFACT or bool(REVISIONS)) and entry.ctype == 'text/html'
+        self._immutable = CACHING == 'production' and FINGERPRINT_RE.search(entry.path) is not None
+        if entry.lite is not None:
+            entry = media_variant(entry, self.path, self.headers)
+        if entry.formats and 'Range' not in self.headers:
+            entry = image_format(entry, self.headers.get('Accept', ''))
+        if entry.variants and 'Range' not in self.headers:
+            entry = encoding_variant(entry, self.headers.get('Accept-Encoding', ''))
+        if not_modified(entry, self.headers):
+            self.send_response(304)
+            self._send_validators(entry)
+            self.end_headers()
+            return None
+        if 'Range' in self.headers and if_range_holds(entry, self.headers):
+            spans = byte_ranges(self.headers['Range'], entry.size)
+            if spans is None:
+                self._range_size = entry.size
+                self.send_error(416, 'Range Not Satisfiable')
+                return None
+            if spans:
+                return self._range_body(entry, spans)
+        body = self._open_body(entry, 0, entry.size - 1)
+        if body is None:
+            return None
+        if links and EARLY_HINTS and self.request_version != 'HTTP/1.0':
+            # Straight to the socket ahead of the 200, so a proxy that
+            # relays 1xx can start the preloads before the page arrives.
+            self.wfile.write(b'HTTP/1.1 103 Early Hints\r\n' + links + b'\r\n')
+        self.send_response(200)
+        self._headers_buffer.append(entry.head)
+        if REVISIONS:
+            self._headers_buffer.append(REVISION_VARY)
+        if links:
+            self._headers_buffer.append(links)
+        if page:
+            self._headers_buffer.append(ACCEPT_CH)   # hints for its media
+        self.end_headers()
+        return body
+
+    def _range_body(self, entry, spans):
+        """206 for the satisfiable spans: one range as a plain body, several
+        as multipart/byteranges whose parts are slices of the same indexed
+        view or spans of one open file (still sendfile'd part by part)."""
+        whole = self._open_body(entry, 0, entry.size - 1)
+        if whole is None:
+            return None
+        if isinstance(whole, memoryview):
+            parts = [whole[start:end + 1] for start, end in spans]
+        else:
+            parts = [(whole[0], start, end) for start, end in spans]
+        self.send_response(206)
+        self.send_header('Accept-Ranges', 'bytes')
+        if len(spans) == 1:
+            (start, end), = spans
+            self.send_header('Content-Type', entry.ctype)
+            self.send_header('Content-Range', f'bytes {start}-{end}/{entry.size}')
+            self.send_header('Content-Length', str(end - start + 1))
+            body = parts[0]
+        else:
+            boundary = os.urandom(12).hex()
+            body = []
+            for (start, end), part in zip(spans, parts):
+                body.append(f'\r\n--{boundary}\r\n'
+                            f'Content-Type: {entry.ctype}\r\n'
+                            f'Content-Range: bytes {start}-{end}/{entry.size}\r\n'
+                            f'\r\n'.encode('latin-1'))
+                body.append(part)
+            body.append(f'\r\n--{boundary}--\r\n'.encode('latin-1'))
+            length = sum(len(p) if not isinstance(p, tuple) else p[2] - p[1] + 1
+                         for p in body)
+            self.send_header('Content-Type', f'multipart/byteranges; boundary={boundary}')
+            self.send_header('Content-Length', str(length))
+        self._send_validators(entry)
+        self.end_headers()
+        return body
+
+    def _open_body(self, entry, start, end):
+        if entry.data is not None:
+            return entry.data[start:end + 1]
+        if entry.cache is not None:
+            return entry.cache.view(entry)[start:end + 1]
+        try:
+            fh = open(entry.path, 'rb')
+        except (OSError, ValueError):
+            self.send_error(404, 'File not found')
+            return None
+        return fh, start, end
+
+    def _send_validators(self, entry):
+        if entry.etag:
+            self.send_header('ETag', entry.etag)
+        if CACHING != 'no-store':
+            self.send_header('Last-Modified', entry.modified)
+        if entry.vary:
+            self.send_header('Vary', entry.vary)
+        if REVISIONS:
+            self._headers_buffer.append(REVISION_VARY)
+
+    def do_GET(self):
+        f = self.send_head()
+        if f is not None:
+            self.send_body(f)
+
+    def send_body(self, f):
+        """Stream what send_head returned — an indexed memoryview, the
+        (fh, start, end) of a file, the parts of a multipart/byteranges
+        body, or a file object — and close it."""
+        parts, files = body_parts(f)
+        try:
+            for part in parts:
+                if not isinstance(part, tuple):
+                    self.wfile.write(part)
+                    self._sent += len(part)
+                    continue
+                fh, start, count = part
+                sent = self._send_span(fh, start, count)
+                self._sent += sent
+                if sent < count:
+                    # The file shrank under us: the promised Content-Length
+                    # can no longer be honoured, so end the connection
+                    # rather than let the client misframe the next response.
+                    self.close_connection = True
+                    return
+        finally:
+            for fh in files:
+                fh.close()
+
+    def _send_span(self, fh, start, count):
+        if SENDFILE and isinstance(self.connection, socket.socket):
+            # socket.sendfile is os.sendfile(2) on a plain socket — the
+            # kernel moves page-cache pages straight to the NIC — and
+            # quietly degrades to send() for TLS sockets or platforms
+            # without it. It honours the socket timeout either way.
+            return self.connection.sendfile(fh, start, count)
+        fh.seek(start)
+        sent = 0
+        while sent < count:
+            chunk = fh.read(min(65536, count - sent))
+            if not chunk:
+                break
+            self.wfile.write(chunk)
+            sent += len(chunk)
+        return sent
+
+    def do_HEAD(self):
+        f = self.send_head()
+        if f is not None:
+            for fh in body_parts(f)[1]:
+                fh.close()
+
+    def log_message(self, *a):
+        pass  # quiet: a stderr line per request from every thread; see AccessLog
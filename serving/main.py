@@ -0,0 +1,67 @@
+"""Command line: build the startup indexes, print the banner, run the engine."""
+import argparse, os, sys
+
+from . import artifact, engines, watch
+from .accesslog import ACCESS_LOG_PATH, ACCESS_LOG_SAMPLE
+from .artifact import REVISIONS, ArtifactCache, PackedArtifact, Revision, mount_revision
+from .config import (CACHE, CACHE_CEILING, CACHE_INLINE, CACHING, DEFAULT_REVISION,
+                     EARLY_HINTS, ENGINE, IDLE_TIMEOUT, KEEPALIVE, LIVERELOAD_PATH, PACK_NAME,
+                     PORT, PRELOAD, REVISIONS_SPEC)
+from .preload import PRELOADS, preload_hints
+
+
+def main(description):
+    parser = argparse.ArgumentParser(prog='serve.py', description=description)
+    parser.add_argument('--workers', type=int,
+                        default=int(os.environ.get('SERVE_WORKERS', 1)),
+                        help='pre-forked server processes sharing the port '
+                             '(default $SERVE_WORKERS or 1)')
+    args = parser.parse_args()
+    if ENGINE not in ('threads', 'asyncio'):
+        sys.exit(f"serve.py: unknown SERVE_ENGINE {ENGINE!r} (threads|asyncio)")
+    if args.workers > 1 and not hasattr(os, 'fork'):
+        sys.exit('serve.py: --workers needs os.fork (POSIX)')
+    banner = (f'serving glowshroom/ on :{PORT} with {CACHING} + range support'
+              + (f' + keep-alive ({IDLE_TIMEOUT:g}s idle)' if KEEPALIVE else '')
+              + (' [asyncio]' if ENGINE == 'asyncio' else '')
+              + (f' x {args.workers} workers' if args.workers > 1 else ''))
+    if os.path.isfile(PACK_NAME):
+        index = PackedArtifact(os.getcwd(), PACK_NAME)   # the tree is not on disk
+    elif CACHE:
+        index = ArtifactCache(os.getcwd(), CACHE_CEILING, CACHE_INLINE)
+    else:
+        index = None
+    if index is not None:
+        artifact.INDEX = index
+        banner += f'\n  index: {index.summary()}'
+    if REVISIONS_SPEC:
+        REVISIONS[DEFAULT_REVISION] = Revision(DEFAULT_REVISION, os.getcwd(), index)
+        for item in REVISIONS_SPEC.split(','):
+            name, _, root = item.partition('=')
+            name = name.strip()
+            if not name or not root or name in REVISIONS or '/' in name:
+                sys.exit(f'serve.py: bad SERVE_REVISIONS entry {item!r} (name=artifact-dir)')
+            REVISIONS[name] = mount_revision(name, root.strip())
+            banner += f'\n  revision {name}: {REVISIONS[name].index.summary()}'
+    if args.workers == 1 and watch.start_watching(index is not None):
+        banner += (f'\n  watching: {watch.WATCHER.mode}'
+                   + (' (stat cache)' if watch.STAT_CACHE is not None else '')
+                   + (f' (live reload on {LIVERELOAD_PATH})' if watch.LIVE is not None else ''))
+    if PRELOAD:
+        PRELOADS.update(preload_hints(os.getcwd(), index))
+    for revision in REVISIONS.values():
+        # Mounted revisions are artifacts: hinted unless SERVE_PRELOAD=0.
+        if revision.name != DEFAULT_REVISION and os.environ.get('SERVE_PRELOAD') != '0':
+            PRELOADS.update(preload_hints(revision.root, revision.index))
+    if PRELOAD or REVISIONS:
+        banner += (f'\n  preload: {len(PRELOADS)} pages hinted'
+                   + (' + 103 Early Hints' if EARLY_HINTS else ''))
+    if ACCESS_LOG_PATH:
+        banner += (f'\n  access log: {ACCESS_LOG_PATH}'
+                   + (' (one file per worker)' if args.workers > 1 and ACCESS_LOG_PATH != '-' else '')
+                   + (f', {ACCESS_LOG_SAMPLE:g} of non-errors' if ACCESS_LOG_SAMPLE < 1 else ''))
+    print(banner, flush=True)
+    if args.workers > 1:
+        engines.run_workers(args.workers)
+    else:
+        engines.serve()
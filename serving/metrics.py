@@ -0,0 +1,183 @@
+"""Prometheus counters on METRICS_PATH (SERVE_METRICS)."""
+import bisect, collections, os, socket, struct, threading
+
+from . import artifact
+from .artifact import REVISIONS
+from .config import ENGINE
+
+# Opt-in Prometheus endpoint: SERVE_METRICS=1 serves METRICS_PATH, to
+# loopback clients only (anyone else gets the 404 an unknown path gets).
+METRICS_PATH = os.environ.get('SERVE_METRICS_PATH', '/__metrics')
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0)
+ROUTE_CLASSES = ('module', 'geom', 'media', 'html', 'other')
+
+
+def route_class(url_path):
+    """Coarse route class of a request path, the label every metric uses."""
+    path = url_path.split('?', 1)[0]
+    if path.endswith(('.js', '.mjs')):
+        return 'module'
+    if path.startswith('/static/geom/'):
+        return 'geom'
+    if path.endswith(('.mp4', '.webm', '.mov')):
+        return 'media'
+    if path.endswith(('/', '.html', '.htm')):
+        return 'html'
+    return 'other'
+
+
+class Metrics:
+    """Request counters and fixed-bucket latency histograms per route class.
+
+    One short critical section per request (a few integer adds under an
+    uncontended lock) — no allocation, no per-request labels beyond the
+    route class and status code (and, under SERVE_REVISIONS, the revision
+    that answered). Counters are per process: with --workers each scrape
+    reports the worker that happened to accept it (pid label).
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = collections.Counter()          # (revision, route, status)
+        self.bytes = collections.Counter()             # (revision, route)
+        self.buckets = {}                              # (revision, route) -> counts
+        self.latency_sum = collections.Counter()       # (revision, route)
+        self.active = 0                                # open connections
+        self.connections = 0
+        self.shed = collections.Counter()              # reason
+        self.listeners = []                            # listening sockets
+        self.pool = None                               # ParallelHTTPServer
+
+    def observe(self, url_path, status, sent, seconds, revision=''):
+        key = revision, route_class(url_path)
+        slot = bisect.bisect_left(LATENCY_BUCKETS, seconds)
+        with self._lock:
+            self.requests[key + (status,)] += 1
+            self.bytes[key] += sent
+            counts = self.buckets.get(key)
+            if counts is None:
+                counts = self.buckets[key] = [0] * (len(LATENCY_BUCKETS) + 1)
+            counts[slot] += 1
+            self.latency_sum[key] += seconds
+
+    def shedding(self, reason):
+        with self._lock:
+            self.shed[reason] += 1
+
+    def opened(self):
+        with self._lock:
+            self.active += 1
+            self.connections += 1
+
+    def closed(self):
+        with self._lock:
+            self.active -= 1
+
+    def accept_queue(self):
+        """(queued, capacity) summed over the listening sockets, from Linux
+        TCP_INFO (tcpi_unacked / tcpi_sacked on a LISTEN socket); None
+        where the kernel does not report it."""
+        if not hasattr(socket, 'TCP_INFO'):
+            return None
+        queued = capacity = 0
+        for sock in self.listeners:
+            try:
+                info = sock.getsockopt(socket.IPPROTO_TCP, socket.TCP_INFO, 32)
+            except OSError:
+                return None
+            unacked, sacked = struct.unpack_from('II', info, 24)
+            queued += unacked
+            capacity += sacked
+        return queued, capacity
+
+    def render(self):
+        """Prometheus text exposition format 0.0.4."""
+        pid = os.getpid()
+        with self._lock:
+            requests = dict(self.requests)
+            sent = dict(self.bytes)
+            buckets = {route: list(counts) for route, counts in self.buckets.items()}
+            latency_sum = dict(self.latency_sum)
+            active, connections = self.active, self.connections
+            shed = dict(self.shed)
+        # Without SERVE_REVISIONS every key has revision '' and no label.
+        revisions = sorted({revision for revision, _ in buckets} | set(REVISIONS)) or ['']
+        empty = [0] * (len(LATENCY_BUCKETS) + 1)
+
+        def labels(revision, route):
+            tag = f',revision="{revision}"' if revision else ''
+            return f'pid="{pid}"{tag},route="{route}"'
+
+        out = ['# HELP serve_requests_total Requests answered, by route class and status.',
+               '# TYPE serve_requests_total counter']
+        for (revision, route, status), count in sorted(requests.items()):
+            out.append(f'serve_requests_total{{{labels(revision, route)},'
+                       f'code="{status}"}} {count}')
+        out += ['# HELP serve_response_bytes_total Body bytes sent, by route class.',
+                '# TYPE serve_response_bytes_total counter']
+        for revision in revisions:
+            for route in ROUTE_CLASSES:
+                out.append(f'serve_response_bytes_total{{{labels(revision, route)}}} '
+                           f'{sent.get((revision, route), 0)}')
+        out += ['# HELP serve_request_duration_seconds Request parsed to last body byte written.',
+                '# TYPE serve_request_duration_seconds histogram']
+        for revision in revisions:
+            for route in ROUTE_CLASSES:
+                key = revision, route
+                total = 0
+                for bound, count in zip(LATENCY_BUCKETS + (float('inf'),),
+                                        buckets.get(key, empty)):
+                    total += count
+                    le = '+Inf' if bound == float('inf') else repr(bound)
+                    out.append(f'serve_request_duration_seconds_bucket{{{labels(*key)},'
+                               f'le="{le}"}} {total}')
+                out.append(f'serve_request_duration_seconds_sum{{{labels(*key)}}} '
+                           f'{latency_sum.get(key, 0.0):.6f}')
+                out.append(f'serve_request_duration_seconds_count{{{labels(*key)}}} '
+                           f'{total}')
+        out += ['# HELP serve_connections_active Open client connections '
+                '(= busy handler threads on the threads engine).',
+                '# TYPE serve_connections_active gauge',
+                f'serve_connections_active{{pid="{pid}",engine="{ENGINE}"}} {active}',
+                '# HELP serve_connections_total Client connections accepted.',
+                '# TYPE serve_connections_total counter',
+                f'serve_connections_total{{pid="{pid}"}} {connections}',
+                '# HELP serve_threads Live threads in this process.',
+                '# TYPE serve_threads gauge',
+                f'serve_threads{{pid="{pid}"}} {threading.active_count()}',
+                '# HELP serve_shed_total Requests refused with 503 (queue full, media share used).',
+                '# TYPE serve_shed_total counter']
+        for reason in ('queue', 'media'):
+            out.append(f'serve_shed_total{{pid="{pid}",reason="{reason}"}} '
+                       f'{shed.get(reason, 0)}')
+        if self.pool is not None:
+            busy, waiting = self.pool.load()
+            out += ['# HELP serve_pool_busy Handler threads serving a connection.',
+                    '# TYPE serve_pool_busy gauge',
+                    f'serve_pool_busy{{pid="{pid}"}} {busy}',
+                    '# HELP serve_pool_waiting Accepted connections waiting for a thread.',
+                    '# TYPE serve_pool_waiting gauge',
+                    f'serve_pool_waiting{{pid="{pid}"}} {waiting}']
+        queue = self.accept_queue()
+        if queue is not None:
+            out += ['# HELP serve_accept_queue_depth Connections waiting in the listen backlog.',
+                    '# TYPE serve_accept_queue_depth gauge',
+                    f'serve_accept_queue_depth{{pid="{pid}"}} {queue[0]}',
+                    '# HELP serve_accept_queue_capacity Listen backlog size.',
+                    '# TYPE serve_accept_queue_capacity gauge',
+                    f'serve_accept_queue_capacity{{pid="{pid}"}} {queue[1]}']
+        indexes = ([(revision.name, revision.index) for revision in REVISIONS.values()]
+                   if REVISIONS else [('', artifact.INDEX)])
+        indexes = [(name, index) for name, index in indexes if index is not None]
+        if indexes:
+            out += ['# HELP serve_index_bytes Artifact bytes held by the startup index.',
+                    '# TYPE serve_index_bytes gauge']
+            for name, index in indexes:
+                tag = f',revision="{name}"' if name else ''
+                out += [f'serve_index_bytes{{pid="{pid}"{tag},tier="inline"}} {index.inline_bytes}',
+                        f'serve_index_bytes{{pid="{pid}"{tag},tier="mapped"}} {index.mapped_bytes}']
+        return ('\n'.join(out) + '\n').encode('utf-8')
+
+
+METRICS = Metrics() if os.environ.get('SERVE_METRICS', '0') != '0' else None
@@ -0,0 +1,101 @@
+"""Which representation of a URL a request gets: precompressed sidecars by
+Accept-Encoding, AVIF/WebP transcodes by Accept, and lite card videos by
+?media=, If-Range, Save-Data and the network client hints."""
+import os, re, urllib.parse
+
+# Sidecar suffix -> Content-Encoding, in server preference order.
+SIDECARS = (('.br', 'br'), ('.gz', 'gzip'))
+
+# package-public.py --media-variants writes name.lite.mp4 next to each
+# card mp4. It is sent instead when the visitor asks to save data
+# (Save-Data: on), the browser reports a slow effective connection (the
+# ECT / Downlink client hints HTML responses opt into with Accept-CH), or
+# the URL says ?media=lite (?media=full forces the original).
+MEDIA_EXTENSIONS = ('.mp4', '.webm', '.mov')
+LITE_SUFFIX = '.lite'
+MEDIA_HINTS = 'Save-Data, ECT, Downlink'
+ACCEPT_CH = b'Accept-CH: ECT, Downlink\r\n'
+LITE_ECT = ('slow-2g', '2g', '3g')
+LITE_DOWNLINK = 2.0   # Mbps; Chrome rounds Downlink to 25 kbps steps
+
+# package-public.py --image-variants writes name.png.avif / name.png.webp
+# next to large images, kept only where they are clearly smaller. The
+# first type the request's Accept names outright wins — browsers list the
+# formats they decode, and image/* or */* alone says nothing about them.
+IMAGE_FORMATS = (('.avif', 'image/avif'), ('.webp', 'image/webp'))
+
+
+def lite_path(path):
+    """name.mp4 -> name.lite.mp4; None for anything that is not media."""
+    root, ext = os.path.splitext(path)
+    if ext not in MEDIA_EXTENSIONS or root.endswith(LITE_SUFFIX):
+        return None
+    return root + LITE_SUFFIX + ext
+
+
+def accepted_codings(header):
+    """Accept-Encoding (or Accept) as {coding: q}; a malformed q counts as 0."""
+    weights = {}
+    for item in header.split(','):
+        coding, _, params = item.partition(';')
+        coding = coding.strip().lower()
+        if not coding:
+            continue
+        weight = 1.0
+        m = re.search(r'\bq\s*=\s*([0-9.]+)', params)
+        if m:
+            try:
+                weight = float(m.group(1))
+            except ValueError:
+                weight = 0.0
+        weights[coding] = weight
+    return weights
+
+
+def encoding_variant(entry, accept_encoding):
+    """The representation Accept-Encoding asks for: a precompressed
+    sidecar when one is accepted, else the identity file. Ranges never
+    get here — offsets always refer to the identity bytes."""
+    weights = accepted_codings(accept_encoding)
+    best, best_q = entry, 0.0
+    for _, coding in SIDECARS:
+        q = weights.get(coding, weights.get('*', 0.0))
+        if coding in entry.variants and q > best_q:
+            best, best_q = entry.variants[coding], q
+    return best
+
+
+def image_format(entry, accept):
+    """The first of `entry`'s AVIF/WebP transcodes that Accept names with
+    a non-zero q, else `entry` itself; like sidecars, ranges stay on the
+    original."""
+    weights = accepted_codings(accept)
+    for _, ctype in IMAGE_FORMATS:
+        if ctype in entry.formats and weights.get(ctype, 0.0) > 0:
+            return entry.formats[ctype]
+    return entry
+
+
+def media_variant(entry, url, headers):
+    """`entry` or its lite encoding. ?media= decides outright; a resumed
+    range stays on the encoding its If-Range validator names, since a
+    player must not splice byte offsets of one onto the other; then
+    Save-Data and the network hints."""
+    query = urllib.parse.parse_qs(urllib.parse.urlsplit(url).query)
+    choice = query.get('media', [''])[0]
+    if choice in ('lite', 'full'):
+        return entry.lite if choice == 'lite' else entry
+    cond = headers.get('If-Range', '').strip()
+    if cond and cond == entry.lite.etag:
+        return entry.lite
+    if cond and cond == entry.etag:
+        return entry
+    if headers.get('Save-Data', '').strip().lower() == 'on' \
+            or headers.get('ECT', '').strip().lower() in LITE_ECT:
+        return entry.lite
+    try:
+        if float(headers.get('Downlink', 'inf')) < LITE_DOWNLINK:
+            return entry.lite
+    except ValueError:
+        pass
+    return entry
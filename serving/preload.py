@@ -0,0 +1,136 @@
+"""Link: rel=modulepreload / rel=preload hints for an artifact's HTML pages,
+scanned once at startup (SERVE_PRELOAD)."""
+import json, os, re, urllib.parse
+
+from .config import PRELOAD_CHAPTERS, PRELOAD_HEADER_MAX
+
+# tools/package-public.py walks the same graph with copies of these three;
+# tools/test_package_public.py fails if they drift apart.
+IMPORT_RE = re.compile(
+    r"""(?:^|[;\s])(?:import|export)\s[^'"`;]*?from\s*['"]([^'"]+)['"]"""
+    r"""|(?:^|[;\s])import\s*['"]([^'"]+)['"]"""
+    r"""|\bimport\(\s*['"]([^'"]+)['"]\s*\)""",
+    re.M)
+COMMENT_RE = re.compile(r"/\*.*?\*/|^\s*//[^\n]*", re.S | re.M)
+JSON_LITERAL_RE = re.compile(r"""['"]([\w./-]+\.json)['"]""")
+
+
+def _import_map(source, page_url):
+    """A page's import map with its URL-like keys and every value resolved
+    against the page, as the browser holds it."""
+    m = re.search(r'<script type="importmap">(.*?)</script>', source, re.S)
+    try:
+        imports = json.loads(m.group(1)).get('imports', {}) if m else {}
+    except ValueError:
+        return {}
+    return {(urllib.parse.urljoin(page_url, key) if key.startswith(('.', '/')) else key):
+            urllib.parse.urljoin(page_url, value) for key, value in imports.items()}
+
+
+def _resolve_specifier(spec, base_url, imports):
+    """URL path (query kept) of an import specifier, None if external. A
+    relative specifier is resolved first and then looked up by URL (what a
+    package-public.py --fingerprint map keys on), a bare one by itself."""
+    if spec.startswith(('.', '/')):
+        spec = urllib.parse.urljoin(base_url, spec)
+    for key in sorted(imports, key=len, reverse=True):
+        if spec == key or (key.endswith('/') and spec.startswith(key)):
+            return imports[key] + spec[len(key):]
+    return spec if spec.startswith('/') else None
+
+
+def _page_preloads(root, page_url, source, index):
+    """Link header value for one HTML page: every module statically
+    reachable from its <script type="module"> entries (import() waits for
+    its caller), in breadth-first order and with ?v= tokens exactly as the
+    importing module wrote them, then the JSON the graph names (resolved
+    against the page, as fetch() does) — and for the geometry manifest the
+    PRELOAD_CHAPTERS bins, the baked.js contract (journey/lib/baked.js:33).
+    None if there is nothing."""
+    imports = _import_map(source, page_url)
+    todo = [urllib.parse.urljoin(page_url, src) for src in
+            re.findall(r'<script type="module" src="([^"]+)"', source)]
+    seen, modules, data = set(), [], []
+    while todo:
+        url = todo.pop(0)
+        if url in seen:
+            continue
+        seen.add(url)
+        code = _served_text(os.path.join(root, urllib.parse.urlsplit(url).path.lstrip('/')), index)
+        if code is None:
+            continue
+        modules.append(f'<{url}>; rel=modulepreload')
+        code = COMMENT_RE.sub(' ', code)
+        for groups in IMPORT_RE.findall(code):
+            if groups[2]:                # import(): not on the boot path
+                continue
+            target = _resolve_specifier(next(g for g in groups if g), url, imports)
+            if target:
+                todo.append(target)
+        for literal in JSON_LITERAL_RE.findall(code):
+            target = urllib.parse.urljoin(page_url, literal)
+            if target not in seen \
+                    and _served_text(os.path.join(root, target.lstrip('/')), index) is not None:
+                seen.add(target)
+                data.append(f'<{target}>; rel=preload; as=fetch; crossorigin')
+                if target.endswith('/static/geom/manifest.json'):
+                    data += _geometry_preloads(root, target, index)
+    kept, size = [], 0
+    for link in data + modules:
+        size += len(link) + 2
+        if size > PRELOAD_HEADER_MAX:
+            break
+        kept.append(link)
+    links = [link for link in modules + data if link in kept]
+    return ', '.join(links) or None
+
+
+def _geometry_preloads(root, manifest_url, index):
+    try:
+        chapters = json.loads(_served_text(os.path.join(root, manifest_url.lstrip('/')), index)
+                              or '{}').get('chapters', {})
+    except ValueError:
+        return []
+    base = manifest_url.rsplit('/', 1)[0] + '/'
+    return [f'<{base}{chapters[name]["file"]}>; rel=preload; as=fetch; crossorigin'
+            for name in PRELOAD_CHAPTERS if 'file' in chapters.get(name, {})]
+
+
+def _served_text(path, index):
+    """A served file's text — from the tree's index when it has one (a pack
+    has no tree on disk), else the filesystem; None if there is no such file."""
+    if index is not None:
+        entry = index.get(path)
+        if entry is None:
+            return None
+        return bytes(index.view(entry)).decode('utf-8', 'replace')
+    try:
+        with open(path, encoding='utf-8', errors='replace') as fh:
+            return fh.read()
+    except OSError:
+        return None
+
+
+def preload_hints(root, index):
+    """Filesystem path of each HTML page -> ready-made 'Link: ...' header
+    line, computed once at startup from the served tree (and its index)."""
+    if index is not None:
+        pages = sorted(path for path in index.entries if not path.endswith('/'))
+    else:
+        pages = []
+        for dirpath, dirnames, filenames in os.walk(root):
+            dirnames.sort()
+            pages += [os.path.join(dirpath, name) for name in filenames]
+    hints = {}
+    for path in pages:
+        if not path.endswith(('.html', '.htm')):
+            continue
+        rel = os.path.relpath(os.path.dirname(path), root).replace(os.sep, '/')
+        page_url = '/' if rel == '.' else f'/{rel}/'
+        links = _page_preloads(root, page_url, _served_text(path, index), index)
+        if links:
+            hints[path] = f'Link: {links}\r\n'.encode('latin-1')
+    return hints
+
+
+PRELOADS = {}  # HTML path -> Link header line, once main() scans (SERVE_PRELOAD)
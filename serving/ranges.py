@@ -0,0 +1,92 @@
+"""Range and conditional requests: the RFC 7233 range-set, If-Range, and
+the If-None-Match / If-Modified-Since test behind a 304."""
+import datetime, email.utils, re
+
+# A Range header with more specs than this is ignored (whole file, 200):
+# players ask for one or two, and each part costs a header and a syscall.
+# Ranges closer together than RANGE_GAP bytes are sent as one part.
+MAX_RANGES = 16
+RANGE_GAP = 80
+RANGE_SPEC = re.compile(r'\s*(\d*)\s*-\s*(\d*)\s*$')
+
+
+def byte_ranges(header, size):
+    """Satisfiable (start, end) spans of a Range header (RFC 7233 §2.1:
+    first-last, first-, and -suffix for the last N bytes — how a player
+    reads an mp4's trailing moov), sorted, with overlapping or
+    near-adjacent spans merged. [] means ignore the header and send the
+    whole file (not a bytes range-set, malformed, or more than
+    MAX_RANGES); None means nothing is satisfiable (416)."""
+    unit, _, range_set = header.partition('=')
+    if unit.strip().lower() != 'bytes':
+        return []
+    specs = [spec for spec in range_set.split(',') if spec.strip()]
+    if not specs or len(specs) > MAX_RANGES:
+        return []
+    spans = []
+    for spec in specs:
+        m = RANGE_SPEC.match(spec)
+        if not m or not (m.group(1) or m.group(2)):
+            return []
+        first, last = m.groups()
+        if not first:
+            suffix = int(last)
+            if suffix:
+                spans.append((max(0, size - suffix), size - 1))
+            continue
+        start = int(first)
+        if last and int(last) < start:
+            return []
+        if start < size:
+            spans.append((start, min(int(last), size - 1) if last else size - 1))
+    if not spans:
+        return None
+    spans.sort()
+    merged = [spans[0]]
+    for start, end in spans[1:]:
+        if start <= merged[-1][1] + RANGE_GAP:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def not_modified(entry, headers):
+    """If-None-Match (weak comparison, RFC 7232 §3.2) when present,
+    otherwise SimpleHTTPRequestHandler's If-Modified-Since test."""
+    inm = headers.get('If-None-Match')
+    if inm is not None:
+        if entry.etag is None:
+            return False
+        if inm.strip() == '*':
+            return True
+        ours = entry.etag.removeprefix('W/')
+        return any(tag.strip().removeprefix('W/') == ours
+                   for tag in inm.split(','))
+    if 'If-Modified-Since' not in headers:
+        return False
+    try:
+        ims = email.utils.parsedate_to_datetime(headers['If-Modified-Since'])
+    except (TypeError, IndexError, OverflowError, ValueError):
+        return False
+    if ims.tzinfo is None:
+        ims = ims.replace(tzinfo=datetime.timezone.utc)
+    if ims.tzinfo is not datetime.timezone.utc:
+        return False
+    modified = datetime.datetime.fromtimestamp(entry.mtime, datetime.timezone.utc)
+    return modified.replace(microsecond=0) <= ims
+
+
+def if_range_holds(entry, headers):
+    """False when If-Range names another version of the file: the client
+    then gets the whole current file (200), never a slice of it to splice
+    onto bytes from the old one. An entity-tag must match strongly; a date
+    must equal Last-Modified exactly."""
+    cond = headers.get('If-Range')
+    if cond is None:
+        return True
+    cond = cond.strip()
+    if cond.startswith(('"', 'W/')):
+        return (entry.etag is not None and not entry.etag.startswith('W/')
+                and cond == entry.etag)
+    return cond == entry.modified
@@ -0,0 +1,343 @@
+"""The dev watcher: changed files under the checkout, fanned out to the
+SERVE_CACHING=dev stat cache and to SERVE_LIVERELOAD pages."""
+import json, os, re, struct, threading, time
+
+from .config import CACHING, LIVERELOAD, LIVERELOAD_DEBOUNCE, LIVERELOAD_PATH, WATCH, WATCH_POLL
+from .files import stat_etag
+
+IN_MODIFY, IN_ATTRIB, IN_MOVED_FROM, IN_MOVED_TO = 0x2, 0x4, 0x40, 0x80
+IN_CREATE, IN_DELETE, IN_DELETE_SELF, IN_MOVE_SELF = 0x100, 0x200, 0x400, 0x800
+IN_Q_OVERFLOW, IN_IGNORED, IN_ISDIR = 0x4000, 0x8000, 0x40000000
+WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE
+              | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF)
+# Never walked, wherever they turn up: an npm install alone is tens of
+# thousands of directories (inotify watches, or stats per poll).
+UNWATCHED = frozenset(('node_modules', '__pycache__'))
+ALLOWLIST = os.path.join('deploy', 'public-files.json')
+
+
+def served_tops(root):
+    """The top-level directories the allowlist ships ('vendor' for
+    'vendor/three'), or None where there is no allowlist — an artifact,
+    every directory of which is served."""
+    try:
+        with open(os.path.join(root, ALLOWLIST), encoding='utf-8') as fh:
+            trees = json.load(fh)['trees']
+        return frozenset(tree['path'].split('/', 1)[0] for tree in trees)
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+
+
+class TreeWatcher:
+    """Reports changed files under `root` to its subscribers, each called
+    (from the watcher thread) with a set of paths, or None when changes
+    were lost and anything may have moved. Only what can be served is
+    walked: in a checkout, the root's files and the top-level directories
+    deploy/public-files.json ships; never dot-directories or UNWATCHED.
+
+    inotify (Linux, via libc) watches every directory and reports a change
+    as it happens. Elsewhere — or with SERVE_WATCH=poll — the tree is
+    scanned once, then every WATCH_POLL seconds the known files and
+    directories are re-stat'ed and only directories whose mtime moved are
+    listed again, so a large tree costs one stat per entry per poll.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self.subscribers = []
+        self.watched = set()                 # directories being covered
+        self._dirs = {}                      # inotify wd -> directory
+        self._tops = served_tops(root)
+        if WATCH == 'inotify' and self._start_inotify():
+            self.mode = 'inotify'
+        else:
+            self.mode = 'polling'
+            self._files = {}                 # path -> stat_etag
+            self._dir_mtimes = {}
+            self._scan(root, set())
+            threading.Thread(target=self._poll, daemon=True).start()
+
+    def subscribe(self, callback):
+        self.subscribers.append(callback)
+
+    def _notify(self, paths):
+        for callback in self.subscribers:
+            callback(paths)
+
+    def _start_inotify(self):
+        try:
+            import ctypes, ctypes.util
+            libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+            fd = libc.inotify_init1(os.O_CLOEXEC)
+        except (ImportError, OSError, AttributeError, TypeError):
+            return False
+        if fd < 0:
+            return False
+        self._libc, self._fd = libc, fd
+        try:
+            self._watch_tree(self.root)
+        except OSError:                      # out of watches: poll instead
+            os.close(fd)
+            self._dirs.clear()
+            self.watched.clear()
+            return False
+        threading.Thread(target=self._read_events, daemon=True).start()
+        return True
+
+    def _watch_tree(self, top):
+        for dirpath, dirnames, _ in os.walk(top):
+            dirnames[:] = [d for d in dirnames if not self._skipped(dirpath, d)]
+            wd = self._libc.inotify_add_watch(self._fd, os.fsencode(dirpath), WATCH_MASK)
+            if wd < 0:
+                raise OSError(f'inotify_add_watch failed for {dirpath}')
+            self._dirs[wd] = dirpath
+            self.watched.add(dirpath)
+
+    def _skipped(self, dirpath, name):
+        return (name.startswith('.') or name in UNWATCHED
+                or self._tops is not None and dirpath == self.root
+                and name not in self._tops)
+
+    def _read_events(self):
+        while True:
+            try:
+                buf = os.read(self._fd, 65536)
+            except OSError:
+                return
+            changed, lost = set(), False
+            offset = 0
+            while offset < len(buf):
+                wd, mask, _, length = struct.unpack_from('iIII', buf, offset)
+                name = os.fsdecode(buf[offset + 16:offset + 16 + length].rstrip(b'\0'))
+                offset += 16 + length
+                dirpath = self._dirs.get(wd)
+                if mask & IN_IGNORED:
+                    self._dirs.pop(wd, None)
+                    self.watched.discard(dirpath)
+                elif mask & (IN_Q_OVERFLOW | IN_ISDIR | IN_DELETE_SELF | IN_MOVE_SELF):
+                    # A directory came, went or moved (or events were lost):
+                    # rare enough to report as "anything may have changed".
+                    if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO) \
+                            and dirpath is not None and not self._skipped(dirpath, name):
+                        try:
+                            self._watch_tree(os.path.join(dirpath, name))
+                        except OSError:
+                            pass
+                    lost = True
+                elif dirpath is not None:
+                    changed.add(os.path.join(dirpath, name))
+            if lost:
+                self._notify(None)
+            elif changed:
+                self._notify(changed)
+
+    def _scan(self, top, changed):
+        """Record every file under `top`; new ones are added to `changed`."""
+        for dirpath, dirnames, filenames in os.walk(top):
+            dirnames[:] = [d for d in dirnames if not self._skipped(dirpath, d)]
+            self._list_dir(dirpath, filenames, changed)
+
+    def _list_dir(self, dirpath, filenames, changed):
+        try:
+            self._dir_mtimes[dirpath] = os.stat(dirpath).st_mtime_ns
+        except OSError:
+            return
+        self.watched.add(dirpath)
+        for name in filenames:
+            path = os.path.join(dirpath, name)
+            try:
+                etag = stat_etag(os.stat(path))
+            except OSError:
+                continue
+            if self._files.get(path) != etag:
+                self._files[path] = etag
+                changed.add(path)
+
+    def _poll(self):
+        while True:
+            time.sleep(WATCH_POLL)
+            changed = set()
+            for dirpath, mtime in list(self._dir_mtimes.items()):
+                try:
+                    moved = os.stat(dirpath).st_mtime_ns != mtime
+                except OSError:
+                    moved = True
+                if not moved:
+                    continue
+                # Entries came or went: forget the directory's files and
+                # list it again (new subdirectories are scanned whole).
+                gone = {p for p in self._files if os.path.dirname(p) == dirpath}
+                self._dir_mtimes.pop(dirpath)
+                self.watched.discard(dirpath)
+                try:
+                    names = os.listdir(dirpath)
+                except OSError:
+                    names = None
+                if names is None:
+                    for path in gone:
+                        del self._files[path]
+                    changed |= gone
+                    continue
+                files = [n for n in names if os.path.isfile(os.path.join(dirpath, n))]
+                for path in gone - {os.path.join(dirpath, n) for n in files}:
+                    del self._files[path]
+                    changed.add(path)
+                self._list_dir(dirpath, files, changed)
+                for name in names:
+                    sub = os.path.join(dirpath, name)
+                    if not self._skipped(dirpath, name) and sub not in self._dir_mtimes \
+                            and os.path.isdir(sub):
+                        self._scan(sub, changed)
+            for path, etag in list(self._files.items()):
+                try:
+                    now = stat_etag(os.stat(path))
+                except OSError:
+                    continue                 # its directory's mtime says so
+                if now != etag:
+                    self._files[path] = now
+                    changed.add(path)
+            if changed:
+                self._notify(changed)
+
+
+class StatCache:
+    """Request path -> ServedFile for SERVE_CACHING=dev, so revalidating an
+    unchanged module touches neither the disk nor the hash of anything.
+    Entries are dropped as the TreeWatcher reports their files changed; a
+    lookup that raced an invalidation is not stored (the generation moved
+    on), and files outside the watched directories are never stored."""
+
+    def __init__(self, watcher):
+        self.watcher = watcher
+        self.entries = {}
+        self.generation = 0
+        self._lock = threading.Lock()
+        watcher.subscribe(self._changed)
+
+    def get(self, key):
+        return self.entries.get(key)
+
+    def put(self, key, entry, generation):
+        if os.path.dirname(entry.path) not in self.watcher.watched:
+            return                           # a directory nobody watches
+        with self._lock:
+            if generation == self.generation:
+                self.entries[key] = entry
+
+    def _changed(self, paths):
+        with self._lock:
+            self.generation += 1
+            if paths is None:
+                self.entries.clear()
+                return
+            for path in paths:
+                self.entries.pop(path, None)
+                # a directory URL is stored under its trailing-slash key
+                self.entries.pop(os.path.dirname(path) + '/', None)
+
+
+# Editor droppings that are never served: vim's swap files and 4913 probe,
+# emacs locks and backups, atomic-save temporaries.
+EDITOR_TEMP = re.compile(r'(^\.#|~$|\.sw[a-p]$|^4913$|\.tmp$)')
+
+# Injected right after <head>: reloads the page when a URL it loaded (the
+# document, a module, a fetch, an image — resource timing) changes, and
+# swaps a changed <link rel=stylesheet> in place instead.
+LIVERELOAD_CLIENT = b"""<script>/* serve.py SERVE_LIVERELOAD */(() => {
+performance.setResourceTimingBufferSize(4096);
+const here = p => new URL(p, location.href).pathname;
+new EventSource('%s').addEventListener('change', (e) => {
+  const changed = new Set(JSON.parse(e.data));
+  const doc = here(location.pathname.endsWith('/') ? location.pathname + 'index.html' : location.pathname);
+  const used = new Set(performance.getEntriesByType('resource').map(r => here(r.name)));
+  const hit = [...changed].filter(u => u === '*' || u === doc || used.has(u));
+  if (!hit.length) return;
+  const sheets = [...document.querySelectorAll('link[rel~=stylesheet]')];
+  if (hit.every(u => sheets.some(l => here(l.href) === u))) {
+    for (const l of sheets) if (changed.has(here(l.href))) {
+      const u = new URL(l.href); u.searchParams.set('livereload', Date.now()); l.href = u.href;
+    }
+  } else location.reload();
+});
+})();</script>
+""" % LIVERELOAD_PATH.encode()
+
+
+class LiveReload:
+    """Server-Sent Events fan-out of changed URLs (SERVE_LIVERELOAD=1).
+
+    TreeWatcher reports collect in `pending`; once the tree has been quiet
+    for LIVERELOAD_DEBOUNCE (one editor save is a write, a rename and a
+    chmod) the batch goes to every open page as a single `change` event
+    whose data is the JSON list of URLs ('*' when changes were lost).
+    Clients are callables taking the encoded event; each connection adds
+    its own and removes it when the page goes away."""
+
+    def __init__(self, watcher):
+        self.root = watcher.root
+        self.clients = set()
+        self._pending = set()
+        self._last = 0.0
+        self._cond = threading.Condition()
+        watcher.subscribe(self._changed)
+        threading.Thread(target=self._flush, daemon=True).start()
+
+    def add(self, deliver):
+        with self._cond:
+            self.clients.add(deliver)
+
+    def discard(self, deliver):
+        with self._cond:
+            self.clients.discard(deliver)
+
+    def _changed(self, paths):
+        with self._cond:
+            self._pending.update(paths if paths is not None else ('*',))
+            self._last = time.monotonic()
+            self._cond.notify()
+
+    def _flush(self):
+        while True:
+            with self._cond:
+                while not self._pending:
+                    self._cond.wait()
+                while True:
+                    quiet = self._last + LIVERELOAD_DEBOUNCE - time.monotonic()
+                    if quiet <= 0:
+                        break
+                    self._cond.wait(quiet)
+                batch, self._pending = self._pending, set()
+                clients = list(self.clients)
+            urls = sorted('*' if path == '*' else
+                          '/' + os.path.relpath(path, self.root).replace(os.sep, '/')
+                          for path in batch
+                          if not EDITOR_TEMP.search(os.path.basename(path)))
+            if not urls:
+                continue
+            event = f'event: change\ndata: {json.dumps(urls)}\n\n'.encode()
+            for deliver in clients:
+                try:
+                    deliver(event)
+                except RuntimeError:         # its event loop has closed
+                    self.discard(deliver)
+
+
+STAT_CACHE = None  # StatCache in each serving process (SERVE_CACHING=dev)
+LIVE = None        # LiveReload in each serving process (SERVE_LIVERELOAD)
+WATCHER = None     # the TreeWatcher both of them subscribe to
+
+
+def start_watching(indexed):
+    """The TreeWatcher and what hangs off it, when a mode needs them (the
+    stat cache only for a tree without a startup index — `indexed`);
+    True if one was started."""
+    global WATCHER, STAT_CACHE, LIVE
+    want_stats = CACHING == 'dev' and not indexed
+    if not (want_stats or LIVERELOAD):
+        return False
+    WATCHER = TreeWatcher(os.getcwd())
+    if want_stats:
+        STAT_CACHE = StatCache(WATCHER)
+    if LIVERELOAD:
+        LIVE = LiveReload(WATCHER)
+    return True
@@ -0,0 +1,808 @@
+#!/usr/bin/env python3
+"""bench-serve.py — replay a journey page load against serve.py and time it.
+
+NOT shipped: nothing imports it. Each scenario starts its own serve.py on a
+free port (never the :8137 dev server), replays the same request list, and
+prints one row per server configuration.
+
+The replayed page load is computed from the tree being served, the way the
+browser discovers it: index.html's stylesheets and module entry, the static
+ES-module graph behind main.js (import map resolved, ?v= tokens kept), the
+geometry manifest plus every chapter bin it names, and a Range request for
+every card preview mp4. Requests go out over a pool of six connections per
+host, like Chrome's HTTP/1.1 loader.
+
+    python3 tools/bench-serve.py keepalive          # HTTP/1.0 vs keep-alive
+    python3 tools/bench-serve.py engines            # threads vs asyncio load
+    python3 tools/bench-serve.py sendfile           # copy loop vs sendfile(2)
+    python3 tools/bench-serve.py cache              # filesystem vs startup index
+    python3 tools/bench-serve.py workers            # req/s for --workers 1..N
+    python3 tools/bench-serve.py admission          # page boot under a video burst
+    python3 tools/bench-serve.py preload            # discovery waterfall vs Link hints
+    python3 tools/bench-serve.py devcache           # dev reload: no-store vs 304s
+    python3 tools/bench-serve.py livereload         # save -> push latency, watcher cost
+    python3 tools/bench-serve.py pack               # cold start: tree vs --pack
+    python3 tools/bench-serve.py accesslog          # req/s with the access log on
+    python3 tools/bench-serve.py revisions --candidate /tmp/public-b   # A/B, one server
+    python3 tools/bench-serve.py keepalive --root /tmp/public --runs 5
+"""
+import argparse
+import asyncio
+import http.client
+import json
+import multiprocessing
+import os
+import queue
+import re
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+POOL = 6            # Chrome's per-host HTTP/1.1 connection limit
+
+IMPORT_RE = re.compile(
+    r"""(?:^|[;\s])(?:import|export)\s[^'"`;]*?from\s*['"]([^'"]+)['"]"""
+    r"""|(?:^|[;\s])import\s*['"]([^'"]+)['"]"""
+    r"""|\bimport\(\s*['"]([^'"]+)['"]\s*\)""",
+    re.M)
+COMMENT_RE = re.compile(r"/\*.*?\*/|^\s*//[^\n]*", re.S | re.M)
+FINGERPRINT_RE = re.compile(r"\.[0-9a-f]{12}\.")   # package-public.py --fingerprint
+
+
+def free_port():
+    s = socket.socket()
+    s.bind(("127.0.0.1", 0))
+    p = s.getsockname()[1]
+    s.close()
+    return p
+
+
+# ---- the replayed page load ----------------------------------------------
+
+def import_map(index_html):
+    """index.html's import map, URL-like keys and all values resolved."""
+    m = re.search(r'<script type="importmap">(.*?)</script>', index_html, re.S)
+    imports = json.loads(m.group(1)).get("imports", {}) if m else {}
+    return {(urllib.parse.urljoin("/", key) if key.startswith((".", "/")) else key):
+            urllib.parse.urljoin("/", value) for key, value in imports.items()}
+
+
+def resolve(spec, base_url, imports):
+    """URL path (with query) of an import specifier, or None if external;
+    mapped as serve.py's preload scan maps it."""
+    if spec.startswith((".", "/")):
+        spec = urllib.parse.urljoin(base_url, spec)
+    for key in sorted(imports, key=len, reverse=True):
+        if spec == key or (key.endswith("/") and spec.startswith(key)):
+            return imports[key] + spec[len(key):]
+    return spec if spec.startswith("/") else None
+
+
+def module_graph(root, entry, imports):
+    """Every module URL statically reachable from entry, in discovery order."""
+    seen, order, todo = set(), [], [entry]
+    while todo:
+        url = todo.pop(0)
+        if url in seen:
+            continue
+        seen.add(url)
+        path = os.path.join(root, urllib.parse.urlsplit(url).path.lstrip("/"))
+        if not os.path.isfile(path):
+            continue
+        order.append(url)
+        with open(path, encoding="utf-8", errors="replace") as fh:
+            source = COMMENT_RE.sub(" ", fh.read())
+        for groups in IMPORT_RE.findall(source):
+            spec = next(g for g in groups if g)
+            target = resolve(spec, url, imports)
+            if target:
+                todo.append(target)
+    return order
+
+
+def page_load(root):
+    """[(path, range header or None)] in roughly the order Chrome asks."""
+    with open(os.path.join(root, "index.html"), encoding="utf-8") as fh:
+        index = fh.read()
+    imports = import_map(index)
+    requests = [("/index.html", None)]
+    for href in re.findall(r'<link rel="stylesheet" href="([^"]+)"', index):
+        requests.append((urllib.parse.urljoin("/", href), None))
+    for src in re.findall(r'<script type="module" src="([^"]+)"', index):
+        for url in module_graph(root, urllib.parse.urljoin("/", src), imports):
+            requests.append((url, None))
+    manifest = os.path.join(root, "static", "geom", "manifest.json")
+    if os.path.isfile(manifest):
+        requests.append(("/static/geom/manifest.json", None))
+        with open(manifest, encoding="utf-8") as fh:
+            for chapter in json.load(fh).get("chapters", {}).values():
+                requests.append(("/static/geom/" + chapter["file"], None))
+    cards = os.path.join(root, "assets", "cards")
+    for dirpath, _, files in sorted(os.walk(cards)):
+        for name in sorted(files):
+            if name.endswith(".mp4") and not FINGERPRINT_RE.search(name):
+                rel = os.path.relpath(os.path.join(dirpath, name), root)
+                requests.append(("/" + rel.replace(os.sep, "/"), "bytes=0-"))
+    return requests
+
+
+# ---- server under test ----------------------------------------------------
+
+class Server:
+    """serve.py from `root` on a private port, with env overrides."""
+
+    def __init__(self, root, env=None, args=()):
+        self.root = root
+        self.port = free_port()
+        server_env = dict(os.environ, PORT=str(self.port), **(env or {}))
+        self.proc = subprocess.Popen(
+            [sys.executable, os.path.join(root, "serve.py"), *args],
+            env=server_env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        deadline = time.monotonic() + 10
+        while time.monotonic() < deadline:
+            try:
+                socket.create_connection(("127.0.0.1", self.port), 0.2).close()
+                return
+            except OSError:
+                if self.proc.poll() is not None:
+                    break
+                time.sleep(0.05)
+        self.close()
+        raise RuntimeError("serve.py did not come up: "
+                           + self.proc.stderr.read().decode(errors="replace"))
+
+    def close(self):
+        if self.proc.poll() is None:
+            self.proc.terminate()
+            try:
+                self.proc.wait(5)
+            except subprocess.TimeoutExpired:
+                self.proc.kill()
+                self.proc.wait()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+# ---- client ---------------------------------------------------------------
+
+class CountingConnection(http.client.HTTPConnection):
+    opened = 0
+    lock = threading.Lock()
+
+    def connect(self):
+        with CountingConnection.lock:
+            CountingConnection.opened += 1
+        super().connect()
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+
+def replay(port, requests, pool=POOL, headers=None):
+    """Fetch every request — (path, range) or (path, range, headers) — over
+    `pool` connections; returns (connections opened, wall seconds to last
+    byte, bytes, per-request s)."""
+    CountingConnection.opened = 0
+    work = queue.Queue()
+    for item in requests:
+        work.put(item)
+    latencies, received, errors = [], [0], []
+    lock = threading.Lock()
+
+    def worker():
+        conn = None
+        while True:
+            try:
+                path, byte_range, *extra = work.get_nowait()
+            except queue.Empty:
+                break
+            if conn is None:
+                conn = CountingConnection("127.0.0.1", port, timeout=30)
+            sent = dict(headers or {}, **(extra[0] if extra else {}))
+            if byte_range:
+                sent["Range"] = byte_range
+            t0 = time.perf_counter()
+            try:
+                conn.request("GET", path, headers=sent)
+                resp = conn.getresponse()
+                body = resp.read()
+            except (OSError, http.client.HTTPException) as error:
+                errors.append(f"{path}: {error}")
+                conn.close()
+                conn = None
+                continue
+            dt = time.perf_counter() - t0
+            with lock:
+                latencies.append(dt)
+                received[0] += len(body)
+            if resp.status >= 400:
+                errors.append(f"{path}: HTTP {resp.status}")
+            if resp.will_close:
+                conn.close()
+                conn = None
+        if conn is not None:
+            conn.close()
+
+    t0 = time.perf_counter()
+    threads = [threading.Thread(target=worker) for _ in range(pool)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    wall = time.perf_counter() - t0
+    if errors:
+        raise RuntimeError("replay failed: " + "; ".join(errors[:5]))
+    return CountingConnection.opened, wall, received[0], latencies
+
+
+def percentile(values, q):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def report(label, rows):
+    """rows: [(opened, wall, bytes, latencies)] across runs."""
+    walls = [r[1] for r in rows]
+    lat = [x for r in rows for x in r[3]]
+    print(f"  {label:<22} conns {rows[0][0]:>4}   "
+          f"TTLB median {statistics.median(walls) * 1000:8.1f} ms   "
+          f"req p50 {percentile(lat, 0.5) * 1000:6.2f} ms   "
+          f"p95 {percentile(lat, 0.95) * 1000:6.2f} ms   "
+          f"{rows[0][2] / 1e6:6.2f} MB")
+
+
+class ProcSampler:
+    """Peak thread count and RSS of a process, sampled from /proc (Linux)."""
+
+    def __init__(self, pid, interval=0.05):
+        self.path = f"/proc/{pid}/status"
+        self.threads = self.rss_kb = 0
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                with open(self.path) as fh:
+                    for line in fh:
+                        if line.startswith("Threads:"):
+                            self.threads = max(self.threads, int(line.split()[1]))
+                        elif line.startswith("VmRSS:"):
+                            self.rss_kb = max(self.rss_kb, int(line.split()[1]))
+            except OSError:
+                return
+            self._stop.wait(self.interval)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+
+
+async def hammer(port, path, clients, seconds, ramp=2.0):
+    """`clients` kept-alive connections all opened first (the unfurl spike),
+    then each issues back-to-back GETs of `path` for `seconds`.
+    Returns (completed requests, failed connections, latencies)."""
+    latencies, failures = [], [0]
+    start = asyncio.Event()
+    request = (f"GET {path} HTTP/1.1\r\nHost: 127.0.0.1\r\n\r\n").encode()
+
+    async def client():
+        try:
+            reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        except OSError:
+            failures[0] += 1
+            return
+        try:
+            await start.wait()
+            deadline = time.perf_counter() + seconds
+            while time.perf_counter() < deadline:
+                t0 = time.perf_counter()
+                writer.write(request)
+                head = await reader.readuntil(b"\r\n\r\n")
+                length = int(re.search(rb"(?i)content-length:\s*(\d+)", head).group(1))
+                await reader.readexactly(length)
+                latencies.append(time.perf_counter() - t0)
+        except (OSError, asyncio.IncompleteReadError, AttributeError):
+            failures[0] += 1
+        finally:
+            writer.close()
+
+    tasks = [asyncio.create_task(client()) for _ in range(clients)]
+    await asyncio.sleep(ramp)                     # let every socket connect
+    start.set()
+    await asyncio.gather(*tasks)
+    return len(latencies), failures[0], latencies
+
+
+def raise_fd_limit():
+    try:
+        import resource
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    except (ImportError, ValueError, OSError):
+        pass
+
+
+# ---- scenarios ------------------------------------------------------------
+
+def bench_keepalive(args):
+    requests = page_load(args.root)
+    print(f"page load: {len(requests)} requests from {args.root}")
+    for label, env in (("HTTP/1.0 (no reuse)", {"SERVE_KEEPALIVE": "0"}),
+                       ("HTTP/1.1 keep-alive", {"SERVE_KEEPALIVE": "1"})):
+        with Server(args.root, env) as server:
+            replay(server.port, requests)          # warm the page cache
+            report(label, [replay(server.port, requests)
+                           for _ in range(args.runs)])
+
+
+def bench_engines(args):
+    """Same spike against both engines: N idle-then-busy keep-alive sockets
+    hitting one small module. The server is pinned to one core (taskset)
+    when available so the comparison is per-core, and the threads engine's
+    pool is sized to the client count so neither engine sheds."""
+    raise_fd_limit()
+    path = "/journey/lib/ease.js"
+    print(f"load: GET {path}, {args.seconds:g}s per level, server on one core")
+    for clients in args.clients:
+        for engine in ("threads", "asyncio"):
+            env = {"SERVE_ENGINE": engine, "SERVE_THREADS": str(clients)}
+            with Server(args.root, env) as server:
+                pin_to_core(server.proc.pid)
+                with ProcSampler(server.proc.pid) as sampler:
+                    done, failed, lat = asyncio.run(
+                        hammer(server.port, path, clients, args.seconds))
+            p99 = percentile(lat, 0.99) * 1000 if lat else float("nan")
+            print(f"  {engine:<8} {clients:>5} conns   {done / args.seconds:8.0f} req/s   "
+                  f"p99 {p99:7.1f} ms   failed {failed:>4}   "
+                  f"threads {sampler.threads:>5}   peak RSS {sampler.rss_kb / 1024:6.1f} MB")
+
+
+def cpu_seconds(pid):
+    """utime + stime of a process from /proc/<pid>/stat (Linux)."""
+    with open(f"/proc/{pid}/stat") as fh:
+        fields = fh.read().rsplit(")", 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+
+def artifact(args):
+    """The tree to serve: --root as given, or a fresh package-public.py
+    artifact when --root is the checkout (the production layout)."""
+    if args.root != ROOT:
+        return args.root
+    args.tmp = tempfile.TemporaryDirectory(prefix="bench-serve.")
+    public = os.path.join(args.tmp.name, "public")
+    subprocess.run([sys.executable, os.path.join(ROOT, "tools", "package-public.py"),
+                    public, "--origin", "http://localhost", "--revision", "bench"],
+                   check=True, stdout=subprocess.DEVNULL)
+    return public
+
+
+def largest_files(root, n):
+    sized = []
+    for dirpath, _, files in os.walk(root):
+        for name in files:
+            if FINGERPRINT_RE.search(name):
+                continue                 # --fingerprint's second name for a file
+            path = os.path.join(dirpath, name)
+            sized.append((os.path.getsize(path), path))
+    return [(size, "/" + os.path.relpath(path, root).replace(os.sep, "/"))
+            for size, path in sorted(sized, reverse=True)[:n]]
+
+
+def bench_sendfile(args):
+    """Full (200) and half-file (206) downloads of the artifact's largest
+    files, buffered copy loop vs sendfile(2). Server CPU is read from /proc
+    around the timed runs, so it excludes startup."""
+    root = artifact(args)
+    files = largest_files(root, args.files)
+    for size, path in files:
+        print(f"  {size / 1e6:6.2f} MB  {path}")
+    for engine in ("threads", "asyncio"):
+        for label, env in (("copy loop", {"SERVE_SENDFILE": "0"}),
+                           ("sendfile", {"SERVE_SENDFILE": "1"})):
+            env["SERVE_ENGINE"] = engine
+            with Server(root, env) as server:
+                for kind in ("200", "206"):
+                    requests = [(path, None if kind == "200" else f"bytes={size // 2}-")
+                                for size, path in files] * args.repeat
+                    replay(server.port, requests)      # warm the page cache
+                    cpu0 = cpu_seconds(server.proc.pid)
+                    rows = [replay(server.port, requests) for _ in range(args.runs)]
+                    cpu = cpu_seconds(server.proc.pid) - cpu0
+                    moved = sum(r[2] for r in rows)
+                    wall = sum(r[1] for r in rows)
+                    print(f"  {engine:<8} {label:<10} {kind}   "
+                          f"{moved / wall / 1e6:8.1f} MB/s   "
+                          f"server CPU {cpu * 1000 / (moved / 1e6):6.2f} ms/MB "
+                          f"({cpu / wall * 100:5.1f}% of a core)")
+
+
+def bench_cache(args):
+    """The replayed page load against a public artifact, answered from the
+    filesystem per request vs from serve.py's startup index."""
+    root = artifact(args)
+    requests = page_load(root)
+    print(f"page load: {len(requests)} requests from {root}")
+    for label, env in (("filesystem", {"SERVE_CACHE": "0"}),
+                       ("startup index", {"SERVE_CACHE": "1"})):
+        with Server(root, env) as server:
+            replay(server.port, requests)
+            cpu0 = cpu_seconds(server.proc.pid)
+            rows = [replay(server.port, requests) for _ in range(args.runs)]
+            cpu = cpu_seconds(server.proc.pid) - cpu0
+            report(label, rows)
+            print(f"  {'':<22} server CPU {cpu * 1000 / args.runs:6.1f} ms per page load")
+
+
+def bench_pack(args):
+    """Cold start of the Railway path: package-public.py as a directory tree
+    vs --pack, then serve.py's boot (startup index vs one mmap) and the
+    first and a warm page load."""
+    tmp = tempfile.TemporaryDirectory(prefix="bench-serve.")
+    for label, extra in (("tree + index", []), ("pack", ["--pack"])):
+        rows = []
+        for run in range(args.runs):
+            public = os.path.join(tmp.name, f"{label.split()[0]}-{run}")
+            t0 = time.perf_counter()
+            subprocess.run([sys.executable, os.path.join(ROOT, "tools", "package-public.py"),
+                            public, "--origin", "http://localhost", "--revision", "bench",
+                            *extra], check=True, stdout=subprocess.DEVNULL)
+            package = time.perf_counter() - t0
+            requests = page_load(os.path.join(tmp.name, f"tree-{run}"))
+            t0 = time.perf_counter()
+            with Server(public) as server:
+                boot = time.perf_counter() - t0
+                first = replay(server.port, requests)[1]
+                warm = replay(server.port, requests)[1]
+            rows.append((package, boot, first, warm))
+        package, boot, first, warm = (statistics.median(column) for column in zip(*rows))
+        print(f"  {label:<14} package {package * 1000:7.0f} ms   boot {boot * 1000:6.0f} ms"
+              f"   first load {first * 1000:6.1f} ms   warm {warm * 1000:6.1f} ms")
+
+
+def bench_accesslog(args):
+    """The engines spike (one small module, server on one core) with
+    SERVE_ACCESS_LOG off, on at full rate and sampled, for --engine."""
+    raise_fd_limit()
+    path = "/journey/lib/ease.js"
+    clients = args.clients[0]
+    log = tempfile.TemporaryDirectory(prefix="bench-serve.")
+    print(f"load: GET {path}, {args.seconds:g}s, {clients} conns, {args.engine}, one core")
+    for label, env in (("off", {}),
+                       ("file", {"SERVE_ACCESS_LOG": os.path.join(log.name, "a.log")}),
+                       ("file, 10% sample", {"SERVE_ACCESS_LOG": os.path.join(log.name, "b.log"),
+                                             "SERVE_ACCESS_LOG_SAMPLE": "0.1"})):
+        env.update(SERVE_ENGINE=args.engine, SERVE_THREADS=str(clients))
+        with Server(args.root, env) as server:
+            pin_to_core(server.proc.pid)
+            done, failed, lat = asyncio.run(hammer(server.port, path, clients, args.seconds))
+        written = os.path.getsize(env["SERVE_ACCESS_LOG"]) if "SERVE_ACCESS_LOG" in env else 0
+        print(f"  {label:<18} {done / args.seconds:8.0f} req/s   "
+              f"p99 {percentile(lat, 0.99) * 1000:7.1f} ms   failed {failed:>4}   "
+              f"log {written / 1e6:6.1f} MB")
+
+
+def bench_revisions(args):
+    """A/B in one serve.py: the artifact as the default revision and
+    --candidate (default: the same checkout packaged with --pack) mounted
+    under SERVE_REVISIONS, replayed alternately by X-Serve-Revision so both
+    see the same process, page cache and CPU; then each revision's
+    request and byte counters from /__metrics."""
+    root = artifact(args)
+    candidate = args.candidate
+    if candidate is None:
+        tmp = tempfile.TemporaryDirectory(prefix="bench-serve.")
+        candidate = os.path.join(tmp.name, "candidate")
+        subprocess.run([sys.executable, os.path.join(ROOT, "tools", "package-public.py"),
+                        candidate, "--origin", "http://localhost", "--revision", "bench",
+                        "--pack"], check=True, stdout=subprocess.DEVNULL)
+    env = {"SERVE_REVISIONS": f"candidate={os.path.abspath(candidate)}", "SERVE_METRICS": "1"}
+    with Server(root, env) as server:
+        loads = {name: [(path, byte_range, {"X-Serve-Revision": name})
+                        for path, byte_range in page_load(root)]
+                 for name in ("default", "candidate")}
+        rows = {name: [] for name in loads}
+        for name, requests in loads.items():
+            replay(server.port, requests)
+        for _ in range(args.runs):
+            for name, requests in loads.items():
+                rows[name].append(replay(server.port, requests))
+        for name in loads:
+            report(name, rows[name])
+        conn = http.client.HTTPConnection("127.0.0.1", server.port, timeout=10)
+        conn.request("GET", "/__metrics")
+        metrics = conn.getresponse().read().decode()
+        conn.close()
+    for name in loads:
+        sent = sum(float(line.rsplit(" ", 1)[1]) for line in metrics.splitlines()
+                   if line.startswith("serve_response_bytes_total")
+                   and f'revision="{name}"' in line)
+        print(f"  {name:<22} /__metrics: {sent / 1e6:8.2f} MB sent")
+
+
+def _hammer_process(port, path, clients, seconds, results):
+    done, failed, _ = asyncio.run(hammer(port, path, clients, seconds))
+    results.put((done, failed))
+
+
+def bench_workers(args):
+    """Requests/second against --workers 1..N. The load comes from one
+    client process per CPU so the client is not the single-core bottleneck
+    it would be in-process; on a machine with fewer cores than N the curve
+    flattens at the core count, which is the honest answer."""
+    raise_fd_limit()
+    path = "/journey/lib/ease.js"
+    cpus = os.cpu_count() or 1
+    top = args.max_workers or cpus
+    print(f"load: GET {path}, {args.seconds:g}s per level, "
+          f"{cpus} client processes, {args.clients[0]} connections")
+    base = None
+    for workers in sorted({1, 2, 4, 8, 16, top} & set(range(1, top + 1))):
+        with Server(args.root, {"SERVE_ENGINE": args.engine},
+                    ["--workers", str(workers)]) as server:
+            results = multiprocessing.Queue()
+            procs = [multiprocessing.Process(
+                         target=_hammer_process,
+                         args=(server.port, path, max(1, args.clients[0] // cpus),
+                               args.seconds, results))
+                     for _ in range(cpus)]
+            for proc in procs:
+                proc.start()
+            totals = [results.get() for _ in procs]
+            for proc in procs:
+                proc.join()
+        rate = sum(t[0] for t in totals) / args.seconds
+        base = base or rate
+        print(f"  {args.engine:<8} workers {workers:>2}   {rate:8.0f} req/s   "
+              f"x{rate / base:4.2f}   failed {sum(t[1] for t in totals)}")
+
+
+def stalled_stream(port, path):
+    """GET `path` and never read past the status line, like a backgrounded
+    <video>; returns (socket, status)."""
+    sock = socket.socket()
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+    sock.settimeout(5)
+    sock.connect(("127.0.0.1", port))
+    sock.sendall(f"GET {path} HTTP/1.1\r\nHost: bench\r\n\r\n".encode())
+    try:
+        status = int(sock.recv(12)[9:12])
+    except (OSError, ValueError):
+        status = 0
+    return sock, status
+
+
+def bench_admission(args):
+    """Page boot (everything but the card media) while --streams clients
+    hold a large media stream each without reading it. Unbounded threads
+    (the old ThreadingHTTPServer) vs the bounded pool at its defaults:
+    boot time, streams admitted vs shed, peak server threads and RSS."""
+    raise_fd_limit()
+    root = artifact(args)
+    if getattr(args, "tmp", None) is None:
+        raise SystemExit("admission adds a stream file to the served tree: "
+                         "run it against a scratch artifact (no --root)")
+    with open(os.path.join(root, "bench-stream.mp4"), "wb") as fh:
+        fh.truncate(64 << 20)              # sparse: sendfile blocks, disk does not
+    boot = [(path, rng) for path, rng in page_load(root) if not path.endswith(".mp4")]
+    print(f"boot: {len(boot)} requests, {args.streams} stalled media streams")
+    for label, env in (("unbounded", {"SERVE_THREADS": "100000",
+                                      "SERVE_QUEUE": "100000",
+                                      "SERVE_MEDIA_SHARE": "1"}),
+                       ("bounded pool", {})):
+        with Server(root, env) as server:
+            replay(server.port, boot)
+            with ProcSampler(server.proc.pid) as sampler:
+                streams = [stalled_stream(server.port, "/bench-stream.mp4")
+                           for _ in range(args.streams)]
+                rows = [replay(server.port, boot) for _ in range(args.runs)]
+            admitted = sum(1 for _, status in streams if status == 200)
+            for sock, _ in streams:
+                sock.close()
+        report(label, rows)
+        print(f"  {'':<22} streams admitted {admitted:>4}   shed "
+              f"{args.streams - admitted:>4}   threads {sampler.threads:>5}   "
+              f"peak RSS {sampler.rss_kb / 1024:6.1f} MB")
+
+
+def discovery_layers(root):
+    """The boot as the browser discovers it without hints: index.html, then
+    each module layer once its importers have arrived, then the geometry
+    manifest (fetched by baked.js as it evaluates) and its chapter bins."""
+    with open(os.path.join(root, "index.html"), encoding="utf-8") as fh:
+        index = fh.read()
+    imports = import_map(index)
+    layers = [["/index.html"]]
+    layer = [urllib.parse.urljoin("/", src) for src in
+             re.findall(r'<script type="module" src="([^"]+)"', index)]
+    seen = set(layer)
+    while layer:
+        layers.append(layer)
+        found = []
+        for url in layer:
+            path = os.path.join(root, urllib.parse.urlsplit(url).path.lstrip("/"))
+            with open(path, encoding="utf-8", errors="replace") as fh:
+                source = COMMENT_RE.sub(" ", fh.read())
+            for groups in IMPORT_RE.findall(source):
+                target = resolve(next(g for g in groups if g), url, imports)
+                if target and target not in seen and os.path.isfile(
+                        os.path.join(root, urllib.parse.urlsplit(target).path.lstrip("/"))):
+                    seen.add(target)
+                    found.append(target)
+        layer = found
+    manifest = os.path.join(root, "static", "geom", "manifest.json")
+    if os.path.isfile(manifest):
+        layers.append(["/static/geom/manifest.json"])
+        with open(manifest, encoding="utf-8") as fh:
+            layers.append(["/static/geom/" + chapter["file"]
+                           for chapter in json.load(fh).get("chapters", {}).values()])
+    return layers
+
+
+def bench_preload(args):
+    """Boot with a simulated round-trip time (--rtt ms, slept once per
+    discovery round): the layered waterfall the module graph forces, vs
+    index.html followed by everything its Link header names at once."""
+    root = artifact(args)
+    layers = discovery_layers(root)
+    rtt = args.rtt / 1000
+    with Server(root) as server:
+        conn = http.client.HTTPConnection("127.0.0.1", server.port)
+        conn.request("GET", "/")
+        resp = conn.getresponse()
+        resp.read()
+        conn.close()
+        hinted = re.findall(r"<([^>]+)>", resp.getheader("Link") or "")
+        print(f"boot: {sum(map(len, layers))} requests in {len(layers)} discovery "
+              f"rounds; Link header names {len(hinted)} ({len(resp.getheader('Link') or '')} B)")
+        for label, rounds in (("waterfall", layers),
+                              ("Link preload", [["/index.html"], hinted])):
+            rows = []
+            for _ in range(args.runs):
+                t0 = time.perf_counter()
+                opened = received = 0
+                for urls in rounds:
+                    time.sleep(rtt)
+                    n, _, got, _ = replay(server.port, [(url, None) for url in urls])
+                    opened += n
+                    received += got
+                rows.append((opened, time.perf_counter() - t0, received, []))
+            walls = [r[1] for r in rows]
+            print(f"  {label:<14} rounds {len(rounds):>3}   TTLB median "
+                  f"{statistics.median(walls) * 1000:8.1f} ms at {args.rtt:g} ms RTT   "
+                  f"{rows[0][2] / 1e6:6.2f} MB")
+
+
+def bench_devcache(args):
+    """A dev reload of the checkout: SERVE_CACHING=no-store refetches every
+    byte; SERVE_CACHING=dev revalidates each request with the ETag the
+    first load got (If-None-Match), like Chrome's reload under no-cache."""
+    requests = page_load(args.root)
+    print(f"reload: {len(requests)} requests from {args.root}")
+    for label, env in (("no-store", {"SERVE_CACHING": "no-store"}),
+                       ("dev (inotify)", {"SERVE_CACHING": "dev"}),
+                       ("dev (polling)", {"SERVE_CACHING": "dev", "SERVE_WATCH": "poll"})):
+        with Server(args.root, env) as server:
+            conn = http.client.HTTPConnection("127.0.0.1", server.port)
+            reload = []
+            for path, byte_range in requests:
+                conn.request("HEAD", path)
+                resp = conn.getresponse()
+                resp.read()
+                etag = resp.getheader("ETag")
+                reload.append((path, byte_range, {"If-None-Match": etag} if etag else {}))
+            conn.close()
+            replay(server.port, reload)
+            cpu0 = cpu_seconds(server.proc.pid)
+            rows = [replay(server.port, reload) for _ in range(args.runs)]
+            cpu = cpu_seconds(server.proc.pid) - cpu0
+            report(label, rows)
+            print(f"  {'':<22} server CPU {cpu * 1000 / args.runs:6.1f} ms per reload")
+
+
+def bench_livereload(args):
+    """SERVE_LIVERELOAD: startup (the watcher's recursive scan), idle server
+    CPU, and the time from a save to its `change` event on /__livereload.
+    The "save" re-touches the replayed modules' mtimes and puts them back."""
+    paths = [path for path, byte_range in page_load(args.root)
+             if path.endswith(".js")][:args.runs * 4]
+    print(f"livereload: {len(paths)} module saves in {args.root}")
+    for label, env in (("inotify", {}), ("polling", {"SERVE_WATCH": "poll"})):
+        t0 = time.perf_counter()
+        with Server(args.root, dict(env, SERVE_LIVERELOAD="1")) as server:
+            boot = time.perf_counter() - t0
+            cpu0 = cpu_seconds(server.proc.pid)
+            time.sleep(args.seconds)
+            idle = (cpu_seconds(server.proc.pid) - cpu0) / args.seconds
+            sock = socket.create_connection(("127.0.0.1", server.port))
+            sock.sendall(b"GET /__livereload HTTP/1.1\r\nHost: 127.0.0.1\r\n\r\n")
+            stream = sock.makefile("rb")
+            while stream.readline() not in (b"\n", b""):
+                pass                                 # headers, then retry:
+            lags = []
+            for path in paths:
+                local = os.path.join(args.root, urllib.parse.unquote(path.split("?")[0]).lstrip("/"))
+                st = os.stat(local)
+                t0 = time.perf_counter()
+                os.utime(local, ns=(st.st_atime_ns, st.st_mtime_ns + 1000))
+                while not stream.readline().startswith(b"data:"):
+                    pass
+                lags.append(time.perf_counter() - t0)
+                os.utime(local, ns=(st.st_atime_ns, st.st_mtime_ns))
+                while not stream.readline().startswith(b"data:"):
+                    pass                             # the restore's event
+            sock.close()
+        print(f"  {label:<10} boot {boot * 1000:7.1f} ms   idle CPU {idle * 100:5.2f}%"
+              f"   save->event p50 {percentile(lags, 0.5) * 1000:6.1f} ms"
+              f"  p95 {percentile(lags, 0.95) * 1000:6.1f} ms")
+
+
+def pin_to_core(pid):
+    try:
+        os.sched_setaffinity(pid, {min(os.sched_getaffinity(0))})
+    except (AttributeError, OSError):
+        pass
+
+
+SCENARIOS = {
+    "accesslog": bench_accesslog,
+    "admission": bench_admission,
+    "cache": bench_cache,
+    "devcache": bench_devcache,
+    "engines": bench_engines,
+    "keepalive": bench_keepalive,
+    "livereload": bench_livereload,
+    "pack": bench_pack,
+    "preload": bench_preload,
+    "revisions": bench_revisions,
+    "sendfile": bench_sendfile,
+    "workers": bench_workers,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("scenario", choices=sorted(SCENARIOS))
+    parser.add_argument("--root", default=ROOT,
+                        help="served tree containing serve.py (default: checkout)")
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--seconds", type=float, default=5.0,
+                        help="load duration per level (engines)")
+    parser.add_argument("--clients", type=int, nargs="+", default=[100, 1000, 3000],
+                        help="concurrent keep-alive connections per level (engines)")
+    parser.add_argument("--max-workers", type=int, default=0,
+                        help="largest --workers level (workers; default: CPU count)")
+    parser.add_argument("--engine", default="threads", choices=("threads", "asyncio"),
+                        help="server engine (workers)")
+    parser.add_argument("--files", type=int, default=6,
+                        help="largest artifact files to download (sendfile)")
+    parser.add_argument("--repeat", type=int, default=8,
+                        help="downloads of each file per run (sendfile)")
+    parser.add_argument("--rtt", type=float, default=50.0,
+                        help="simulated round-trip time in ms (preload)")
+    parser.add_argument("--streams", type=int, default=300,
+                        help="stalled media streams held open (admission)")
+    parser.add_argument("--candidate", default=None,
+                        help="artifact to mount beside --root (revisions; default: a --pack build)")
+    args = parser.parse_args()
+    args.root = os.path.abspath(args.root)
+    SCENARIOS[args.scenario](args)
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
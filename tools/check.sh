@@ -1,6 +1,11 @@
 #!/usr/bin/env bash
-# Read-only release gates. This script never builds, stages, commits, merges,
-# pushes, deploys, or rewrites committed artifacts.
+# Release gates. This script never stages, commits, merges, pushes, deploys,
+# or rewrites committed artifacts. It builds the public artifact three times
+# into a temporary directory: the tree the size budget measures, the pack
+# with exactly the flags railway.toml deploys, and that pack again with the
+# opt-in --minify --service-worker. The builds share a persistent package
+# cache outside the checkout ($PACKAGE_CACHE, by default under
+# ${XDG_CACHE_HOME:-$HOME/.cache}), which this script creates and fills.
 
 set -euo pipefail
 cd "$(dirname "$0")/.." || exit 2
@@ -31,10 +36,44 @@ trap 'rm -rf "$CHECK_TMP"' EXIT
 
 step "PUBLIC ARTIFACT"
 CHECK_REVISION=$(git rev-parse HEAD) || die "could not resolve checkout revision" 2
-python3 tools/package-public.py "$CHECK_TMP/public" \
+# Outside the checkout; holds content-addressed copies, not artifacts.
+PACKAGE_CACHE="${PACKAGE_CACHE:-${XDG_CACHE_HOME:-$HOME/.cache}/glowshroom/package-public}"
+# Growth is measured from the committed size report, the same on every
+# machine; PACKAGE_ACCEPT_GROWTH=1 accepts growth past the budget's allowance.
+python3 tools/package-public.py "$CHECK_TMP/public" --cache "$PACKAGE_CACHE" \
   --origin https://www.banodoco.ai --revision "$CHECK_REVISION" \
-  || die "public artifact allowlist/roundtrip verification failed"
-pass "public artifact matches its allowlist and substituted source bytes"
+  --budget deploy/public-budget.json --baseline deploy/public-size-report.json \
+  --report "$CHECK_TMP/size-report.json" \
+  ${PACKAGE_ACCEPT_GROWTH:+--accept-growth} \
+  || die "public artifact allowlist/roundtrip verification or size budget failed"
+# The deployed build's flags, read from railway.toml's startCommand so the
+# gate cannot drift from what Railway runs (destination, --origin and
+# --revision aside).
+DEPLOY_FLAGS=$(python3 - <<'PY'
+import re, shlex
+with open("railway.toml", encoding="utf-8") as fh:
+    command = re.search(r'^startCommand\s*=\s*"(.*)"\s*$', fh.read(), re.M).group(1)
+words = shlex.split(command)
+words = words[words.index("tools/package-public.py") + 2:]
+words = words[:words.index("&&")] if "&&" in words else words
+flags, skip = [], False
+for word in words:
+    if skip or word in ("--origin", "--revision"):
+        skip = not skip
+        continue
+    flags.append(word)
+print(" ".join(flags))
+PY
+) || die "could not read the package-public.py flags from railway.toml" 2
+# $DEPLOY_FLAGS unquoted: it is a list of flags.
+python3 tools/package-public.py "$CHECK_TMP/deployed" $DEPLOY_FLAGS --cache "$PACKAGE_CACHE" \
+  --origin https://www.banodoco.ai --revision "$CHECK_REVISION" \
+  || die "public artifact as railway.toml builds it ($DEPLOY_FLAGS) failed verification"
+python3 tools/package-public.py "$CHECK_TMP/options" $DEPLOY_FLAGS --minify --service-worker \
+  --cache "$PACKAGE_CACHE" --origin https://www.banodoco.ai --revision "$CHECK_REVISION" \
+  || die "public artifact with --minify --service-worker failed verification"
+pass "public artifact matches its allowlist and substituted source bytes (tree; $DEPLOY_FLAGS as deployed; and with --minify --service-worker)"
+pass "public artifact within deploy/public-budget.json, and its growth since deploy/public-size-report.json"
 
 step "CHECK PRECONDITIONS"
 if ! curl -fsS "$CHECK_ORIGIN/index.html" -o "$CHECK_TMP/index.html" 2>/dev/null; then
@@ -4,17 +4,237 @@
 from __future__ import annotations
 
 import argparse
+import collections
+import filecmp
 import fnmatch
+import gzip
+import hashlib
+import http.server
+import io
 import json
+import mmap
+import os
+import posixpath
+import re
 import shutil
+import struct
+import subprocess
 import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path, PurePosixPath
+from typing import NamedTuple
+
+try:
+    import brotli
+except ImportError:          # optional: gzip sidecars only
+    brotli = None
+
+try:
+    import fcntl
+except ImportError:          # not POSIX: --cache hardlinks or copies
+    fcntl = None
+
+try:
+    from PIL import Image, features
+except ImportError:          # optional: only --image-variants needs it
+    Image = None
 
 
 ROOT = Path(__file__).resolve().parent.parent
 MANIFEST = ROOT / "deploy" / "public-files.json"
 REVISION_FILE = "release-revision.txt"
 
+# Packaging reads every file once, on a pool of --jobs threads (file I/O,
+# hashing, zlib and ffmpeg all run outside the GIL): PLACEHOLDER is
+# substituted as COPY_CHUNK-sized reads stream to the artifact. A
+# placeholder split across two reads is held back to the next; it has no
+# prefix that is also a suffix, so a held-back prefix can never belong to
+# an earlier match. verify() then reads each source again, re-derives its
+# served bytes and hashes the artifact's against them, so a fault in the
+# streaming path cannot vouch for itself.
+PLACEHOLDER = b"ORIGIN"
+COPY_CHUNK = 1 << 20
+JOBS = max(2, min(16, os.cpu_count() or 1))
+
+# Precompressed sidecars (name.js -> name.js.gz / name.js.br) that serve.py
+# sends on Accept-Encoding. Only text-like and float-array payloads are worth
+# trying, only above COMPRESS_MIN_BYTES, and a sidecar is kept only when it
+# is at most COMPRESS_MAX_RATIO of the original.
+COMPRESSIBLE = {".css", ".html", ".js", ".json", ".svg", ".txt", ".xml",
+                ".webmanifest", ".bin"}
+COMPRESS_MIN_BYTES = 1024
+COMPRESS_MAX_RATIO = 0.9
+SIDECAR_CODINGS = {".br": "br", ".gz": "gzip"}
+
+# --media-variants: a lower-bitrate name.lite.mp4 next to each allowlisted
+# mp4, which serve.py sends on Save-Data or a slow ECT/Downlink hint. The
+# card previews play at most ~300 CSS px wide, so LITE_WIDTH covers a
+# 430x932 phone at 1.5x; H.264 main/yuv420p plays everywhere the original
+# does. A variant is kept only at most LITE_MAX_RATIO of the original.
+MEDIA_VARIANT_SUFFIXES = {".mp4"}
+LITE_SUFFIX = ".lite"
+LITE_WIDTH = 480
+LITE_MAX_RATIO = 0.75
+LITE_ARGS = ["-map", "0:v:0", "-map", "0:a:0?", "-map_metadata", "-1",
+             "-vf", f"scale='min({LITE_WIDTH},iw)':-2",
+             "-c:v", "libx264", "-profile:v", "main", "-pix_fmt", "yuv420p",
+             "-preset", "slow", "-crf", "30", "-maxrate", "350k", "-bufsize", "700k",
+             "-c:a", "aac", "-b:a", "48k", "-movflags", "+faststart"]
+
+# Faststart: a player can start an mp4 only once it has the moov box (the
+# sample tables). In front of mdat it arrives with the first range; behind
+# it the player must first seek to the end of the file. Every allowlisted
+# mp4 with moov after mdat is rewritten with moov first and its stco/co64
+# chunk offsets shifted to match. The samples are not re-encoded.
+FASTSTART_SUFFIXES = {".mp4"}
+MP4_CONTAINERS = {b"moov", b"trak", b"mdia", b"minf", b"stbl"}   # down to stco / co64
+
+# --minify: the site's own modules, stylesheets and JSON ship without
+# comments and redundant whitespace. Only what lies between tokens is
+# touched: strings, template literals (with their ${} expressions), regex
+# literals and CSS url()s are copied as written, /*! and @license comments
+# stay, and a JS line break stays wherever automatic semicolon insertion
+# could depend on it. JSON is re-serialized compactly. vendor/ ships as
+# distributed.
+MINIFY_SUFFIXES = {".css", ".js", ".json"}
+MINIFY_EXCLUDE = ["vendor/*"]
+MINIFY_VERSION = 2           # in the --cache key: bump when the output changes
+KEPT_COMMENT_RE = re.compile(r"/\*!|@license|@preserve")
+GAP_PART_RE = re.compile(r"\s+|//[^\n\r\u2028\u2029]*|/\*[\s\S]*?\*/")
+JS_GAP_RE = re.compile(r"(?:\s+|//[^\n\r\u2028\u2029]*|/\*[\s\S]*?\*/)+")
+JS_CODE_RE = re.compile(r"[^\s/'\"`{}]+")
+STRING_RE = re.compile(r"'(?:[^'\\\n]|\\[\s\S])*'" r'|"(?:[^"\\\n]|\\[\s\S])*"')   # JS and CSS
+JS_TEMPLATE_RE = re.compile(r"(?:[^`\\$]|\\[\s\S]|\$(?!\{))*(?:`|\$\{)")
+JS_REGEX_RE = re.compile(r"/(?:[^/\\\[\n]|\\.|\[(?:[^\]\\\n]|\\.)*\])+/")
+JS_WORD_RE = re.compile(r"[\w$#\\]+$")
+JS_REGEX_AFTER = {"await", "case", "delete", "do", "else", "in", "instanceof", "new", "of",
+                  "return", "throw", "typeof", "void", "yield"}
+JS_JOIN_AFTER = set("{([,;")      # a line break after these never ends a statement
+JS_JOIN_BEFORE = set("})],;")     # nor one before these
+CSS_GAP_RE = re.compile(r"(?:\s+|/\*[\s\S]*?\*/)+")
+CSS_CODE_RE = re.compile(r"""(?:url\((?!\s*['"])[^)]*\)|/(?!\*)|[^\s/'"])+""", re.I)
+CSS_TIGHT_AFTER = set("{};,>:(")
+CSS_TIGHT_BEFORE = set("{};,>)")
+
+# --image-variants (needs Pillow): each allowlisted raster of at least
+# IMAGE_MIN_BYTES is re-encoded as WebP, and as AVIF where Pillow has it.
+# name.png.webp / name.png.avif keep the full size; serve.py sends one in
+# place of name.png to a browser whose Accept names the type. name.<W>w.webp
+# / .avif are at each narrower IMAGE_WIDTHS width, for srcset. A variant is
+# kept only at most IMAGE_MAX_RATIO of the original. IMAGE_MANIFEST lists
+# them per original, as srcset strings relative to its directory. The brand
+# icons and og cards are left alone, since launchers and link unfurlers
+# fetch them expecting the declared format.
+IMAGE_VARIANT_SUFFIXES = {".jpg", ".png"}
+IMAGE_VARIANT_EXCLUDE = ["assets/brand/*"]
+IMAGE_MIN_BYTES = 16 << 10
+IMAGE_WIDTHS = (480, 960, 1440)
+IMAGE_MAX_RATIO = 0.9
+IMAGE_FORMATS = {            # suffix -> (Pillow format, MIME type, save options), best first
+    ".avif": ("AVIF", "image/avif", {"quality": 55, "speed": 6}),
+    ".webp": ("WEBP", "image/webp", {"quality": 80, "method": 6}),
+}
+IMAGE_MANIFEST = "image-variants.json"
+
+# --budget / --report: the artifact's bytes by top-level tree and by type,
+# its REPORT_LARGEST largest files, and its critical path. That is
+# CRITICAL_PAGE, its stylesheets, the modules its scripts import statically,
+# and the JSON those modules name (the geometry manifest). import() waits
+# for the journey, and the chapter bins load behind the first chapter. A
+# committed budget caps each of these, and no total may grow past the
+# budget's "growth" allowance since --baseline, a report committed with the
+# tree (SIZE_BASELINE) so every checkout measures growth from the same bytes.
+CRITICAL_PAGE = "index.html"
+REPORT_LARGEST = 10
+SIZE_BASELINE = "deploy/public-size-report.json"
+STYLESHEET_RE = re.compile(r'<link rel="stylesheet" href="([^"]+)"')
+JSON_LITERAL_RE = re.compile(r"""['"]([\w./-]+\.json)['"]""")   # serving/preload.py's, tested equal
+
+# --service-worker writes SERVICE_WORKER, SERVICE_WORKER_SOURCE with its
+# PRECACHE_LINE replaced by the precache manifest, and CRITICAL_PAGE
+# registers it once loaded. The manifest carries the revision and, per
+# allowlisted file in each of two tiers, the sha256 of its served bytes
+# (and its --fingerprint name): "boot", the critical path plus the icons,
+# fonts and images the page and its stylesheets point at; and "chapters",
+# the rest of the page's module graph (import() included), the JSON those
+# modules name and the geometry manifest's chapter files. Both are cached
+# before the worker installs, so the pages it controls get one revision
+# whole. A new revision's worker reuses every cached entry whose hash it
+# shares with the last one. Range-served media (PRECACHE_EXCLUDE) and originals
+# with --image-variants, negotiated per request, stay off the manifest.
+SERVICE_WORKER = "sw.js"
+SERVICE_WORKER_SOURCE = ROOT / "tools" / "public-sw.js"
+PRECACHE_LINE = "const PRECACHE = { revision: '', boot: {}, chapters: {} };"
+PRECACHE_EXCLUDE = {".mp4"}
+
+# --pack writes the artifact as one file for serve.py to mmap: PACK_MAGIC,
+# the JSON index's length (u64 LE), the index (revision; per file its
+# offset and length in the data, MIME type, ETag, mtime), zero padding to
+# PACK_ALIGN, then every file's bytes back to back. Only serve.py and the
+# serving/ package (to run) and the release marker (to be recognised) are
+# also written as files: PACK_LOOSE names them by their first path part.
+# The layout is read by serving/artifact.py's PackedArtifact; keep the two in step.
+PACK_NAME = "public.pack"
+PACK_MAGIC = b"GSPACK1\n"
+PACK_ALIGN = 4096
+PACK_LOOSE = ("serve.py", "serving", REVISION_FILE)
+
+# --fingerprint: every allowlisted file with a FINGERPRINTED suffix is also
+# served as name.<hash>.ext (the first FINGERPRINT_LENGTH hex digits of the
+# sha256 of its served bytes) — a hardlink in a tree, a second index entry
+# for the same bytes in a pack — and serve.py caches those names immutable
+# for a year. The original names stay, revalidated as before: the card
+# media URLs journey/cards/ builds at runtime, the portrait sprite found
+# next to its module's import.meta.url, and pages a visitor still holds
+# from the previous deploy all keep working. What can be rewritten points
+# at the new names: each page's import map covers its module graph (so
+# module sources stay byte-for-byte, and a changed module renames only
+# itself), <script src>/<link href>/url() in the pages and stylesheets,
+# and the geometry manifest's chapter files. Files are processed in
+# REWRITE_STAGES order, so a stylesheet's own hash covers the names it
+# was rewritten to before a page names it in turn.
+FINGERPRINTED = {".bin", ".css", ".jpg", ".js", ".mp4", ".png", ".svg", ".woff2"}
+FINGERPRINT_LENGTH = 12
+GEOMETRY_MANIFEST = "static/geom/manifest.json"
+REWRITE_STAGES = 3           # 0: as substituted; 1: .css + GEOMETRY_MANIFEST; 2: .html
+IMPORTMAP_RE = re.compile(r'<script type="importmap">(.*?)</script>', re.S)
+MODULE_SCRIPT_RE = re.compile(r'([ \t]*)<script type="module"(?: src="([^"]+)")?>(.*?)</script>',
+                              re.S)
+# serving/preload.py's, for the same module graph (test_package_public.py
+# holds the copies equal: the packager does not import the server).
+IMPORT_RE = re.compile(
+    r"""(?:^|[;\s])(?:import|export)\s[^'"`;]*?from\s*['"]([^'"]+)['"]"""
+    r"""|(?:^|[;\s])import\s*['"]([^'"]+)['"]"""
+    r"""|\bimport\(\s*['"]([^'"]+)['"]\s*\)""",
+    re.M)
+COMMENT_RE = re.compile(r"/\*.*?\*/|^\s*//[^\n]*", re.S | re.M)
+HTML_REF_RE = re.compile(r"""(\s(?:src|href)=)(["'])([^"']+)\2""")
+CSS_URL_RE = re.compile(r"""(url\(\s*)(['"]?)([^'"()\s]+)\2(\s*\))""")
+GEOMETRY_FILE_RE = re.compile(r'("file"\s*:\s*")([^"]+)(")')
+
+# --cache DIR makes a rebuild incremental. CACHE_INDEX records each source's
+# stat stamp (SOURCE_STAMP), its sha256 and whether it contains ORIGIN, so
+# an unchanged file is not read or hashed again; objects/ holds read-only copies of the
+# files without ORIGIN and every sidecar and lite variant, named by the
+# sha256 of the bytes they derive from. A tree artifact hardlinks (else
+# reflinks, else copies) its files from there, and verify() only checks
+# the size of what an earlier build already checked. Objects no current file derives from are
+# deleted at the end of each build.
+CACHE_INDEX = "index.json"
+CACHE_VERSION = 2
+# Size and mtime alone miss a same-size edit whose mtime was put back (cp -p,
+# rsync -t, an editor or checkout preserving it); nothing sets ctime back,
+# and a replaced file gets a new inode.
+SOURCE_STAMP = ("st_size", "st_mtime_ns", "st_ctime_ns", "st_ino", "st_dev")
+LITE_KEY = hashlib.sha256(json.dumps(LITE_ARGS).encode("utf-8")).hexdigest()[:12]
+IMAGE_KEY = hashlib.sha256(json.dumps([IMAGE_WIDTHS, IMAGE_MAX_RATIO, IMAGE_FORMATS])
+                           .encode("utf-8")).hexdigest()[:12]
+FICLONE = 0x40049409         # linux/fs.h: share extents (btrfs, xfs, ...)
+
 
 def matches(path: str, patterns: list[str]) -> bool:
     name = PurePosixPath(path).name
@@ -49,25 +269,1300 @@ def selected_files(config: dict) -> list[tuple[Path, Path]]:
     return [(source, Path(relative)) for relative, source in sorted(selected.items())]
 
 
+class Written(NamedTuple):
+    """One allowlisted file as the pipeline wrote it."""
+    size: int
+    sha256: str
+    unresolved: bool                 # PLACEHOLDER still present after substitution
+
+
+class StreamScan:
+    """sha256, size and a PLACEHOLDER search over bytes arriving in blocks;
+    the last len(PLACEHOLDER) - 1 bytes of a block are kept, so an ORIGIN
+    split across two blocks is still found."""
+
+    def __init__(self) -> None:
+        self.digest = hashlib.sha256()
+        self.size = 0
+        self.unresolved = False
+        self._tail = b""
+
+    def update(self, block: bytes) -> None:
+        self.digest.update(block)
+        self.size += len(block)
+        keep = len(PLACEHOLDER) - 1
+        self.unresolved = (self.unresolved or PLACEHOLDER in block
+                           or PLACEHOLDER in self._tail + block[:keep])
+        self._tail = (self._tail + block[-keep:])[-keep:]
+
+    def written(self) -> Written:
+        return Written(self.size, self.digest.hexdigest(), self.unresolved)
+
+
+def substituted(source: Path, origin: bytes):
+    """`source` in COPY_CHUNK blocks with PLACEHOLDER replaced by `origin`;
+    a block ending in a prefix of PLACEHOLDER holds it back for the next."""
+    carry = b""
+    with open(source, "rb") as src:
+        while True:
+            chunk = src.read(COPY_CHUNK)
+            block = carry + chunk if carry else chunk
+            hold = next((k for k in range(len(PLACEHOLDER) - 1, 0, -1)
+                         if block.endswith(PLACEHOLDER[:k])), 0) if chunk else 0
+            carry, section = block[len(block) - hold:], block[:len(block) - hold]
+            yield section.replace(PLACEHOLDER, origin)
+            if not chunk:
+                return
+
+
+def substitute_stream(source: Path, target: Path, origin: bytes,
+                      keep: bool = False) -> tuple[Written, bytes | None]:
+    """Copy `source` to `target` through substituted(), hashing what is
+    written; also returns the written bytes when `keep` (for the sidecars)."""
+    scan, parts = StreamScan(), []
+    with open(target, "wb") as dst:
+        for out in substituted(source, origin):
+            dst.write(out)
+            scan.update(out)
+            if keep:
+                parts.append(out)
+    shutil.copystat(source, target)
+    return scan.written(), (b"".join(parts) if keep else None)
+
+
+def compress(data: bytes, coding: str) -> bytes:
+    if coding == "gzip":
+        return gzip.compress(data, compresslevel=9, mtime=0)
+    return brotli.compress(data, quality=11)
+
+
+def decompress(data: bytes, coding: str) -> bytes:
+    return gzip.decompress(data) if coding == "gzip" else brotli.decompress(data)
+
+
+def sidecar_codings(relative: Path, size: int) -> list[tuple[str, str]]:
+    """The (suffix, coding) sidecars worth trying for one file."""
+    if relative.suffix not in COMPRESSIBLE or size < COMPRESS_MIN_BYTES:
+        return []
+    codings = ["gzip"] + (["br"] if brotli is not None else [])
+    return [(next(s for s, c in SIDECAR_CODINGS.items() if c == coding), coding)
+            for coding in codings]
+
+
+def sidecar_payload(data: bytes, coding: str) -> bytes | None:
+    packed = compress(data, coding)
+    return packed if len(packed) <= len(data) * COMPRESS_MAX_RATIO else None
+
+
+def sidecar_payloads(relative: Path, data: bytes) -> list[tuple[Path, str, bytes]]:
+    """The worthwhile sidecars of one file as (sidecar, coding, bytes)."""
+    payloads = []
+    for suffix, coding in sidecar_codings(relative, len(data)):
+        packed = sidecar_payload(data, coding)
+        if packed is not None:
+            payloads.append((relative.with_name(relative.name + suffix), coding, packed))
+    return payloads
+
+
+def ffmpeg_exe() -> str:
+    """The ffmpeg binary, found the way tools/film/film.py finds it."""
+    try:
+        import imageio_ffmpeg
+        return imageio_ffmpeg.get_ffmpeg_exe()
+    except Exception:
+        path = shutil.which("ffmpeg")
+        if path:
+            return path
+        raise ValueError("--media-variants needs ffmpeg: pip3 install --user imageio-ffmpeg")
+
+
+def lite_name(relative: Path) -> Path:
+    return relative.with_name(relative.stem + LITE_SUFFIX + relative.suffix)
+
+
+def lite_payload(ffmpeg: str, relative: Path, data: bytes | Path) -> bytes | None:
+    """The lower-bitrate encoding of one media file (its bytes, or a path
+    ffmpeg can read them from), None if not worth it."""
+    if relative.suffix not in MEDIA_VARIANT_SUFFIXES:
+        return None
+    with tempfile.TemporaryDirectory(prefix="package-public.") as scratch:
+        source = data if isinstance(data, Path) else Path(scratch) / ("in" + relative.suffix)
+        target = Path(scratch) / ("out" + relative.suffix)
+        if not isinstance(data, Path):
+            source.write_bytes(data)
+        result = subprocess.run([ffmpeg, "-v", "error", "-y", "-i", str(source),
+                                 *LITE_ARGS, str(target)],
+                                stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        if result.returncode != 0:
+            detail = result.stderr.decode(errors="replace").strip().splitlines()
+            raise ValueError(f"ffmpeg failed for {relative}: "
+                             + (detail[-1] if detail else f"exit {result.returncode}"))
+        lite = target.read_bytes()
+        size = source.stat().st_size
+    return lite if len(lite) <= size * LITE_MAX_RATIO else None
+
+
+def mp4_boxes(data, start: int = 0, end: int | None = None) -> list[tuple[bytes, int, int]]:
+    """The boxes tiling data[start:end] as (type, offset, end offset)."""
+    end = len(data) if end is None else end
+    boxes = []
+    while start < end:
+        if end - start < 8:
+            raise ValueError("truncated box header")
+        size, kind = struct.unpack_from(">I4s", data, start)
+        header = 8
+        if size == 1:                # 64-bit size follows the type
+            if end - start < 16:
+                raise ValueError("truncated box header")
+            (size,) = struct.unpack_from(">Q", data, start + 8)
+            header = 16
+        elif size == 0:              # runs to the end of its parent
+            size = end - start
+        if size < header or start + size > end:
+            raise ValueError(f"{kind.decode('latin-1')!r} box overruns its parent")
+        boxes.append((kind, start, start + size))
+        start += size
+    return boxes
+
+
+def moov_first(relative: Path, data) -> bool:
+    """Whether the mp4 in `data` has its moov box ahead of its first mdat."""
+    try:
+        kinds = [kind for kind, _, _ in mp4_boxes(data)]
+    except ValueError as error:
+        raise ValueError(f"{relative} is not a well-formed mp4: {error}") from None
+    if kinds.count(b"moov") != 1 or b"mdat" not in kinds:
+        raise ValueError(f"{relative} is not a playable mp4: needs one moov and an mdat")
+    return kinds.index(b"moov") < kinds.index(b"mdat")
+
+
+def source_moov_first(source: Path, relative: Path) -> bool:
+    """moov_first() from the top-level box headers alone (the file is
+    mapped, so only those pages are read)."""
+    with open(source, "rb") as fh:
+        if os.fstat(fh.fileno()).st_size == 0:
+            return moov_first(relative, b"")
+        with mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as view:
+            return moov_first(relative, view)
+
+
+def faststart(relative: Path, data: bytes) -> bytes:
+    """`data` with its moov box moved in front of the first mdat, and each
+    stco/co64 chunk offset into the bytes that move back shifted by the
+    moov's size. Everything else is copied through unchanged."""
+    if moov_first(relative, data):
+        return data
+    boxes = mp4_boxes(data)
+    moov_start, moov_end = next((start, end) for kind, start, end in boxes if kind == b"moov")
+    mdat_start = next(start for kind, start, _ in boxes if kind == b"mdat")
+    moov = bytearray(data[moov_start:moov_end])
+    shift = len(moov)
+    if struct.unpack_from(">I", moov)[0] == 0:
+        struct.pack_into(">I", moov, 0, shift)   # "to the end of the file" no longer is
+
+    def patch(start: int, end: int) -> None:
+        for kind, box, box_end in mp4_boxes(moov, start, end):
+            body = box + (16 if struct.unpack_from(">I", moov, box)[0] == 1 else 8)
+            if kind in MP4_CONTAINERS:
+                patch(body, box_end)
+            elif kind in (b"stco", b"co64"):
+                fmt, width = (">Q", 8) if kind == b"co64" else (">I", 4)
+                (count,) = struct.unpack_from(">I", moov, body + 4)   # after version/flags
+                table = body + 8
+                if table + count * width > box_end:
+                    raise ValueError(f"{kind.decode()} table overruns its box")
+                for at in range(table, table + count * width, width):
+                    (offset,) = struct.unpack_from(fmt, moov, at)
+                    if mdat_start <= offset < moov_start:
+                        offset += shift
+                    if offset >= 1 << (8 * width):
+                        raise ValueError("the shifted offsets need co64, not stco")
+                    struct.pack_into(fmt, moov, at, offset)
+
+    try:
+        patch(16 if struct.unpack_from(">I", moov)[0] == 1 else 8, shift)
+    except (ValueError, struct.error) as error:
+        raise ValueError(f"{relative}: cannot move moov to the front: {error}") from None
+    return b"".join((data[:mdat_start], moov, data[mdat_start:moov_start], data[moov_end:]))
+
+
+def minifiable(relative: Path) -> bool:
+    return relative.suffix in MINIFY_SUFFIXES and not matches(relative.as_posix(), MINIFY_EXCLUDE)
+
+
+def _word_char(char: str) -> bool:
+    return char.isalnum() or char in "_$#\\" or char > "\x7f"
+
+
+def js_gap(before: str, after: str, gap: str) -> str:
+    """What minify_js() leaves of the whitespace and comments `gap` between
+    two tokens: a line break ASI might need, a space where the tokens would
+    otherwise fuse, else nothing."""
+    a, b = before[-1], after[0]
+    if any(end in gap for end in "\n\r\u2028\u2029") \
+            and a not in JS_JOIN_AFTER and b not in JS_JOIN_BEFORE:
+        return "\n"
+    word = JS_WORD_RE.search(before)
+    if (_word_char(a) and (_word_char(b) or b == ".")
+            or a in "+-" and b in "+-" or a == "/" and b in "/*"
+            or a == "/" and _word_char(b) and len(before) > 1   # a regex literal, not its flags
+            or (a, b) in (("<", "!"), ("-", ">"))
+            or word is not None and word.group() in ("import", "export")):   # preload.py's IMPORT_RE
+        return " "
+    return ""
+
+
+def js_regex_allowed(last: str, previous: str = "") -> bool:
+    """Whether a / after the token `last` (`previous` the token before it)
+    opens a regex literal rather than dividing. A keyword read as a
+    property (a.return / 2) and a postfix x++ / 2 divide."""
+    word = JS_WORD_RE.search(last)
+    if word is not None:
+        return word.group() in JS_REGEX_AFTER \
+            and not (last[:word.start()] or previous).endswith(".")
+    if last.endswith(("++", "--")):
+        return False
+    return not last or last[-1] not in ")]}'\"`/"
+
+
+def minify_js(source: str) -> str:
+    """An ES module without comments and without the whitespace its tokens
+    can do without."""
+    out, templates, depth, i = [], [], 0, 0
+    previous, last, gap = "", "", ""
+
+    def emit(token: str, significant: bool = True) -> None:
+        nonlocal previous, last, gap
+        separator = js_gap(out[-1], token, gap) if gap and out else ""
+        out.extend((separator, token) if separator else (token,))
+        gap = ""
+        if significant:
+            previous, last = last, token
+
+    while i < len(source):
+        char = source[i]
+        gaps = JS_GAP_RE.match(source, i)
+        if gaps is not None:
+            for part in GAP_PART_RE.finditer(gaps.group()):
+                if part.group().startswith("/*") and KEPT_COMMENT_RE.search(part.group()):
+                    emit(part.group(), significant=False)
+                    gap = "\n"
+                else:
+                    gap += part.group()
+            i = gaps.end()
+            continue
+        if char == "`" or char == "}" and templates and templates[-1] == depth:
+            body = JS_TEMPLATE_RE.match(source, i + 1)
+            if body is None:
+                raise ValueError(f"unterminated template literal at offset {i}")
+            if char == "}":
+                templates.pop()
+            if body.group().endswith("${"):
+                templates.append(depth)
+            token = char + body.group()
+        elif char in "'\"":
+            literal = STRING_RE.match(source, i)
+            if literal is None:
+                raise ValueError(f"unterminated string at offset {i}")
+            token = literal.group()
+        elif char == "/":
+            literal = JS_REGEX_RE.match(source, i) if js_regex_allowed(last, previous) else None
+            token = literal.group() if literal is not None else char
+        elif char in "{}":
+            depth += 1 if char == "{" else -1
+            token = char
+        else:
+            token = JS_CODE_RE.match(source, i).group()
+        emit(token)
+        i += len(token)
+    return "".join(out)
+
+
+def minify_css(source: str) -> str:
+    """A stylesheet without comments and without the whitespace its tokens
+    can do without (nor the last ; of a block)."""
+    out, gap, i = [], None, 0      # gap: None, or whether it held whitespace
+    while i < len(source):
+        gaps = CSS_GAP_RE.match(source, i)
+        if gaps is not None:
+            for part in GAP_PART_RE.finditer(gaps.group()):
+                if part.group().startswith("/*") and KEPT_COMMENT_RE.search(part.group()):
+                    out.append(part.group())
+                else:
+                    gap = bool(gap) or part.group()[0].isspace()
+            i = gaps.end()
+            continue
+        if source[i] in "'\"":
+            literal = STRING_RE.match(source, i)
+            if literal is None:
+                raise ValueError(f"unterminated string at offset {i}")
+            token = literal.group()
+        else:
+            token = CSS_CODE_RE.match(source, i).group()
+        i += len(token)
+        if out and gap is not None and out[-1][-1] not in CSS_TIGHT_AFTER \
+                and token[0] not in CSS_TIGHT_BEFORE:
+            out.append(" " if gap else "/**/")   # a comment alone is no descendant combinator
+        gap = None
+        if token[0] == "}" and out and out[-1].endswith(";"):
+            out[-1] = out[-1][:-1]
+        out.append(token.replace(";}", "}"))
+    return "".join(out)
+
+
+def minified(relative: Path, data: bytes) -> bytes | None:
+    """--minify's version of one file's served bytes, None when it saves
+    nothing."""
+    try:
+        text = data.decode("utf-8")
+        if relative.suffix == ".json":
+            text = json.dumps(json.loads(text), ensure_ascii=False, separators=(",", ":"))
+        elif relative.suffix == ".css":
+            text = minify_css(text)
+        else:
+            text = minify_js(text)
+    except ValueError as error:
+        raise ValueError(f"cannot minify {relative}: {error}") from None
+    packed = text.encode("utf-8")
+    return packed if len(packed) < len(data) else None
+
+
+def image_formats() -> list[str]:
+    """The IMAGE_FORMATS suffixes this Pillow can write."""
+    if Image is None:
+        raise ValueError("--image-variants needs Pillow: pip3 install --user pillow")
+    return [suffix for suffix, (name, _, _) in IMAGE_FORMATS.items()
+            if features.check(name.lower())]
+
+
+def image_name(relative: Path, width: int, suffix: str, full: bool) -> Path:
+    if full:
+        return relative.with_name(relative.name + suffix)
+    return relative.with_name(f"{relative.stem}.{width}w{suffix}")
+
+
+def image_payload(pixels: Image.Image, width: int, suffix: str, size: int) -> bytes | None:
+    """One re-encoding of a decoded raster at `width`, None if it is not at
+    most IMAGE_MAX_RATIO of the original's `size` bytes."""
+    name, _, options = IMAGE_FORMATS[suffix]
+    if width != pixels.width:
+        pixels = pixels.resize((width, max(1, round(pixels.height * width / pixels.width))),
+                               Image.LANCZOS)
+    if "icc_profile" in pixels.info:
+        options = {**options, "icc_profile": pixels.info["icc_profile"]}
+    out = io.BytesIO()
+    pixels.save(out, name, **options)
+    return out.getvalue() if out.tell() <= size * IMAGE_MAX_RATIO else None
+
+
+class BuildCache:
+    """The --cache directory: CACHE_INDEX plus content-addressed objects."""
+
+    def __init__(self, directory: Path):
+        self.directory = directory
+        try:
+            state = json.loads((directory / CACHE_INDEX).read_text(encoding="utf-8"))
+        except (OSError, ValueError):
+            state = {}
+        if state.get("version") != CACHE_VERSION:
+            state = {}
+        self.sources: dict[str, dict] = state.get("sources", {})   # posix -> digest entry
+        self.derived: dict[str, bool] = state.get("derived", {})   # key -> worth keeping
+        self.digests: dict[str, str] = {}    # posix -> sha256 of the bytes served
+        self.live: set[str] = set()          # digests anything of this build has
+        self.trusted: set[str] = set()       # artifact paths an earlier build verified
+
+    def object(self, key: str) -> Path:
+        return self.directory / "objects" / key[:2] / key
+
+    def _store(self, key: str, data: bytes, mtime: float, mode: int = 0o444) -> Path:
+        path = self.object(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        scratch = path.with_name(f"{path.name}.{os.getpid()}-{threading.get_ident()}.tmp")
+        scratch.write_bytes(data)
+        os.utime(scratch, (mtime, mtime))
+        scratch.chmod(mode & 0o555)      # shared by every hardlink: never edit in place
+        os.replace(scratch, path)
+        return path
+
+    def served(self, source: Path, relative: Path, origin: bytes, keep: bool = True
+               ) -> tuple[bytes | None, Path | None]:
+        """One source as served: (bytes, None) when they had to be read or
+        substituted, else (None, object) — an ORIGIN-free file is stored
+        under its digest (when `keep`) and only re-read when its
+        SOURCE_STAMP moved since the last build."""
+        name = relative.as_posix()
+        st = source.stat()
+        stamp = [getattr(st, field) for field in SOURCE_STAMP]
+        entry = self.sources.get(name)
+        data = None
+        if entry is None or entry["stamp"] != stamp:
+            data = source.read_bytes()
+            entry = self.sources[name] = {
+                "stamp": stamp,
+                "sha256": hashlib.sha256(data).hexdigest(), "origin": PLACEHOLDER in data}
+        sha = self.digests[name] = entry["sha256"]
+        self.live.add(sha)
+        if entry["origin"]:              # rewritten, so checked, every build
+            data = (data if data is not None else source.read_bytes()).replace(PLACEHOLDER, origin)
+            sha = self.digests[name] = hashlib.sha256(data).hexdigest()
+            self.live.add(sha)
+            return data, None
+        stored = self.object(sha)
+        if data is None and (not keep or stored.is_file()):
+            self.trusted.add(name)
+        if not keep:
+            return (data if data is not None else source.read_bytes()), None
+        if stored.is_file():
+            return None, stored
+        data = data if data is not None else source.read_bytes()
+        if hashlib.sha256(data).hexdigest() != sha:
+            raise ValueError(f"{name} changed while packaging")
+        return None, self._store(sha, data, st.st_mtime, st.st_mode)
+
+    def rewritten(self, relative: Path, data: bytes) -> str:
+        """Record the bytes file_rewrite() turned a file into (what its
+        sidecars derive from); --fingerprint's depend on other files, so
+        the file is written and verified every build."""
+        name = relative.as_posix()
+        sha = self.digests[name] = hashlib.sha256(data).hexdigest()
+        self.live.add(sha)
+        self.trusted.discard(name)
+        return sha
+
+    def derive(self, name: Path, key: str, make, mtime: float) -> Path | None:
+        """The object `make()` builds for `key` (a sidecar, a lite variant),
+        None when it was not worth keeping; made only if no earlier build
+        recorded the answer."""
+        self.live.add(key.split(".")[0])
+        known = self.derived.get(key)
+        if known is False:
+            return None
+        if known and self.object(key).is_file():
+            self.trusted.add(name.as_posix())
+            return self.object(key)
+        data = make()
+        self.derived[key] = data is not None
+        return None if data is None else self._store(key, data, mtime)
+
+    def place(self, stored: Path, target: Path, source: Path) -> str:
+        """Put an object at `target`: hardlink, else reflink, else copy.
+        Returns which."""
+        target.parent.mkdir(parents=True, exist_ok=True)
+        try:
+            os.link(stored, target)
+            kind = "hardlinked"
+        except OSError:
+            try:
+                if fcntl is None:
+                    raise OSError("no FICLONE")
+                with open(stored, "rb") as src, open(target, "wb") as dst:
+                    fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+                kind = "reflinked"
+            except OSError:
+                shutil.copyfile(stored, target)
+                kind = "copied"
+            shutil.copystat(source, target)
+        return kind
+
+    def save(self, selected: set[str]) -> None:
+        """Forget sources no longer allowlisted, delete objects nothing in
+        this build derives from, and write CACHE_INDEX."""
+        self.sources = {name: entry for name, entry in self.sources.items() if name in selected}
+        self.derived = {key: worth for key, worth in self.derived.items()
+                        if key.split(".")[0] in self.live}
+        for path in (self.directory / "objects").glob("*/*"):
+            if path.name.split(".")[0] not in self.live:
+                path.unlink()
+        self.directory.mkdir(parents=True, exist_ok=True)
+        scratch = self.directory / f"{CACHE_INDEX}.{os.getpid()}.tmp"
+        scratch.write_text(json.dumps({"version": CACHE_VERSION, "sources": self.sources,
+                                       "derived": self.derived}, separators=(",", ":")),
+                           encoding="utf-8")
+        os.replace(scratch, self.directory / CACHE_INDEX)
+
+
+def cached_sidecars(relative: Path, read, size: int, mtime: float,
+                    cache: BuildCache | None) -> list[tuple[Path, str, bytes | Path]]:
+    """sidecar_payloads() through the cache: (sidecar, coding, bytes or
+    the cache object holding them). `read` returns the original's bytes."""
+    if cache is None:
+        return sidecar_payloads(relative, read())
+    payloads = []
+    for suffix, coding in sidecar_codings(relative, size):
+        sidecar = relative.with_name(relative.name + suffix)
+        stored = cache.derive(sidecar, cache.digests[relative.as_posix()] + suffix,
+                              lambda: sidecar_payload(read(), coding), mtime)
+        if stored is not None:
+            payloads.append((sidecar, coding, stored))
+    return payloads
+
+
+def cached_lite(ffmpeg: str, relative: Path, read, mtime: float,
+                cache: BuildCache | None) -> bytes | Path | None:
+    """lite_payload() through the cache."""
+    if relative.suffix not in MEDIA_VARIANT_SUFFIXES:
+        return None
+    if cache is None:
+        return lite_payload(ffmpeg, relative, read())
+    key = f"{cache.digests[relative.as_posix()]}.lite-{LITE_KEY}{relative.suffix}"
+    return cache.derive(lite_name(relative), key,
+                        lambda: lite_payload(ffmpeg, relative, read()), mtime)
+
+
+def cached_images(relative: Path, image: Path | bytes, size: int, mtime: float,
+                  formats: list[str], cache: BuildCache | None
+                  ) -> tuple[tuple[int, int] | None, list[tuple[Path, int, bytes | Path]]]:
+    """--image-variants for one file (`image` is its served bytes, or a
+    path holding them), through the cache: its pixel size, None if it gets
+    none, and (variant, width, bytes or cache object) of each kept. The
+    raster is decoded only when some variant is not in the cache."""
+    if not formats or relative.suffix not in IMAGE_VARIANT_SUFFIXES or size < IMAGE_MIN_BYTES \
+            or matches(relative.as_posix(), IMAGE_VARIANT_EXCLUDE):
+        return None, []
+    with Image.open(image if isinstance(image, Path) else io.BytesIO(image)) as opened:
+        width, height = opened.size
+        decoded = []
+
+        def make(target: int, suffix: str) -> bytes | None:
+            if not decoded:
+                decoded.append(opened.convert("RGBA" if opened.mode in ("RGBA", "LA", "PA")
+                                              or "transparency" in opened.info else "RGB"))
+            return image_payload(decoded[0], target, suffix, size)
+
+        variants = []
+        for target in [w for w in IMAGE_WIDTHS if w < width] + [width]:
+            for suffix in formats:
+                name = image_name(relative, target, suffix, target == width)
+                if cache is None:
+                    payload = make(target, suffix)
+                else:
+                    key = f"{cache.digests[relative.as_posix()]}.{target}w-{IMAGE_KEY}{suffix}"
+                    payload = cache.derive(name, key, lambda t=target, x=suffix: make(t, x), mtime)
+                if payload is not None:
+                    variants.append((name, target, payload))
+    return (width, height), variants
+
+
+def write_payload(destination: Path, name: Path, payload: bytes | Path,
+                  source: Path, cache: BuildCache | None) -> str | None:
+    """Write derived bytes next to their original (stat copied from
+    `source`), or place the cache object holding them (returns how)."""
+    if isinstance(payload, Path):
+        return cache.place(payload, destination / name, source)
+    (destination / name).write_bytes(payload)
+    shutil.copystat(source, destination / name)
+    return None
+
+
+def rewritten(source: Path, relative: Path, origin: bytes, rewrite,
+              cache: BuildCache | None) -> tuple[bytes, str]:
+    """A file file_rewrite() changes, as served: substituted, then passed
+    through `rewrite(relative, data)`; with its sha256."""
+    if cache is None:
+        data = rewrite(relative, source.read_bytes().replace(PLACEHOLDER, origin))
+        return data, hashlib.sha256(data).hexdigest()
+    data, _ = cache.served(source, relative, origin, keep=False)
+    data = rewrite(relative, data)
+    return data, cache.rewritten(relative, data)
+
+
+def cached_minified(relative: Path, data: bytes, mtime: float,
+                    cache: BuildCache | None) -> bytes:
+    """minified() through the cache; `data` itself when it saves nothing."""
+    if cache is None:
+        packed = minified(relative, data)
+    else:
+        key = f"{cache.digests[relative.as_posix()]}.min{MINIFY_VERSION}{relative.suffix}"
+        stored = cache.derive(relative, key, lambda: minified(relative, data), mtime)
+        packed = stored.read_bytes() if stored is not None else None
+    return data if packed is None else packed
+
+
+def file_rewrite(source: Path, relative: Path, minify: bool, cache: BuildCache | None,
+                 rewrite) -> tuple[object, bool]:
+    """Everything one file's substituted bytes go through: faststart() for
+    an mp4 with its moov behind its mdat, --minify, then `rewrite`
+    (--fingerprint's references); None for none of them. And whether the
+    moov moved."""
+    steps = []
+    moved = relative.suffix in FASTSTART_SUFFIXES and not source_moov_first(source, relative)
+    if moved:
+        steps.append(faststart)
+    if minify and minifiable(relative):
+        mtime = source.stat().st_mtime
+        steps.append(lambda relative, data: cached_minified(relative, data, mtime, cache))
+    if rewrite is not None:
+        steps.append(rewrite)
+    if not steps:
+        return None, moved
+
+    def run(relative: Path, data: bytes) -> bytes:
+        for step in steps:
+            data = step(relative, data)
+        return data
+
+    return run, moved
+
+
+class Packaged(NamedTuple):
+    """One allowlisted file through the pipeline."""
+    relative: Path
+    written: Written
+    sidecars: list[tuple[Path, str]]         # (sidecar, coding)
+    lite: bool
+    moved: bool                              # faststart() moved its moov
+    pixels: tuple[int, int] | None           # --image-variants: width, height
+    images: list[tuple[Path, int]]           # (variant, width)
+    placed: list[str]                        # how cache objects were placed
+    blobs: list[tuple[Path, bytes, float]]   # --pack: (name, bytes, mtime)
+
+
+def package_file(destination: Path, source: Path, relative: Path, origin: bytes,
+                 with_sidecars: bool, ffmpeg: str | None, formats: list[str], minify: bool,
+                 cache: BuildCache | None, rewrite=None) -> Packaged:
+    """Copy one file into the tree artifact, then write its sidecars (from
+    the bytes already in hand), lite variant (ffmpeg reads the copy) and
+    image variants (Pillow reads it too)."""
+    rewrite, moved = file_rewrite(source, relative, minify, cache, rewrite)
+    target = destination / relative
+    target.parent.mkdir(parents=True, exist_ok=True)
+    name, placed = relative.as_posix(), []
+    if rewrite is not None:
+        data, sha = rewritten(source, relative, origin, rewrite, cache)
+        target.write_bytes(data)
+        shutil.copystat(source, target)
+        written = Written(len(data), sha, PLACEHOLDER in data)
+    elif cache is None:
+        written, data = substitute_stream(source, target, origin,
+                                          keep=with_sidecars and relative.suffix in COMPRESSIBLE)
+    else:
+        data, stored = cache.served(source, relative, origin)
+        if stored is None:
+            target.write_bytes(data)
+            shutil.copystat(source, target)
+            written = Written(len(data), cache.digests[name], PLACEHOLDER in data)
+        else:
+            placed.append(cache.place(stored, target, source))
+            written = Written(target.stat().st_size, cache.digests[name], False)
+    mtime = target.stat().st_mtime
+    sidecars = []
+    if with_sidecars:
+        for sidecar, coding, payload in cached_sidecars(
+                relative, lambda: data if data is not None else target.read_bytes(),
+                written.size, mtime, cache):
+            placed.append(write_payload(destination, sidecar, payload, target, cache))
+            sidecars.append((sidecar, coding))
+    lite = cached_lite(ffmpeg, relative, lambda: target, mtime, cache) if ffmpeg else None
+    if lite is not None:
+        placed.append(write_payload(destination, lite_name(relative), lite, target, cache))
+    pixels, images = cached_images(relative, target, written.size, mtime, formats, cache)
+    for name, _, payload in images:
+        placed.append(write_payload(destination, name, payload, target, cache))
+    return Packaged(relative, written, sidecars, lite is not None, moved, pixels,
+                    [(name, width) for name, width, _ in images],
+                    [kind for kind in placed if kind], [])
+
+
+def pack_file(source: Path, relative: Path, origin: bytes, with_sidecars: bool,
+              ffmpeg: str | None, formats: list[str], minify: bool,
+              cache: BuildCache | None, rewrite=None) -> Packaged:
+    """One file's blobs for the pack: its substituted bytes, sidecars, lite
+    variant and image variants, from a single read of the source (after
+    the mp4 box headers)."""
+    rewrite, moved = file_rewrite(source, relative, minify, cache, rewrite)
+    if rewrite is not None:
+        data, sha = rewritten(source, relative, origin, rewrite, cache)
+    elif cache is None:
+        data = source.read_bytes().replace(PLACEHOLDER, origin)
+        sha = hashlib.sha256(data).hexdigest()
+    else:
+        data, _ = cache.served(source, relative, origin, keep=False)
+        sha = cache.digests[relative.as_posix()]
+    mtime = source.stat().st_mtime
+    blobs = [(relative, data, mtime)]
+
+    def payload(stored: bytes | Path) -> bytes:
+        return stored.read_bytes() if isinstance(stored, Path) else stored
+
+    lite = cached_lite(ffmpeg, relative, lambda: data, mtime, cache) if ffmpeg else None
+    if lite is not None:
+        blobs.append((lite_name(relative), payload(lite), mtime))
+    sidecars = []
+    if with_sidecars:
+        for sidecar, coding, packed in cached_sidecars(relative, lambda: data,
+                                                       len(data), mtime, cache):
+            blobs.append((sidecar, payload(packed), mtime))
+            sidecars.append((sidecar, coding))
+    pixels, images = cached_images(relative, data, len(data), mtime, formats, cache)
+    for name, _, stored in images:
+        blobs.append((name, payload(stored), mtime))
+    return Packaged(relative, Written(len(data), sha, PLACEHOLDER in data),
+                    sidecars, lite is not None, moved, pixels,
+                    [(name, width) for name, width, _ in images], [], blobs)
+
+
+def package_files(destination: Path, copied: list[tuple[Path, Path]], origin: str,
+                  packed: bool, with_sidecars: bool, ffmpeg: str | None, formats: list[str],
+                  minify: bool, cache: BuildCache | None, jobs: int,
+                  rewrite=None) -> list[Packaged]:
+    """Every allowlisted file through package_file (or pack_file), `jobs`
+    at a time, in `copied` order; `rewrite(relative, data)`, when given,
+    is applied to each file's substituted (and minified) bytes."""
+    encoded = origin.encode("utf-8")
+    with ThreadPoolExecutor(jobs) as pool:
+        if packed:
+            return list(pool.map(lambda item: pack_file(*item, encoded, with_sidecars, ffmpeg,
+                                                        formats, minify, cache, rewrite),
+                                 copied))
+        return list(pool.map(lambda item: package_file(destination, *item, encoded, with_sidecars,
+                                                       ffmpeg, formats, minify, cache, rewrite),
+                             copied))
+
+
+def rewrite_stage(relative: Path) -> int:
+    """Which REWRITE_STAGES pass --fingerprint packages a file in."""
+    if relative.suffix == ".html":
+        return 2
+    return 1 if relative.suffix == ".css" or relative.as_posix() == GEOMETRY_MANIFEST else 0
+
+
+def fingerprint_name(relative: Path, sha: str) -> Path:
+    return relative.with_name(f"{relative.stem}.{sha[:FINGERPRINT_LENGTH]}{relative.suffix}")
+
+
+def fingerprint_names(packaged: list[Packaged]) -> dict[str, str]:
+    """Posix path -> fingerprinted posix path of each FINGERPRINTED file."""
+    return {item.relative.as_posix():
+            fingerprint_name(item.relative, item.written.sha256).as_posix()
+            for item in packaged if item.relative.suffix in FINGERPRINTED}
+
+
+def fingerprint_aliases(packaged: list[Packaged]) -> dict[Path, Path]:
+    """Fingerprinted name -> original of each FINGERPRINTED file, and of
+    its sidecars and lite variant (serve.py finds those by name)."""
+    aliases = {}
+    for item in packaged:
+        if item.relative.suffix not in FINGERPRINTED:
+            continue
+        alias = fingerprint_name(item.relative, item.written.sha256)
+        aliases[alias] = item.relative
+        for sidecar, _ in item.sidecars:
+            aliases[alias.with_name(alias.name + sidecar.suffix)] = sidecar
+        if item.lite:
+            aliases[lite_name(alias)] = lite_name(item.relative)
+        for image, width in item.images:
+            if width == item.pixels[0]:
+                aliases[alias.with_name(alias.name + image.suffix)] = image
+    return aliases
+
+
+def fingerprint_url(url: str, base: str, names: dict[str, str]) -> str:
+    """`url`, written in a file under `base`, pointed at its target's
+    fingerprinted name when it is a relative reference to one of `names`;
+    a query goes with the old name (a hand-kept ?v= token is moot now)."""
+    parts = urllib.parse.urlsplit(url)
+    if parts.scheme or parts.netloc or not parts.path or parts.path.startswith("/"):
+        return url
+    target = names.get(posixpath.normpath(posixpath.join(base, parts.path)))
+    if target is None:
+        return url
+    return (parts.path[:parts.path.rfind("/") + 1] + posixpath.basename(target)
+            + (f"#{parts.fragment}" if parts.fragment else ""))
+
+
+def page_url(page_dir: str, path: str) -> str:
+    """`path` (posix, from the root) as a URL relative to a page in `page_dir`."""
+    url = posixpath.relpath(path, page_dir or ".")
+    return url if url.startswith("../") else "./" + url
+
+
+def module_graph(page: str, html: str, modules, dynamic: bool = True) -> dict[str, str]:
+    """Every module the page's scripts reach, breadth first, as serve.py's
+    preload scan walks them (without import() when not `dynamic`): import
+    map key -> module path. Relative specifiers are keyed by their URL
+    relative to the page, ?v= tokens included; bare ones go through the
+    page's own map. `modules(path)` is a module's source, None if it is not
+    served."""
+    page_dir = posixpath.dirname(page)
+    found = IMPORTMAP_RE.search(html)
+    bare = json.loads(found.group(1)).get("imports", {}) if found else {}
+    todo = []                        # (specifier, directory of its importer)
+    for _, src, inline in MODULE_SCRIPT_RE.findall(html):
+        if not src:
+            todo += [(spec, page_dir) for spec in _specifiers(inline, dynamic)]
+        elif not urllib.parse.urlsplit(src).scheme and not src.startswith("/"):
+            todo.append((src if src.startswith(("./", "../")) else "./" + src, page_dir))
+    entries, seen = {}, set()        # import map key -> module path; scanned paths
+    while todo:
+        spec, base = todo.pop(0)
+        if spec.startswith(("./", "../")):
+            parts = urllib.parse.urlsplit(spec)
+            path = posixpath.normpath(posixpath.join(base, parts.path))
+            key = page_url(page_dir, path) + (f"?{parts.query}" if parts.query else "")
+        else:
+            prefix = max((key for key in bare
+                          if spec == key or (key.endswith("/") and spec.startswith(key))),
+                         key=len, default=None)
+            if prefix is None:
+                continue
+            path = posixpath.normpath(posixpath.join(page_dir, bare[prefix] + spec[len(prefix):]))
+            key = spec
+        entries[key] = path
+        if path in seen:
+            continue
+        seen.add(path)
+        source = modules(path)
+        if source is not None:
+            todo += [(child, posixpath.dirname(path)) for child in _specifiers(source, dynamic)]
+    return entries
+
+
+def import_map(page: str, html: str, names: dict[str, str], modules) -> str:
+    """The page with an import map sending every module_graph() entry to
+    its fingerprinted name. The page's own map entries are kept, a prefix
+    entry gaining one exact entry per module reached through it."""
+    page_dir = posixpath.dirname(page)
+    found = IMPORTMAP_RE.search(html)
+    mapping = json.loads(found.group(1)) if found else {}
+    bare = mapping.get("imports", {})
+    entries = module_graph(page, html, modules)
+    imports = {}
+    for key, value in bare.items():
+        path = posixpath.normpath(posixpath.join(page_dir, value))
+        imports[key] = (page_url(page_dir, names[path])
+                        if not key.endswith("/") and path in names else value)
+    for key, path in entries.items():
+        if path in names:
+            imports[key] = page_url(page_dir, names[path])
+    if imports == bare:
+        return html
+    mapping["imports"] = imports
+    block = json.dumps(mapping, indent=2)
+    if found:
+        return html[:found.start(1)] + "\n" + block + "\n" + html[found.end(1):]
+    first = MODULE_SCRIPT_RE.search(html)
+    return (html[:first.start()]
+            + f'{first.group(1)}<script type="importmap">\n{block}\n{first.group(1)}</script>\n'
+            + html[first.start():])
+
+
+def _specifiers(code: str, dynamic: bool = True) -> list[str]:
+    return [next(group for group in groups if group)
+            for groups in IMPORT_RE.findall(COMMENT_RE.sub(" ", code))
+            if dynamic or not groups[2]]
+
+
+def rewrite_references(relative: Path, data: bytes, names: dict[str, str], modules) -> bytes:
+    """--fingerprint's rewrite of one stage-1 or stage-2 file: the geometry
+    manifest's chapter files; url() in stylesheets and pages; src/href and
+    the import map in pages."""
+    text = data.decode("utf-8")
+    base = posixpath.dirname(relative.as_posix())
+
+    def point(match: re.Match) -> str:
+        return match.group(1) + match.group(2) + fingerprint_url(match.group(3), base, names) \
+            + match.group(2) + (match.group(4) if match.re is CSS_URL_RE else "")
+
+    if relative.as_posix() == GEOMETRY_MANIFEST:
+        text = GEOMETRY_FILE_RE.sub(lambda m: m.group(1) + fingerprint_url(m.group(2), base, names)
+                                    + m.group(3), text)
+    if relative.suffix == ".html":
+        text = import_map(relative.as_posix(), text, names, modules)
+        text = HTML_REF_RE.sub(point, text)
+    if relative.suffix in (".css", ".html"):
+        text = CSS_URL_RE.sub(point, text)
+    return text.encode("utf-8")
+
+
+def image_manifest(packaged: list[Packaged]) -> bytes | None:
+    """IMAGE_MANIFEST: per original with image variants, its size and a
+    srcset per MIME type (URLs relative to the original's directory)."""
+    images = {}
+    for item in packaged:
+        if not item.images:
+            continue
+        srcset = {}
+        for suffix, (_, ctype, _) in IMAGE_FORMATS.items():
+            candidates = [f"{name.name} {width}w" for name, width in item.images
+                          if name.suffix == suffix]
+            if candidates and not any(width == item.pixels[0] for name, width in item.images
+                                      if name.suffix == suffix):
+                candidates.append(f"{item.relative.name} {item.pixels[0]}w")   # not worth it
+            if candidates:
+                srcset[ctype] = ", ".join(candidates)
+        images[item.relative.as_posix()] = {"width": item.pixels[0], "height": item.pixels[1],
+                                            "srcset": srcset}
+    if not images:
+        return None
+    return (json.dumps(images, indent=2, sort_keys=True) + "\n").encode("utf-8")
+
+
+def minify_report(sizes: dict[str, tuple[int, int]]) -> str:
+    """--minify's table: per file the bytes as authored, as shipped and
+    saved, most saved first, then the totals."""
+    rows = sorted(sizes.items(), key=lambda row: (row[1][1] - row[1][0], row[0]))
+    source = sum(before for before, _ in sizes.values())
+    shipped = sum(after for _, after in sizes.values())
+    lines = [f"{'saved':>9} {'source':>9} {'shipped':>9}  minified file"]
+    lines += [f"{before - after:>9} {before:>9} {after:>9}  {name}"
+              for name, (before, after) in rows]
+    lines.append(f"{source - shipped:>9} {source:>9} {shipped:>9}  "
+                 f"total, {len(sizes)} files ({1 - shipped / max(source, 1):.0%} saved)")
+    return "\n".join(lines)
+
+
+def critical_path(page: str, read) -> list[str]:
+    """The page's critical path (see CRITICAL_PAGE) in load order;
+    `read(path)` is a file's text, None if it is not served."""
+    html = read(page)
+    page_dir = posixpath.dirname(page)
+    paths = [page]
+    for href in STYLESHEET_RE.findall(html):
+        parts = urllib.parse.urlsplit(href)
+        if not parts.scheme and not parts.netloc and not parts.path.startswith("/"):
+            paths.append(posixpath.normpath(posixpath.join(page_dir, parts.path)))
+    modules = list(dict.fromkeys(module_graph(page, html, read, dynamic=False).values()))
+    paths += modules + _json_literals(page, modules, read)
+    return [path for path in dict.fromkeys(paths) if read(path) is not None]
+
+
+def _json_literals(page: str, modules: list[str], read) -> list[str]:
+    """The JSON files `modules` name in string literals, resolved as the
+    page's fetch() resolves them: against the page."""
+    page_dir = posixpath.dirname(page)
+    return [posixpath.normpath(posixpath.join(page_dir, literal))
+            for path in modules
+            for literal in JSON_LITERAL_RE.findall(COMMENT_RE.sub(" ", read(path) or ""))]
+
+
+def source_text(copied: list[tuple[Path, Path]]):
+    """`read(path)` for critical_path(): an allowlisted file's source text,
+    None if it is not allowlisted."""
+    sources = {relative.as_posix(): source for source, relative in copied}
+
+    def read(path: str) -> str | None:
+        return sources[path].read_text(encoding="utf-8") if path in sources else None
+
+    return read
+
+
+def size_report(revision: str, sizes: dict[str, int], names: list[str],
+                critical: list[str]) -> dict:
+    """The --report for the allowlisted `names`, given the size of every
+    file in the artifact. A critical file's transfer size is its smallest
+    sidecar's, if it has any."""
+    files = {name: sizes[name] for name in names}
+    trees, types = collections.Counter(), collections.Counter()
+    for name, size in files.items():
+        trees[name.split("/")[0] if "/" in name else "."] += size
+        types[PurePosixPath(name).suffix or "(none)"] += size
+    transfer = sum(min([files[name]] + [sizes[name + suffix] for suffix in SIDECAR_CODINGS
+                                        if name + suffix in sizes])
+                   for name in critical)
+    largest = sorted(files.items(), key=lambda item: (-item[1], item[0]))[:REPORT_LARGEST]
+    return {"revision": revision, "files": len(files), "total": sum(files.values()),
+            "trees": dict(sorted(trees.items())), "types": dict(sorted(types.items())),
+            "largest": [list(item) for item in largest],
+            "critical": {"bytes": sum(files[name] for name in critical),
+                         "transfer": transfer, "files": critical}}
+
+
+def _report_totals(report: dict) -> dict[str, int]:
+    """Every total a report budgets or tracks, by label."""
+    return {"total": report["total"], "critical path": report["critical"]["bytes"],
+            "critical path transfer": report["critical"]["transfer"],
+            **{f"{tree}/": size for tree, size in report["trees"].items()},
+            **{f"{suffix} files": size for suffix, size in report["types"].items()}}
+
+
+def budget_overruns(report: dict, budget: dict, previous: dict | None
+                    ) -> tuple[list[str], list[str]]:
+    """What `report` spends past `budget`; and what grew past its "growth"
+    allowance since `previous`."""
+    limits = {"total": budget.get("total"), "critical path": budget.get("critical"),
+              "critical path transfer": budget.get("critical_transfer"),
+              **{f"{tree}/": limit for tree, limit in budget.get("trees", {}).items()},
+              **{f"{suffix} files": limit for suffix, limit in budget.get("types", {}).items()}}
+    over = []
+    for label, size in _report_totals(report).items():
+        limit = limits.get(label)
+        if label.endswith("/") and limit is None:
+            over.append(f"{label} {size:,} bytes, and no budget")
+        elif limit is not None and size > limit:
+            over.append(f"{label} {size:,} bytes, budget {limit:,}")
+    name, size = report["largest"][0] if report["largest"] else ("", 0)
+    if budget.get("file") is not None and size > budget["file"]:
+        over.append(f"{name} {size:,} bytes, budget {budget['file']:,} per file")
+    grown, growth = [], budget.get("growth", {})
+    if previous is not None and "ratio" in growth:
+        before = _report_totals(previous)
+        for label, size in _report_totals(report).items():
+            was = before.get(label)
+            if was and size - was > max(growth.get("bytes", 0), was * growth["ratio"]):
+                grown.append(f"{label} grew {size - was:,} bytes ({size / was - 1:.0%}) "
+                             f"since {previous['revision']}")
+    return over, grown
+
+
+def format_report(report: dict, previous: dict | None) -> str:
+    """The size report as the build prints it, with changes since `previous`."""
+    before = _report_totals(previous) if previous is not None else {}
+
+    def row(label: str, size: int) -> str:
+        change = (f" {size - before[label]:>+12,}" if label in before
+                  else " {:>12}".format("new") if before else "")
+        return f"  {label:<44} {size:>12,}{change}"
+
+    totals = _report_totals(report)
+    critical = report["critical"]
+    lines = [f"size report: {report['files']} files, {report['total']:,} bytes; critical path "
+             f"{len(critical['files'])} files, {critical['bytes']:,} bytes "
+             f"({critical['transfer']:,} compressed)"
+             + (f"; changes since {previous['revision']}" if previous is not None else ""),
+             "by tree:"]
+    lines += [row(f"{tree}/", totals[f"{tree}/"]) for tree in report["trees"]]
+    lines.append("by type:")
+    lines += [row(f"{suffix} files", totals[f"{suffix} files"]) for suffix in report["types"]]
+    lines.append("largest:")
+    lines += [f"  {name:<44} {size:>12,}" for name, size in report["largest"]]
+    return "\n".join(lines)
+
+
+def precache_tiers(page: str, read, served: set[str]) -> dict[str, list[str]]:
+    """The page's "boot" and "chapters" tiers (see SERVICE_WORKER), as paths
+    in `served`; `read` as for critical_path()."""
+    boot = critical_path(page, read)
+    for path in [path for path in boot if path.endswith((".css", ".html"))]:
+        base, text = posixpath.dirname(path), read(path)
+        for match in [*HTML_REF_RE.finditer(text), *CSS_URL_RE.finditer(text)]:
+            parts = urllib.parse.urlsplit(match.group(3))
+            if not parts.scheme and not parts.netloc and not parts.path.startswith("/"):
+                boot.append(posixpath.normpath(posixpath.join(base, parts.path)))
+    modules = list(dict.fromkeys(module_graph(page, read(page), read).values()))
+    chapters = modules + _json_literals(page, modules, read)
+    geometry = read(GEOMETRY_MANIFEST)
+    if geometry is not None:
+        chapters += [posixpath.normpath(posixpath.join(posixpath.dirname(GEOMETRY_MANIFEST),
+                                                       chapter["file"]))
+                     for chapter in json.loads(geometry).get("chapters", {}).values()]
+    boot = [path for path in dict.fromkeys(boot) if path in served]
+    return {"boot": boot,
+            "chapters": [path for path in dict.fromkeys(chapters)
+                         if path in served and path not in boot]}
+
+
+def precache_manifest(revision: str, tiers: dict[str, list[str]], packaged: list[Packaged],
+                      names: dict[str, str]) -> dict:
+    """The manifest SERVICE_WORKER carries: per tier, path -> the sha256 of
+    its served bytes, and its fingerprinted name if it is in `names`."""
+    digests = {item.relative.as_posix(): item.written.sha256 for item in packaged}
+    manifest = {"revision": revision}
+    for tier, paths in tiers.items():
+        manifest[tier] = {path: {"sha256": digests[path],
+                                 **({"url": names[path]} if path in names else {})}
+                          for path in paths}
+    return manifest
+
+
+def service_worker(manifest: dict, minify: bool) -> bytes:
+    """SERVICE_WORKER_SOURCE carrying `manifest` (minified with --minify)."""
+    source = SERVICE_WORKER_SOURCE.read_text(encoding="utf-8")
+    if source.count(PRECACHE_LINE) != 1:
+        raise ValueError(f"{SERVICE_WORKER_SOURCE.name} lacks its manifest line: {PRECACHE_LINE}")
+    source = source.replace(PRECACHE_LINE, "const PRECACHE = "
+                            + json.dumps(manifest, separators=(",", ":")) + ";")
+    return (minify_js(source) if minify else source).encode("utf-8")
+
+
+def register_worker(relative: Path, data: bytes) -> bytes:
+    """CRITICAL_PAGE with a script at the end of its body that registers
+    SERVICE_WORKER once the page has loaded; any other file as it is."""
+    if relative.as_posix() != CRITICAL_PAGE:
+        return data
+    text = data.decode("utf-8")
+    end = text.rfind("</body>")
+    if end < 0:
+        raise ValueError(f"{CRITICAL_PAGE} has no </body> to register {SERVICE_WORKER} before")
+    url = page_url(posixpath.dirname(CRITICAL_PAGE), SERVICE_WORKER)
+    script = ("<script>\n"
+              "if ('serviceWorker' in navigator) {\n"
+              "  addEventListener('load', () => {\n"
+              f"    navigator.serviceWorker.register('{url}').catch(() => {{}});\n"
+              "  });\n"
+              "}\n"
+              "</script>\n")
+    return (text[:end] + script + text[end:]).encode("utf-8")
+
+
+def link_aliases(destination: Path, aliases: dict[Path, Path]) -> None:
+    """Hardlink (else copy) each fingerprinted name to its original."""
+    for alias, original in aliases.items():
+        try:
+            os.link(destination / original, destination / alias)
+        except OSError:
+            shutil.copy2(destination / original, destination / alias)
+
+
+def write_pack(destination: Path, copied: list[tuple[Path, Path]],
+               packaged: list[Packaged], revision: str,
+               aliases: dict[Path, Path] | None = None,
+               extra: list[tuple[Path, bytes, float]] = ()) -> None:
+    """Write PACK_NAME from pack_file()'s blobs and `extra` ones, plus the
+    PACK_LOOSE files; each alias is an index entry for its original's bytes."""
+    marker = (revision + "\n").encode("utf-8")
+    blobs = [blob for item in packaged for blob in item.blobs] + list(extra)
+    digests = {item.relative.as_posix(): item.written.sha256 for item in packaged}
+    blobs.append((Path(REVISION_FILE), marker, time.time()))
+    # guess_type only reads the class-level extensions_map — serve.py's types.
+    guess_type = http.server.SimpleHTTPRequestHandler.guess_type
+    files, offset = {}, 0
+    for relative, data, mtime in sorted(blobs, key=lambda blob: blob[0].as_posix()):
+        digest = digests.get(relative.as_posix()) or hashlib.sha256(data).hexdigest()
+        files[relative.as_posix()] = {
+            "offset": offset, "length": len(data),
+            "type": guess_type(http.server.SimpleHTTPRequestHandler, relative.name),
+            "etag": f'"{digest[:32]}"',
+            "mtime": mtime,
+        }
+        offset += len(data)
+    order = list(files)
+    for alias, original in (aliases or {}).items():
+        files[alias.as_posix()] = files[original.as_posix()]
+    index = json.dumps({"revision": revision, "files": files},
+                       separators=(",", ":")).encode("utf-8")
+    start = len(PACK_MAGIC) + 8 + len(index)
+    contents = {relative.as_posix(): data for relative, data, _ in blobs}
+    with open(destination / PACK_NAME, "wb") as fh:
+        fh.write(PACK_MAGIC + struct.pack("<Q", len(index)) + index)
+        fh.write(bytes(-start % PACK_ALIGN))
+        for name in order:
+            fh.write(contents[name])
+    for source, relative in copied:
+        if relative.parts[0] in PACK_LOOSE:
+            (destination / relative).parent.mkdir(parents=True, exist_ok=True)
+            (destination / relative).write_bytes(contents[relative.as_posix()])
+            shutil.copystat(source, destination / relative)
+    (destination / REVISION_FILE).write_bytes(marker)
+
+
+def read_pack(path: Path) -> dict[str, memoryview]:
+    """Posix path -> bytes of every file in a pack, as serve.py maps it."""
+    with open(path, "rb") as fh:
+        mapped = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+    if mapped[:len(PACK_MAGIC)] != PACK_MAGIC:
+        raise ValueError(f"not a public pack: {path}")
+    (length,) = struct.unpack_from("<Q", mapped, len(PACK_MAGIC))
+    start = len(PACK_MAGIC) + 8
+    files = json.loads(mapped[start:start + length])["files"]
+    base = start + length + -(start + length) % PACK_ALIGN
+    view = memoryview(mapped)
+    return {name: view[base + entry["offset"]:base + entry["offset"] + entry["length"]]
+            for name, entry in files.items()}
+
+
+def served_digest(source: Path, relative: Path, origin: bytes, minify: bool,
+                  rewrite) -> tuple[int, str]:
+    """(size, sha256) of served_bytes(), streamed through substituted()
+    when the substitution is all that applies — every large file."""
+    if rewrite is None and not minify and not (relative.suffix in FASTSTART_SUFFIXES
+                                               and not source_moov_first(source, relative)):
+        scan = StreamScan()
+        for block in substituted(source, origin):
+            scan.update(block)
+        return scan.size, scan.digest.hexdigest()
+    data = served_bytes(source, relative, origin, minify, rewrite)
+    return len(data), hashlib.sha256(data).hexdigest()
+
+
+def served_bytes(source: Path, relative: Path, origin: bytes, minify: bool, rewrite) -> bytes:
+    """What the artifact should hold for one source, recomputed for
+    verify() from the source alone (no cache, nothing the pipeline
+    recorded): substituted, faststart, minified, then `rewrite`."""
+    data = source.read_bytes().replace(PLACEHOLDER, origin)
+    if relative.suffix in FASTSTART_SUFFIXES:
+        data = faststart(relative, data)
+    if minify:
+        data = minified(relative, data) or data
+    return data if rewrite is None else rewrite(relative, data)
+
+
 def verify(destination: Path, config: dict,
-           copied: list[tuple[Path, Path]], origin: str, revision: str) -> None:
-    missing = [path for path in config["required"] if not (destination / path).is_file()]
+           copied: list[tuple[Path, Path]], written: dict[str, Written], origin: str,
+           revision: str, sidecars: list[tuple[Path, Path, str]] = (), packed: bool = False,
+           media: list[tuple[Path, Path]] = (), trusted: set[str] = frozenset(),
+           aliases: dict[Path, Path] | None = None,
+           images: list[tuple[Path, Path]] = (), minified: set[str] = frozenset(),
+           precache: dict | None = None, rewrites: dict | None = None) -> None:
+    """Check the artifact against the allowlist and against its sources:
+    every file hashes to its source recomputed by served_bytes() (with
+    `rewrites`, posix path -> the --fingerprint or --service-worker
+    rewrite it went through, and --minify for the `minified` ones),
+    sidecars decompress to that digest, media and image variants are
+    smaller files of their type, mp4s have moov first, fingerprinted
+    aliases are identical to their originals, minified JSON still parses,
+    the service worker's precache manifest names the served bytes, and no
+    file's bytes still hold ORIGIN. Paths in `trusted` (an earlier --cache
+    build verified them, and neither they nor their source changed since)
+    are only checked for presence and their recorded size."""
+    aliases, rewrites = aliases or {}, rewrites or {}
+    if packed:
+        loose = {path.name for path in destination.iterdir()}
+        if loose != {PACK_NAME, *PACK_LOOSE}:
+            raise ValueError("packed artifact holds more than its pack: " + ", ".join(sorted(loose)))
+        contents = read_pack(destination / PACK_NAME)
+        actual = set(contents)
+        on_disk = {path.relative_to(destination).as_posix()
+                   for name in PACK_LOOSE
+                   for path in (destination / name, *(destination / name).rglob("*"))
+                   if path.is_file()}
+        expected = {name for name in actual if name.split("/")[0] in PACK_LOOSE}
+        if on_disk != expected:
+            raise ValueError("loose files differ from the packed ones: "
+                             + ", ".join(sorted(on_disk ^ expected)))
+        for name in sorted(on_disk):
+            if (destination / name).read_bytes() != contents.get(name):
+                raise ValueError(f"{name} differs from its packed copy")
+
+        def read(name: str) -> bytes:
+            return bytes(contents[name])
+
+        def blocks(name: str):
+            view = contents[name]
+            for at in range(0, len(view), COPY_CHUNK):
+                yield bytes(view[at:at + COPY_CHUNK])
+    else:
+        actual = {path.relative_to(destination).as_posix()
+                  for path in destination.rglob("*") if path.is_file()}
+
+        def read(name: str) -> bytes:
+            return (destination / name).read_bytes()
+
+        def blocks(name: str):
+            with open(destination / name, "rb") as fh:
+                yield from iter(lambda: fh.read(COPY_CHUNK), b"")
+
+    missing = [path for path in config["required"] if path not in actual]
     if missing:
         raise ValueError("required public files are missing: " + ", ".join(missing))
 
-    present = {path.relative_to(destination).parts[0]
-               for path in destination.iterdir()}
+    present = ({path.name for path in destination.iterdir()}
+               | {name.split("/")[0] for name in actual})
     leaked = sorted(present.intersection(config["forbidden"]))
     if leaked:
         raise ValueError("repository-only paths entered the artifact: " + ", ".join(leaked))
 
-    check_outputs = destination / "static" / "captures" / "_check"
-    if check_outputs.exists():
+    if any(name.startswith("static/captures/_check/") for name in actual) \
+            or (destination / "static" / "captures" / "_check").exists():
         raise ValueError("capture check outputs entered the artifact")
 
-    expected = {relative.as_posix() for _, relative in copied} | {REVISION_FILE}
-    actual = {path.relative_to(destination).as_posix()
-              for path in destination.rglob("*") if path.is_file()}
+    expected = ({relative.as_posix() for _, relative in copied} | {REVISION_FILE}
+                | {sidecar.as_posix() for sidecar, _, _ in sidecars}
+                | {variant.as_posix() for variant, _ in media}
+                | {alias.as_posix() for alias in aliases}
+                | {variant.as_posix() for variant, _ in images}
+                | ({IMAGE_MANIFEST} if images else set())
+                | ({SERVICE_WORKER} if precache is not None else set()))
     unexpected = sorted(actual - expected)
     omitted = sorted(expected - actual)
     if unexpected or omitted:
@@ -78,22 +1573,145 @@ def verify(destination: Path, config: dict,
             details.append("omitted: " + ", ".join(omitted))
         raise ValueError("artifact differs from allowlist (" + "; ".join(details) + ")")
 
-    changed = []
-    for source, relative in copied:
-        expected_bytes = source.read_bytes().replace(b"ORIGIN", origin.encode("utf-8"))
-        if expected_bytes != (destination / relative).read_bytes():
-            changed.append(relative.as_posix())
+    encoded = origin.encode("utf-8")
+
+    def source_digest(item: tuple[Path, Path]) -> tuple[int, str]:
+        source, relative = item
+        name = relative.as_posix()
+        return served_digest(source, relative, encoded, name in minified, rewrites.get(name))
+
+    def scan(name: str) -> Written:
+        scanned = StreamScan()
+        for block in blocks(name):
+            scanned.update(block)
+        return scanned.written()
+
+    def size(name: str) -> int:
+        return len(contents[name]) if packed else (destination / name).stat().st_size
+
+    def head(name: str, length: int) -> bytes:
+        if packed:
+            return bytes(contents[name][:length])
+        with open(destination / name, "rb") as fh:
+            return fh.read(length)
+
+    checked = [item for item in copied if item[1].as_posix() not in trusted]
+    names = [relative.as_posix() for _, relative in checked]
+    compressed = ({sidecar.as_posix() for sidecar, _, _ in sidecars}
+                  | {variant.as_posix() for variant, _ in media}
+                  | {variant.as_posix() for variant, _ in images})
+    searched = {name for name in actual
+                if name not in compressed and name not in trusted and Path(name) not in aliases}
+    # (size, sha256) of each file as served: recomputed unless trusted. One
+    # streamed pass over each artifact file hashes it and looks for ORIGIN.
+    digests = {name: (entry.size, entry.sha256) for name, entry in written.items()}
+    with ThreadPoolExecutor(JOBS) as pool:
+        digests.update(zip(names, pool.map(source_digest, checked)))
+        scanned = sorted(searched.union(names))
+        scans = dict(zip(scanned, pool.map(scan, scanned)))
+    changed = [name for name in (relative.as_posix() for _, relative in copied)
+               if (size(name) != digests[name][0] if name in trusted
+                   else scans[name].sha256 != digests[name][1])]
     if changed:
         raise ValueError("artifact files differ from substituted sources: " + ", ".join(changed))
-    unresolved = [path.relative_to(destination).as_posix()
-                  for path in destination.rglob("*")
-                  if path.is_file() and b"ORIGIN" in path.read_bytes()]
+    stale = [sidecar.as_posix() for sidecar, original, coding in sidecars
+             if sidecar.as_posix() not in trusted
+             and hashlib.sha256(decompress(read(sidecar.as_posix()), coding)).hexdigest()
+             != digests[original.as_posix()][1]]
+    if stale:
+        raise ValueError("compressed sidecars differ from their originals: " + ", ".join(stale))
+    if packed:
+        unlike = [alias.as_posix() for alias, original in aliases.items()
+                  if contents[alias.as_posix()] != contents[original.as_posix()]]
+    else:
+        unlike = [alias.as_posix() for alias, original in aliases.items()
+                  if not os.path.samefile(destination / alias, destination / original)
+                  and not filecmp.cmp(destination / alias, destination / original, shallow=False)]
+    if unlike:
+        raise ValueError("fingerprinted names differ from their originals: " + ", ".join(unlike))
+    broken = [variant.as_posix() for variant, original in media
+              if variant.as_posix() not in trusted
+              and (head(variant.as_posix(), 8)[4:] != b"ftyp"
+                   or size(variant.as_posix()) >= digests[original.as_posix()][0])]
+    if broken:
+        raise ValueError("media variants are not smaller mp4s: " + ", ".join(broken))
+    broken = []
+    for name in sorted(minified - trusted):
+        if name.endswith(".json"):
+            try:
+                json.loads(read(name))
+            except ValueError:
+                broken.append(name)
+    if broken:
+        raise ValueError("minified JSON does not parse: " + ", ".join(broken))
+    late = [name for name in sorted(actual)
+            if Path(name).suffix in FASTSTART_SUFFIXES and name not in trusted
+            and Path(name) not in aliases
+            and not (moov_first(Path(name), contents[name]) if packed
+                     else source_moov_first(destination / name, Path(name)))]
+    if late:
+        raise ValueError("mp4s still have moov behind mdat: " + ", ".join(late))
+    signatures = {".avif": (4, b"ftypavif"), ".webp": (8, b"WEBP")}   # offset, magic
+    broken = []
+    for variant, original in images:
+        if variant.as_posix() in trusted:
+            continue
+        offset, magic = signatures[variant.suffix]
+        if head(variant.as_posix(), offset + len(magic))[offset:] != magic \
+                or size(variant.as_posix()) >= digests[original.as_posix()][0]:
+            broken.append(variant.as_posix())
+    if broken:
+        raise ValueError("image variants are not smaller images of their type: "
+                         + ", ".join(broken))
+    if precache is not None:
+        if precache["revision"] != revision \
+                or f'"revision":{json.dumps(revision)}'.encode("utf-8") not in read(SERVICE_WORKER):
+            raise ValueError(f"{SERVICE_WORKER} does not carry the requested revision")
+        stale = [name for tier in ("boot", "chapters") for name, entry in precache[tier].items()
+                 if name not in trusted
+                 and (scans[name] if name in scans else scan(name)).sha256 != entry["sha256"]]
+        if stale:
+            raise ValueError(f"{SERVICE_WORKER} would precache other bytes than are served: "
+                             + ", ".join(stale))
+    unresolved = [name for name in sorted(searched) if scans[name].unresolved]
     if unresolved:
         raise ValueError("unresolved ORIGIN placeholders: " + ", ".join(unresolved))
-    if (destination / REVISION_FILE).read_text(encoding="utf-8") != revision + "\n":
+    if read(REVISION_FILE).decode("utf-8") != revision + "\n":
         raise ValueError("release revision marker does not match requested revision")
 
 
+def check_sizes(destination: Path, packed: bool, revision: str,
+                copied: list[tuple[Path, Path]], budget_path: Path | None,
+                report_path: Path | None, baseline_path: Path | None,
+                accept_growth: bool) -> None:
+    """Print the artifact's size report with its changes since the report
+    at `baseline_path`, record it at `report_path`, and raise when it
+    overruns the budget at `budget_path` (or its growth allowance since
+    the baseline)."""
+    if packed:
+        sizes = {name: len(data) for name, data in read_pack(destination / PACK_NAME).items()}
+    else:
+        sizes = {path.relative_to(destination).as_posix(): path.stat().st_size
+                 for path in destination.rglob("*") if path.is_file()}
+    report = size_report(revision, sizes, [relative.as_posix() for _, relative in copied],
+                         critical_path(CRITICAL_PAGE, source_text(copied)))
+    previous = None
+    if baseline_path is not None:
+        previous = json.loads(baseline_path.read_text(encoding="utf-8"))
+    if report_path is not None:
+        report_path.parent.mkdir(parents=True, exist_ok=True)
+        report_path.write_text(json.dumps(report, indent=2) + "\n", encoding="utf-8")
+    print(format_report(report, previous))
+    if budget_path is None:
+        return
+    budget = json.loads(budget_path.read_text(encoding="utf-8"))
+    over, grown = budget_overruns(report, budget, None if accept_growth else previous)
+    if grown:
+        over.append("; ".join(grown) + " (--accept-growth if intended)")
+    if over:
+        raise ValueError(f"artifact exceeds {budget_path}: " + "; ".join(over))
+
+
 def main() -> int:
     parser = argparse.ArgumentParser(description=__doc__)
     parser.add_argument("destination", type=Path,
@@ -102,6 +1720,47 @@ def main() -> int:
                         help="absolute deployment origin substituted into public files")
     parser.add_argument("--revision", required=True,
                         help="opaque deployed revision written to release-revision.txt")
+    parser.add_argument("--no-sidecars", action="store_true",
+                        help="skip the precompressed .gz/.br sidecars")
+    parser.add_argument("--media-variants", action="store_true",
+                        help="also encode a lower-bitrate name.lite.mp4 per mp4 "
+                             "(needs ffmpeg) for Save-Data / slow connections")
+    parser.add_argument("--image-variants", action="store_true",
+                        help="also encode WebP (and AVIF) copies of large rasters at "
+                             "full size and narrower widths (needs Pillow), listed in "
+                             f"{IMAGE_MANIFEST}")
+    parser.add_argument("--minify", action="store_true",
+                        help="strip comments and redundant whitespace from the site's "
+                             "own .js and .css and re-serialize .json compactly")
+    parser.add_argument("--pack", action="store_true",
+                        help=f"write the files into one {PACK_NAME} for serve.py "
+                             "to mmap instead of a directory tree")
+    parser.add_argument("--fingerprint", action="store_true",
+                        help="also serve modules, stylesheets and media as name.<hash>.ext, "
+                             "which pages, stylesheets and the geometry manifest point "
+                             "at, for serve.py to cache immutable")
+    parser.add_argument("--service-worker", action="store_true",
+                        help=f"also write {SERVICE_WORKER}, registered from {CRITICAL_PAGE}: it "
+                             "precaches the page's boot files and chapters, each by "
+                             "content hash, so repeat visits boot from Cache Storage, "
+                             "one revision whole, and a deploy refetches only what changed")
+    parser.add_argument("--cache", type=Path,
+                        help="persistent build cache directory: unchanged files are "
+                             "hardlinked from it, and only changed ones re-hashed, "
+                             "re-compressed and re-verified")
+    parser.add_argument("--budget", type=Path,
+                        help="size budget JSON (deploy/public-budget.json): print the size "
+                             "report and fail when the artifact exceeds it")
+    parser.add_argument("--report", type=Path,
+                        help=f"write the size report here as JSON (to {SIZE_BASELINE} "
+                             "to move the growth baseline)")
+    parser.add_argument("--baseline", type=Path,
+                        help=f"size report to show changes since and check growth against "
+                             f"the budget's allowance ({SIZE_BASELINE})")
+    parser.add_argument("--accept-growth", action="store_true",
+                        help="report growth since the baseline without failing on it")
+    parser.add_argument("--jobs", type=int, default=JOBS,
+                        help=f"files processed at once (default: {JOBS})")
     args = parser.parse_args()
     origin = args.origin.rstrip("/")
     if not origin.startswith(("https://", "http://")):
@@ -114,18 +1773,117 @@ def main() -> int:
         raise ValueError("destination must be outside the repository")
     if destination.exists() and any(destination.iterdir()):
         raise ValueError(f"destination is not empty: {destination}")
+    cache = None
+    if args.cache is not None:
+        cache_dir = args.cache.resolve()
+        if cache_dir == ROOT or ROOT in cache_dir.parents:
+            raise ValueError("cache must be outside the repository")
+        if cache_dir == destination or destination in cache_dir.parents \
+                or cache_dir in destination.parents:
+            raise ValueError("cache and destination must not contain each other")
+        cache = BuildCache(cache_dir)
     destination.mkdir(parents=True, exist_ok=True)
 
     config = json.loads(MANIFEST.read_text(encoding="utf-8"))
     copied = selected_files(config)
-    for source, relative in copied:
-        target = destination / relative
-        target.parent.mkdir(parents=True, exist_ok=True)
-        target.write_bytes(source.read_bytes().replace(b"ORIGIN", origin.encode("utf-8")))
-        shutil.copystat(source, target)
-    (destination / REVISION_FILE).write_text(revision + "\n", encoding="utf-8")
-    verify(destination, config, copied, origin, revision)
-    print(f"public artifact: {len(copied)} files copied to {destination}")
+    ffmpeg = ffmpeg_exe() if args.media_variants else None
+    formats = image_formats() if args.image_variants else []
+    jobs = max(1, args.jobs)
+    register = register_worker if args.service_worker else (lambda relative, data: data)
+    rewrites = {}                    # posix path -> the rewrite its bytes went through
+    if args.fingerprint:
+        sources = {relative.as_posix(): source for source, relative in copied
+                   if relative.suffix == ".js"}
+
+        def modules(path: str) -> str | None:
+            return sources[path].read_text(encoding="utf-8") if path in sources else None
+
+        packaged = []
+        for stage in range(REWRITE_STAGES):
+            names = fingerprint_names(packaged)
+            staged = [item for item in copied if rewrite_stage(item[1]) == stage]
+            rewrite = ((lambda relative, data, names=names:
+                        register(relative, rewrite_references(relative, data, names, modules)))
+                       if stage else None)
+            rewrites.update((relative.as_posix(), rewrite) for _, relative in staged)
+            packaged += package_files(destination, staged, origin, args.pack,
+                                      not args.no_sidecars, ffmpeg, formats, args.minify,
+                                      cache, jobs, rewrite)
+        aliases = fingerprint_aliases(packaged)
+    else:
+        # Only the page --service-worker registers from needs rewriting.
+        page = [item for item in copied
+                if args.service_worker and item[1].as_posix() == CRITICAL_PAGE]
+        packaged = package_files(destination, [item for item in copied if item not in page],
+                                 origin, args.pack, not args.no_sidecars,
+                                 ffmpeg, formats, args.minify, cache, jobs)
+        packaged += package_files(destination, page, origin, args.pack, not args.no_sidecars,
+                                  ffmpeg, formats, args.minify, cache, jobs, register)
+        rewrites.update((relative.as_posix(), register) for _, relative in page)
+        aliases = {}
+    manifest = image_manifest(packaged)
+    precache = worker = None
+    if args.service_worker:
+        served = {item.relative.as_posix() for item in packaged
+                  if item.relative.suffix not in PRECACHE_EXCLUDE and not item.images}
+        precache = precache_manifest(
+            revision, precache_tiers(CRITICAL_PAGE, source_text(copied), served), packaged,
+            fingerprint_names(packaged) if args.fingerprint else {})
+        worker = service_worker(precache, args.minify)
+    generated = ([(Path(IMAGE_MANIFEST), manifest)] if manifest else []) \
+        + ([(Path(SERVICE_WORKER), worker)] if worker else [])
+    if args.pack:
+        write_pack(destination, copied, packaged, revision, aliases,
+                   [(name, data, time.time()) for name, data in generated])
+    else:
+        link_aliases(destination, aliases)
+        for name, data in generated:
+            (destination / name).write_bytes(data)
+        (destination / REVISION_FILE).write_text(revision + "\n", encoding="utf-8")
+    written = {item.relative.as_posix(): item.written for item in packaged}
+    sidecars = [(sidecar, item.relative, coding)
+                for item in packaged for sidecar, coding in item.sidecars]
+    media = [(lite_name(item.relative), item.relative) for item in packaged if item.lite]
+    images = [(image, item.relative) for item in packaged for image, _ in item.images]
+    mp4s = sum(item.relative.suffix in FASTSTART_SUFFIXES for item in packaged)
+    moved = sum(item.moved for item in packaged)
+    sources = {relative.as_posix(): source for source, relative in copied}
+    minified = {item.relative.as_posix(): (sources[item.relative.as_posix()].stat().st_size,
+                                           item.written.size)
+                for item in packaged if args.minify and minifiable(item.relative)}
+    placed = collections.Counter(kind for item in packaged for kind in item.placed)
+    del packaged                     # a pack's blobs: free them before verify maps it
+    try:
+        verify(destination, config, copied, written, origin, revision, sidecars,
+               packed=args.pack, media=media,
+               trusted=cache.trusted if cache is not None else frozenset(), aliases=aliases,
+               images=images, minified=set(minified), precache=precache, rewrites=rewrites)
+    except ValueError as error:
+        if cache is None:
+            raise
+        raise ValueError(f"{error} (built through --cache {cache.directory}; "
+                         "delete it to rebuild from scratch)") from error
+    if cache is not None:
+        cache.save({relative.as_posix() for _, relative in copied})
+    if minified:
+        print(minify_report(minified))
+    if args.budget is not None or args.report is not None or args.baseline is not None:
+        check_sizes(destination, args.pack, revision, copied, args.budget, args.report,
+                    args.baseline, args.accept_growth)
+    print(f"public artifact: {len(copied)} files "
+          + (f"packed into {destination / PACK_NAME}" if args.pack else f"copied to {destination}")
+          + (f", {len(sidecars)} compressed sidecars" if sidecars else "")
+          + (f", {mp4s} mp4s faststart" + (f" ({moved} with moov moved)" if moved else "")
+             if mp4s else "")
+          + (f", {len(media)} lite media variants" if media else "")
+          + (f", {len(images)} image variants ({'/'.join(s[1:] for s in formats)})"
+             if images else "")
+          + (f", {len(aliases)} fingerprinted names" if aliases else "")
+          + (f", {SERVICE_WORKER} precaching {len(precache['boot'])} boot files "
+             f"and {len(precache['chapters'])} chapter files" if precache else "")
+          + (f"; cache: {len(cache.trusted)} unchanged"
+             + "".join(f", {count} {kind}" for kind, count in sorted(placed.items()))
+             if cache is not None else ""))
     return 0
 
 
@@ -0,0 +1,157 @@
+// tools/public-sw.js — the service worker `package-public.py --service-worker`
+// ships as sw.js at the artifact root, with the precache manifest line below
+// filled in. Not loaded from the checkout: only an artifact has a manifest.
+//
+// THE MANIFEST names index.html's files in two tiers, each by the sha256 of
+// the bytes the artifact serves for it (and by its fingerprinted name too,
+// when it has one):
+//   - boot: the page, its stylesheets, its static module graph, the JSON
+//     those modules name, and the icons and fonts the page and stylesheets
+//     point at, so a repeat visit boots without touching the network.
+//   - chapters: the rest of the module graph (import()) and the baked
+//     chapter geometry.
+// BOTH tiers are in Cache Storage before this worker installs (boot first,
+// all at once; then the chapters one at a time, behind whatever the page
+// is fetching): a page this worker controls is served one revision whole,
+// however many deploys land while it is open.
+//
+// ONE CACHE PER REVISION (release-revision.txt, which is also
+// PRECACHE.revision). Installing a revision copies every entry whose hash
+// an older revision's cache already holds and fetches only the rest, so a
+// deploy costs the files it changed. The previous worker keeps serving its
+// own cache to the pages it controls until they are gone; the new one then
+// activates and deletes it.
+//
+// ONLY THE MANIFEST'S BYTES ARE SERVED. A file that cannot be stored (a
+// deploy landing mid-install) fails the install, which the browser retries
+// on a later visit. Should the browser evict a cached file, the network
+// answers for it; bytes with another hash there mean this revision is no
+// longer the deployed one, and rather than mix the two on one page the
+// worker retires: it unregisters and reloads its pages, which boot whole
+// from the network and register the deployed worker. Everything off the
+// manifest (media, which is range-served and negotiated, other pages,
+// release-revision.txt) goes to the network as before.
+
+// package-public.py replaces this line with the artifact's manifest.
+const PRECACHE = { revision: '', boot: {}, chapters: {} };
+
+const SCOPE = new URL(self.registration.scope);
+const PREFIX = `precache ${SCOPE.pathname} `;
+const CACHE = PREFIX + PRECACHE.revision;
+
+// Path under the scope -> entry ({ path, sha256, url? }); a fingerprinted
+// name finds the same entry as its original.
+const ENTRIES = new Map();
+for (const tier of ['boot', 'chapters']) {
+  for (const [path, { sha256, url }] of Object.entries(PRECACHE[tier])) {
+    const entry = { path, sha256, url };
+    ENTRIES.set(path, entry);
+    if (url) ENTRIES.set(url, entry);
+  }
+}
+const tierOf = (tier) => Object.keys(PRECACHE[tier]).map((path) => ENTRIES.get(path));
+
+// The Cache Storage key: the path with its hash, so any revision's cache
+// holding the same bytes answers for it.
+const keyOf = (entry) => new URL(`${entry.path}?sha256=${entry.sha256}`, SCOPE).href;
+
+function lookup(url) {
+  const { origin, pathname } = new URL(url);
+  if (origin !== SCOPE.origin || !pathname.startsWith(SCOPE.pathname)) return null;
+  let path = decodeURIComponent(pathname.slice(SCOPE.pathname.length));
+  if (path === '' || path.endsWith('/')) path += 'index.html';
+  return ENTRIES.get(path) || null;
+}
+
+async function sha256(buffer) {
+  const digest = new Uint8Array(await crypto.subtle.digest('SHA-256', buffer));
+  return Array.from(digest, (byte) => byte.toString(16).padStart(2, '0')).join('');
+}
+
+// What to cache for entry from `response`; null for an error, a redirect or
+// bytes other than the manifest's. The body is already decoded, so its
+// transfer headers no longer describe it.
+async function verified(entry, response) {
+  if (!response.ok || response.redirected || response.type !== 'basic') return null;
+  const body = await response.arrayBuffer();
+  if (await sha256(body) !== entry.sha256) return null;
+  const headers = new Headers(response.headers);
+  headers.delete('Content-Encoding');
+  headers.delete('Content-Length');
+  return new Response(body, { status: response.status, statusText: response.statusText, headers });
+}
+
+// Put entry in `cache` from whichever cache holds its bytes, else from the
+// network. Resolves whether it is cached.
+async function store(cache, entry) {
+  const key = keyOf(entry);
+  const held = await caches.match(key);
+  if (held) {
+    await cache.put(key, held);
+    return true;
+  }
+  // A fingerprinted name is immutable: the HTTP cache may answer for it.
+  const response = await fetch(new URL(entry.url || entry.path, SCOPE),
+    { cache: entry.url ? 'default' : 'no-cache' });
+  const copy = await verified(entry, response);
+  if (copy) await cache.put(key, copy);
+  return copy !== null;
+}
+
+self.addEventListener('install', (event) => {
+  event.waitUntil((async () => {
+    const cache = await caches.open(CACHE);
+    const stored = await Promise.all(tierOf('boot').map((entry) => store(cache, entry)));
+    for (const entry of tierOf('chapters')) {
+      if (stored.includes(false)) break;
+      stored.push(await store(cache, entry));
+    }
+    if (stored.includes(false)) {
+      throw new Error(`precache ${PRECACHE.revision}: files differ from the manifest`);
+    }
+  })());
+});
+
+self.addEventListener('activate', (event) => {
+  event.waitUntil((async () => {
+    for (const name of await caches.keys()) {
+      if (name.startsWith(PREFIX) && name !== CACHE) await caches.delete(name);
+    }
+    await self.clients.claim();
+  })());
+});
+
+// Another revision is deployed and this cache can no longer serve its own
+// whole: stop intercepting, and reload every page this worker controls.
+async function retire() {
+  await self.registration.unregister();
+  for (const client of await self.clients.matchAll({ type: 'window' })) {
+    client.navigate(client.url).catch(() => {});
+  }
+}
+
+async function respond(event, entry) {
+  const cache = await caches.open(CACHE);
+  const held = await cache.match(keyOf(entry));
+  if (held) return held;
+  // Evicted: the network's bytes, if they are still this revision's.
+  const response = await fetch(event.request);
+  if (!response.ok || response.redirected || response.type !== 'basic') return response;
+  const copy = await verified(entry, response);
+  if (copy) {
+    event.waitUntil(cache.put(keyOf(entry), copy.clone()));
+    return copy;
+  }
+  await retire();
+  // A page load starts over outside this worker; a subresource fails, and
+  // its page is being reloaded.
+  return event.request.mode === 'navigate' ? Response.redirect(event.request.url, 303)
+    : Response.error();
+}
+
+self.addEventListener('fetch', (event) => {
+  const { request } = event;
+  if (request.method !== 'GET' || request.headers.has('Range')) return;
+  const entry = lookup(request.url);
+  if (entry) event.respondWith(respond(event, entry));
+});
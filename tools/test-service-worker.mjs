@@ -0,0 +1,152 @@
+import assert from 'node:assert/strict';
+import { createHash } from 'node:crypto';
+import { readFile } from 'node:fs/promises';
+import { dirname, resolve } from 'node:path';
+import { fileURLToPath } from 'node:url';
+import vm from 'node:vm';
+
+// tools/public-sw.js with a manifest filled in, as package-public.py
+// --service-worker writes it, run against in-memory Cache Storage and a
+// network whose files can change under it.
+const root = resolve(dirname(fileURLToPath(import.meta.url)), '..');
+const PRECACHE_LINE = "const PRECACHE = { revision: '', boot: {}, chapters: {} };";
+const template = await readFile(resolve(root, 'tools/public-sw.js'), 'utf8');
+assert.equal(template.split(PRECACHE_LINE).length, 2, 'public-sw.js keeps its manifest line');
+
+const sha256 = (text) => createHash('sha256').update(text).digest('hex');
+const SITE = { 'index.html': 'page', 'main.js': 'main', 'journey/chapter.js': 'chapter',
+  'static/geom/final.bin': 'geometry' };
+const manifest = {
+  revision: 'r1',
+  boot: {
+    'index.html': { sha256: sha256('page') },
+    'main.js': { sha256: sha256('main'), url: 'main.0123456789ab.js' },
+  },
+  chapters: {
+    'journey/chapter.js': { sha256: sha256('chapter') },
+    'static/geom/final.bin': { sha256: sha256('geometry') },
+  },
+};
+const source = template.replace(PRECACHE_LINE, `const PRECACHE = ${JSON.stringify(manifest)};`);
+const SCOPE = 'https://site.test/';
+const CACHE = 'precache / r1';
+
+// A worker global scope of its own: `network` maps paths to bodies (a
+// fingerprinted name answers with its original's) and may be edited.
+function worker(network) {
+  const stores = new Map();
+  const listeners = {};
+  const seen = { fetched: [], unregistered: false, navigated: [] };
+  const store = (name) => {
+    if (!stores.has(name)) stores.set(name, new Map());
+    const entries = stores.get(name);
+    return {
+      match: async (key) => entries.get(key)?.clone(),
+      put: async (key, response) => { entries.set(key, response.clone()); },
+    };
+  };
+  const caches = {
+    open: async (name) => store(name),
+    match: async (key) => [...stores.values()].find((entries) => entries.has(key))?.get(key).clone(),
+    keys: async () => [...stores.keys()],
+    delete: async (name) => stores.delete(name),
+  };
+  const fetch = async (input) => {
+    let path = new URL(input.url ?? input).pathname.slice(1) || 'index.html';
+    seen.fetched.push(path);
+    path = path.replace(/\.[0-9a-f]{12}(\.[a-z]+)$/, '$1');
+    if (!(path in network)) return new Response('not found', { status: 404 });
+    const response = new Response(network[path]);
+    Object.defineProperty(response, 'type', { value: 'basic' });
+    return response;
+  };
+  const self = {
+    registration: {
+      scope: SCOPE,
+      unregister: async () => { seen.unregistered = true; return true; },
+    },
+    clients: {
+      claim: async () => {},
+      matchAll: async () => [{ url: SCOPE, navigate: async (url) => seen.navigated.push(url) }],
+    },
+    addEventListener: (type, listener) => { listeners[type] = listener; },
+  };
+  vm.runInContext(source, vm.createContext({
+    self, caches, fetch, crypto: globalThis.crypto, Response, Headers, URL, decodeURIComponent,
+  }));
+  const dispatch = (type, fields = {}) => {
+    const event = { ...fields, waited: [] };
+    event.waitUntil = (promise) => { event.waited.push(promise); };
+    event.respondWith = (promise) => { event.response = promise; };
+    listeners[type](event);
+    return event;
+  };
+  const request = (path, mode = 'no-cors') => ({
+    url: SCOPE + path, method: 'GET', mode, headers: new Headers(),
+  });
+  const get = (path, mode) => dispatch('fetch', { request: request(path, mode) });
+  const install = () => Promise.all(dispatch('install').waited);
+  return { stores, seen, get, install };
+}
+
+// Installing stores both tiers; the worker then answers without the network,
+// for a fingerprinted name too.
+{
+  const sw = worker({ ...SITE });
+  await sw.install();
+  assert.equal(sw.stores.get(CACHE).size, 4);
+  assert.ok(sw.seen.fetched.includes('main.0123456789ab.js'), 'fetched by its immutable name');
+  sw.seen.fetched.length = 0;
+  assert.equal(await (await sw.get('static/geom/final.bin').response).text(), 'geometry');
+  assert.equal(await (await sw.get('main.0123456789ab.js').response).text(), 'main');
+  assert.equal(await (await sw.get('', 'navigate').response).text(), 'page');
+  assert.deepEqual(sw.seen.fetched, []);
+}
+
+// A file served with other bytes than the manifest's fails the install.
+{
+  const sw = worker({ ...SITE, 'journey/chapter.js': 'next revision' });
+  await assert.rejects(sw.install(), /r1: files differ from the manifest/);
+}
+
+// Evicted while this revision is still deployed: fetched, checked, cached again.
+{
+  const sw = worker({ ...SITE });
+  await sw.install();
+  sw.stores.get(CACHE).clear();
+  const event = sw.get('journey/chapter.js');
+  assert.equal(await (await event.response).text(), 'chapter');
+  await Promise.all(event.waited);
+  assert.equal(sw.stores.get(CACHE).size, 1);
+  assert.equal(sw.seen.unregistered, false);
+}
+
+// Evicted after another revision was deployed: the network's hash differs,
+// so the worker retires rather than mix revisions on one page.
+{
+  const network = { ...SITE };
+  const sw = worker(network);
+  await sw.install();
+  sw.stores.get(CACHE).clear();
+  Object.assign(network, { 'index.html': 'page v2', 'main.js': 'main v2' });
+  const failed = await sw.get('main.js').response;
+  assert.equal(failed.type, 'error', 'a subresource fails; its page is being reloaded');
+  assert.equal(sw.seen.unregistered, true);
+  assert.deepEqual(sw.seen.navigated, [SCOPE]);
+  const navigation = await sw.get('', 'navigate').response;
+  assert.equal(navigation.status, 303);
+  assert.equal(navigation.headers.get('Location'), SCOPE);
+}
+
+// A 404 from the network passes through and does not retire the worker.
+{
+  const network = { ...SITE };
+  const sw = worker(network);
+  await sw.install();
+  sw.stores.get(CACHE).clear();
+  delete network['static/geom/final.bin'];
+  assert.equal((await sw.get('static/geom/final.bin').response).status, 404);
+  assert.equal(sw.seen.unregistered, false);
+}
+
+console.log('service worker precache, eviction and retirement: PASS');
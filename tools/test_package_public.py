@@ -0,0 +1,404 @@
+"""test_package_public.py — the pure parts of tools/package-public.py.
+
+NOT shipped: tools/ is forbidden in the artifact. Run: python3 -m pytest -q tools
+"""
+import importlib.util
+import json
+import struct
+import sys
+from pathlib import Path
+
+import pytest
+
+SPEC = importlib.util.spec_from_file_location(
+    "package_public", Path(__file__).resolve().parent / "package-public.py")
+pp = importlib.util.module_from_spec(SPEC)
+sys.modules[SPEC.name] = pp
+SPEC.loader.exec_module(pp)
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from serving import preload  # noqa: E402
+
+
+# budget_overruns / check_sizes -----------------------------------------------
+
+def report(total: int, trees: dict[str, int], largest: int = 10,
+           revision: str = "new") -> dict:
+    return {"revision": revision, "files": 3, "total": total, "trees": trees,
+            "types": {".js": total}, "largest": [["a.js", largest]],
+            "critical": {"bytes": 100, "transfer": 40, "files": ["a.js"]}}
+
+
+BUDGET = {"total": 1000, "file": 500, "critical": 200, "critical_transfer": 50,
+          "trees": {".": 400, "journey": 600}, "types": {".js": 1000},
+          "growth": {"ratio": 0.05, "bytes": 20}}
+
+
+def test_budget_overruns_within_budget():
+    assert pp.budget_overruns(report(900, {".": 300, "journey": 600}), BUDGET, None) == ([], [])
+
+
+def test_budget_overruns_names_every_overrun():
+    over, grown = pp.budget_overruns(
+        report(1200, {".": 450, "journey": 600, "new": 150}, largest=600), BUDGET, None)
+    assert grown == []
+    assert over == ["total 1,200 bytes, budget 1,000", "./ 450 bytes, budget 400",
+                    "new/ 150 bytes, and no budget", ".js files 1,200 bytes, budget 1,000",
+                    "a.js 600 bytes, budget 500 per file"]
+
+
+def test_budget_overruns_growth_allowance_is_the_larger_of_ratio_and_bytes():
+    previous = report(800, {".": 200, "journey": 600}, revision="old")
+    # ./ +20 bytes is inside the 20-byte floor; journey/ +31 is past 5% of 600.
+    over, grown = pp.budget_overruns(report(851, {".": 220, "journey": 631}), BUDGET, previous)
+    assert over == ["journey/ 631 bytes, budget 600"]
+    assert grown == ["total grew 51 bytes (6%) since old",
+                     "journey/ grew 31 bytes (5%) since old",
+                     ".js files grew 51 bytes (6%) since old"]
+    assert pp.budget_overruns(report(851, {".": 220, "journey": 631}),
+                              {**BUDGET, "growth": {}}, previous)[1] == []
+
+
+def test_check_sizes_measures_growth_from_the_baseline(tmp_path, capsys):
+    site = tmp_path / "site"
+    site.mkdir()
+    (site / "index.html").write_bytes(b"<!doctype html>")
+    (site / "a.js").write_bytes(b"x" * 1000)
+    copied = [(site / name, Path(name)) for name in ("a.js", "index.html")]
+    budget = tmp_path / "budget.json"
+    budget.write_text(json.dumps({"total": 10_000, "trees": {".": 10_000},
+                                  "growth": {"ratio": 0.05, "bytes": 20}}))
+    baseline = tmp_path / "baseline.json"
+    pp.check_sizes(site, False, "old", copied, budget, baseline, None, False)
+    (site / "a.js").write_bytes(b"x" * 1100)
+    with pytest.raises(ValueError, match="total grew 100 bytes .* since old"):
+        pp.check_sizes(site, False, "new", copied, budget, tmp_path / "r.json", baseline, False)
+    assert json.loads((tmp_path / "r.json").read_text())["total"] == 1115
+    assert json.loads(baseline.read_text())["revision"] == "old"      # never rotated
+    pp.check_sizes(site, False, "new", copied, budget, None, baseline, True)
+    assert "changes since old" in capsys.readouterr().out
+
+
+# module graph ----------------------------------------------------------------
+
+@pytest.mark.parametrize("name", ["IMPORT_RE", "COMMENT_RE", "JSON_LITERAL_RE"])
+def test_module_graph_patterns_match_the_server(name):
+    """The packager walks the module graph serving/preload.py hints, with
+    its own copy of the patterns (it does not import the server)."""
+    ours, served = getattr(pp, name), getattr(preload, name)
+    assert (ours.pattern, ours.flags) == (served.pattern, served.flags)
+
+
+# mp4_boxes / faststart ------------------------------------------------------
+
+def box(kind: bytes, body: bytes) -> bytes:
+    return struct.pack(">I4s", 8 + len(body), kind) + body
+
+
+def offsets_box(kind: bytes, offsets: list[int]) -> bytes:
+    fmt = ">Q" if kind == b"co64" else ">I"
+    return box(kind, bytes(4) + struct.pack(">I", len(offsets))
+               + b"".join(struct.pack(fmt, offset) for offset in offsets))
+
+
+def moov_last_mp4(kind: bytes) -> tuple[bytes, list[int]]:
+    """ftyp, mdat, moov: a chunk table of `kind` pointing into the mdat."""
+    ftyp = box(b"ftyp", b"isom" + bytes(4))
+    payload = bytes(range(256)) * 4
+    mdat = box(b"mdat", payload)
+    chunks = [len(ftyp) + 8 + at for at in (0, 100, 700)]
+    table = offsets_box(kind, chunks)
+    moov = box(b"moov", box(b"mvhd", bytes(20)) + box(b"trak", box(b"mdia", box(
+        b"minf", box(b"stbl", box(b"stsd", bytes(8)) + table)))))
+    return ftyp + mdat + moov, chunks
+
+
+def chunk_offsets(data: bytes, kind: bytes) -> list[int]:
+    at = data.index(kind) - 4
+    width, fmt = (8, ">Q") if kind == b"co64" else (4, ">I")
+    (count,) = struct.unpack_from(">I", data, at + 12)
+    return [struct.unpack_from(fmt, data, at + 16 + n * width)[0] for n in range(count)]
+
+
+def test_mp4_boxes_tiles_the_file_and_reads_64_bit_sizes():
+    big = struct.pack(">I4sQ", 1, b"mdat", 16 + 3) + b"abc"
+    data = box(b"ftyp", b"isom") + big + box(b"moov", b"")
+    assert pp.mp4_boxes(data) == [(b"ftyp", 0, 12), (b"mdat", 12, 31), (b"moov", 31, 39)]
+    assert pp.mp4_boxes(box(b"free", b"") + struct.pack(">I4s", 0, b"mdat") + b"tail") \
+        == [(b"free", 0, 8), (b"mdat", 8, 20)]
+
+
+@pytest.mark.parametrize("data", [b"\0\0\0", struct.pack(">I4s", 99, b"mdat") + b"x"])
+def test_mp4_boxes_refuses_truncated_boxes(data):
+    with pytest.raises(ValueError):
+        pp.mp4_boxes(data)
+
+
+@pytest.mark.parametrize("kind", [b"stco", b"co64"])
+def test_faststart_moves_moov_and_shifts_chunk_offsets(kind):
+    data, chunks = moov_last_mp4(kind)
+    moved = pp.faststart(Path("clip.mp4"), data)
+    assert [k for k, _, _ in pp.mp4_boxes(moved)] == [b"ftyp", b"moov", b"mdat"]
+    assert len(moved) == len(data)
+    shift = len(data) - data.index(b"moov") + 4
+    assert chunk_offsets(moved, kind) == [offset + shift for offset in chunks]
+    for before, after in zip(chunks, chunk_offsets(moved, kind)):
+        assert moved[after:after + 16] == data[before:before + 16]
+    assert pp.faststart(Path("clip.mp4"), moved) is moved
+
+
+def test_faststart_refuses_a_chunk_table_that_overruns_its_box():
+    data, _ = moov_last_mp4(b"stco")
+    at = data.index(b"stco") + 8                 # the entry count
+    data = data[:at] + struct.pack(">I", 1000) + data[at + 4:]
+    with pytest.raises(ValueError, match="cannot move moov"):
+        pp.faststart(Path("clip.mp4"), data)
+
+
+# minify_js: regex literal or division ---------------------------------------
+
+@pytest.mark.parametrize("source, expected", [
+    ("const a = b / c / d;", "const a=b/c/d;"),
+    ("const r = /ab+c/g.test(s);", "const r=/ab+c/g.test(s);"),
+    ("if (x) return /\"/.test(s);", "if(x)return/\"/.test(s);"),
+    ("f(a) / 2 / g[0]", "f(a)/2/g[0]"),
+    ("s.split(/[/'\"]/)", "s.split(/[/'\"]/)"),
+    ("const u = 'a // b'; // note", "const u='a // b';"),
+    ("x = a\n/ 2", "x=a\n/2"),
+    ("x = a.return / 2 / b", "x=a.return/2/b"),          # a keyword as a property divides
+    ("x = a. return / 2 / b", "x=a.return/2/b"),
+    ("x = a?.typeof / 2 / b", "x=a?.typeof/2/b"),
+    ("x = i++ / 2 / j", "x=i++/2/j"),                    # so does a postfix operator
+    ("x = i-- / 2 / j", "x=i--/2/j"),
+    ("x = a + /b c/.source", "x=a+/b c/.source"),
+    ("if (ok) return /a b/.test(s)", "if(ok)return/a b/.test(s)"),
+])
+def test_minify_js_tells_regex_literals_from_division(source, expected):
+    assert pp.minify_js(source) == expected
+
+
+def test_minify_js_keeps_license_comments_and_asi_line_breaks():
+    assert pp.minify_js("/*! keep */\nlet a = 1\nlet b = 2") == "/*! keep */\nlet a=1\nlet b=2"
+
+
+# BuildCache ------------------------------------------------------------------
+
+def cached_build(directory: Path, source: Path) -> "pp.BuildCache":
+    cache = pp.BuildCache(directory)
+    assert cache.served(source, Path("a.js"), b"https://example.org")[0] is None
+    cache.save({"a.js"})
+    return cache
+
+
+def test_build_cache_trusts_only_an_unchanged_source(tmp_path):
+    source = tmp_path / "a.js"
+    source.write_bytes(b"let a = 1;")
+    first = cached_build(tmp_path / "cache", source)
+    assert "a.js" not in first.trusted
+    assert "a.js" in cached_build(tmp_path / "cache", source).trusted
+
+
+def test_build_cache_sees_a_same_size_edit_with_its_mtime_put_back(tmp_path):
+    source = tmp_path / "a.js"
+    source.write_bytes(b"let a = 1;")
+    cached_build(tmp_path / "cache", source)
+    st = source.stat()
+    source.write_bytes(b"let a = 2;")
+    pp.os.utime(source, ns=(st.st_atime_ns, st.st_mtime_ns))
+    assert source.stat().st_size == st.st_size
+    again = cached_build(tmp_path / "cache", source)
+    assert "a.js" not in again.trusted
+    assert again.digests["a.js"] == pp.hashlib.sha256(b"let a = 2;").hexdigest()
+
+
+# substitute_stream ----------------------------------------------------------
+
+@pytest.mark.parametrize("source, origin", [
+    (b"<a href=\"ORIGIN/\">ORIGIN</a>ORIGINORIGIN", b"https://example.org"),
+    (b"ORIGININ", b"ORIG"),            # the substitution spells ORIGIN again
+    (b"ORIORIGIN ORIGI", b"x"),        # a prefix that is not a match
+    (b"no placeholder here", b"https://example.org"),
+])
+@pytest.mark.parametrize("chunk", [1, 2, 3, 5, 6, 7, 64])
+def test_substitute_stream_across_chunk_boundaries(tmp_path, monkeypatch, source, origin, chunk):
+    monkeypatch.setattr(pp, "COPY_CHUNK", chunk)
+    (tmp_path / "in").write_bytes(source)
+    written, kept = pp.substitute_stream(tmp_path / "in", tmp_path / "out", origin, keep=True)
+    expected = source.replace(pp.PLACEHOLDER, origin)
+    assert (tmp_path / "out").read_bytes() == expected == kept
+    assert written.size == len(expected)
+    assert written.sha256 == pp.hashlib.sha256(expected).hexdigest()
+    assert written.unresolved == (pp.PLACEHOLDER in expected)
+
+
+# fingerprint -----------------------------------------------------------------
+
+NAMES = {"journey/app.js": "journey/app.0123456789ab.js",
+         "journey/lib/x.js": "journey/lib/x.00000000000a.js",
+         "journey/style.css": "journey/style.00000000000c.css",
+         "assets/a.png": "assets/a.00000000000b.png",
+         "vendor/three/three.module.js": "vendor/three/three.module.00000000000d.js"}
+SOURCES = {"journey/app.js": 'import * as THREE from "three";\nimport { x } from "./lib/x.js";\n',
+           "journey/lib/x.js": "export const x = 1;\n"}
+
+
+@pytest.mark.parametrize("url, rewritten", [
+    ("app.js?v=7", "app.0123456789ab.js"),                 # the hand-kept token goes
+    ("./lib/x.js#top", "./lib/x.00000000000a.js#top"),
+    ("../assets/a.png", "../assets/a.00000000000b.png"),
+    ("/journey/app.js", "/journey/app.js"),                # root-relative: left alone
+    ("https://cdn.example/app.js", "https://cdn.example/app.js"),
+    ("other.js", "other.js"),
+])
+def test_fingerprint_url(url, rewritten):
+    assert pp.fingerprint_url(url, "journey", NAMES) == rewritten
+
+
+def test_rewrite_references_page_and_import_map():
+    page = ('<link rel="stylesheet" href="style.css?v=2">\n'
+            '<script type="importmap">{"imports": {"three": "../vendor/three/three.module.js", '
+            '"three/addons/": "../vendor/three/addons/"}}</script>\n'
+            '<script type="module">import "./app.js?v=3";</script>\n')
+    out = pp.rewrite_references(Path("journey/index.html"), page.encode(), NAMES,
+                                SOURCES.get).decode()
+    assert 'href="style.00000000000c.css"' in out
+    imports = json.loads(pp.IMPORTMAP_RE.search(out).group(1))["imports"]
+    assert imports == {
+        "three": "../vendor/three/three.module.00000000000d.js",   # bare, through the map
+        "three/addons/": "../vendor/three/addons/",                # a prefix is kept
+        "./app.js?v=3": "./app.0123456789ab.js",                   # the ?v= import
+        "./lib/x.js": "./lib/x.00000000000a.js",                   # reached from app.js
+    }
+    assert 'import "./app.js?v=3"' in out          # the map, not the script, redirects it
+
+
+def test_rewrite_references_css_url():
+    css = b"a{background:url('../assets/a.png')}b{background:url( ../assets/a.png )}" \
+          b"c{background:url(https://cdn.example/a.png)}"
+    out = pp.rewrite_references(Path("journey/style.css"), css, NAMES, SOURCES.get)
+    assert out == (b"a{background:url('../assets/a.00000000000b.png')}"
+                   b"b{background:url( ../assets/a.00000000000b.png )}"
+                   b"c{background:url(https://cdn.example/a.png)}")
+
+
+def test_fingerprint_aliases_are_identical_to_their_originals(tmp_path):
+    data = b"export const x = 1;\n"
+    (tmp_path / "x.js").write_bytes(data)
+    (tmp_path / "x.js.gz").write_bytes(pp.compress(data, "gzip"))
+    sha = pp.hashlib.sha256(data).hexdigest()
+    item = pp.Packaged(Path("x.js"), pp.Written(len(data), sha, False),
+                       [(Path("x.js.gz"), "gzip")], False, False, None, [], [], [])
+    aliases = pp.fingerprint_aliases([item])
+    assert aliases == {Path(f"x.{sha[:12]}.js"): Path("x.js"),
+                       Path(f"x.{sha[:12]}.js.gz"): Path("x.js.gz")}
+    pp.link_aliases(tmp_path, aliases)
+    for alias, original in aliases.items():
+        assert (tmp_path / alias).read_bytes() == (tmp_path / original).read_bytes()
+
+
+# verify ----------------------------------------------------------------------
+
+def verified_tree(tmp_path: Path, served: bytes, recorded: bytes | None = None,
+                  trusted: set[str] = frozenset(), origin: str = "https://example.org") -> None:
+    """verify() of a one-file tree whose a.js holds `served`, the pipeline's
+    record claiming `recorded` (by default, exactly those bytes)."""
+    source, destination = tmp_path / "a.js", tmp_path / "public"
+    source.write_bytes(b"fetch('ORIGIN/api');")
+    destination.mkdir(exist_ok=True)
+    (destination / "a.js").write_bytes(served)
+    (destination / pp.REVISION_FILE).write_text("r1\n", encoding="utf-8")
+    recorded = served if recorded is None else recorded
+    record = pp.Written(len(recorded), pp.hashlib.sha256(recorded).hexdigest(),
+                        pp.PLACEHOLDER in recorded)
+    pp.verify(destination, {"required": [], "forbidden": []}, [(source, Path("a.js"))],
+              {"a.js": record}, origin, "r1", trusted=trusted)
+
+
+def test_verify_rederives_files_from_their_sources(tmp_path):
+    verified_tree(tmp_path, b"fetch('https://example.org/api');")
+    with pytest.raises(ValueError, match="differ from substituted sources: a.js"):
+        verified_tree(tmp_path, b"fetch('https://example.net/api');")     # same size
+    with pytest.raises(ValueError, match="differ from substituted sources: a.js"):
+        verified_tree(tmp_path, b"fetch('ORIGIN/api');")
+
+
+def test_verify_checks_only_the_size_of_trusted_files(tmp_path):
+    good = b"fetch('https://example.org/api');"
+    verified_tree(tmp_path, b"fetch('https://example.net/api');", good, trusted={"a.js"})
+    with pytest.raises(ValueError, match="differ from substituted sources: a.js"):
+        verified_tree(tmp_path, good + b"\n", good, trusted={"a.js"})
+
+
+def test_verify_streams_and_finds_origin_across_blocks(tmp_path, monkeypatch):
+    monkeypatch.setattr(pp, "COPY_CHUNK", 4)          # ORIGIN spans three reads
+    verified_tree(tmp_path, b"fetch('https://example.org/api');")
+    with pytest.raises(ValueError, match="unresolved ORIGIN placeholders: a.js"):
+        verified_tree(tmp_path, b"fetch('https://ORIGIN.test/api');", origin="https://ORIGIN.test")
+
+
+# service worker --------------------------------------------------------------
+
+SW_SITE = {
+    "index.html": '<link rel="stylesheet" href="hero.css?v=2">\n<link rel="icon" href="favicon.ico">\n'
+                  '<script type="module" src="main.js"></script>\n'
+                  '<link rel="canonical" href="ORIGIN/">\n',
+    "hero.css": "@font-face{src:url(fonts/a.woff2)}",
+    "main.js": 'import { a } from "./lib.js";\nfetch("data/x.json");\n'
+               'const later = () => import("./chapter.js");\n',
+    "lib.js": "export const a = 1;\n",
+    "chapter.js": "export default 'ORIGIN/api';\n",
+    "data/x.json": "{}",
+    "fonts/a.woff2": "font",
+    pp.GEOMETRY_MANIFEST: '{"chapters": {"final": {"file": "final.bin"}}}',
+    "static/geom/final.bin": "geometry",
+}
+
+
+def test_precache_tiers():
+    tiers = pp.precache_tiers("index.html", SW_SITE.get, set(SW_SITE))   # no favicon.ico
+    assert tiers == {
+        "boot": ["index.html", "hero.css", "main.js", "lib.js", "data/x.json", "fonts/a.woff2"],
+        "chapters": ["chapter.js", "static/geom/final.bin"],    # import() and geometry
+    }
+    tiers = pp.precache_tiers("index.html", SW_SITE.get, set(SW_SITE) - {"lib.js"})
+    assert "lib.js" not in tiers["boot"] + tiers["chapters"]
+
+
+def test_precache_manifest_names_the_served_bytes(tmp_path):
+    source, destination = tmp_path / "src", tmp_path / "public"
+    packaged = []
+    for name, text in SW_SITE.items():
+        (source / name).parent.mkdir(parents=True, exist_ok=True)
+        (source / name).write_text(text, encoding="utf-8")
+        packaged.append(pp.package_file(destination, source / name, Path(name),
+                                        b"https://example.org", False, None, [], False, None))
+    tiers = pp.precache_tiers("index.html", SW_SITE.get, set(SW_SITE))
+    names = {"main.js": "main.0123456789ab.js"}
+    manifest = pp.precache_manifest("r1", tiers, packaged, names)
+    assert manifest["revision"] == "r1"
+    assert list(manifest["boot"]) == tiers["boot"]
+    assert list(manifest["chapters"]) == tiers["chapters"]
+    for tier in ("boot", "chapters"):
+        for name, entry in manifest[tier].items():
+            served = (destination / name).read_bytes()          # ORIGIN substituted
+            assert entry["sha256"] == pp.hashlib.sha256(served).hexdigest(), name
+    assert manifest["boot"]["main.js"]["url"] == "main.0123456789ab.js"
+    assert "url" not in manifest["boot"]["lib.js"]
+
+
+@pytest.mark.parametrize("minify", [False, True])
+def test_service_worker_carries_the_manifest(minify):
+    manifest = {"revision": "r1", "boot": {"index.html": {"sha256": "ab" * 32}}, "chapters": {}}
+    worker = pp.service_worker(manifest, minify).decode()
+    assert pp.PRECACHE_LINE not in worker
+    assert "const PRECACHE=" + json.dumps(manifest, separators=(",", ":")) + ";" \
+        in worker.replace("const PRECACHE = ", "const PRECACHE=")
+    assert '"revision":"r1"' in worker           # what verify() looks for
+
+
+def test_service_worker_refuses_a_template_without_its_manifest_line(tmp_path, monkeypatch):
+    template = tmp_path / "sw.js"
+    template.write_text("const PRECACHE = {};\n", encoding="utf-8")
+    monkeypatch.setattr(pp, "SERVICE_WORKER_SOURCE", template)
+    with pytest.raises(ValueError, match="lacks its manifest line"):
+        pp.service_worker({"revision": "r1", "boot": {}, "chapters": {}}, False)
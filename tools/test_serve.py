@@ -0,0 +1,492 @@
+"""test_serve.py — serve.py's serving/ package, in-process and over a real
+socket.
+
+NOT shipped: tools/ is forbidden in the artifact. Run: python3 -m pytest -q tools
+"""
+import asyncio
+import http.client
+import json
+import re
+import socket
+import sys
+import threading
+import time
+from pathlib import Path
+from types import SimpleNamespace
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from serving import accesslog, artifact, engines, files, handler, watch  # noqa: E402
+from serving.accesslog import AccessLog, ua_class  # noqa: E402
+from serving.config import RETRY_AFTER  # noqa: E402
+from serving.files import ServedFile  # noqa: E402
+from serving.metrics import ENGINE, Metrics, route_class  # noqa: E402
+from serving.negotiation import (accepted_codings, encoding_variant, image_format,  # noqa: E402
+                                 media_variant)
+from serving.ranges import MAX_RANGES, byte_ranges, if_range_holds, not_modified  # noqa: E402
+
+BODY = bytes(range(256)) * 40          # 10,240 bytes
+
+
+# ranges ----------------------------------------------------------------------
+
+@pytest.mark.parametrize("header, spans", [
+    ("bytes=0-99", [(0, 99)]),
+    ("bytes=100-", [(100, 999)]),
+    ("bytes=-10", [(990, 999)]),
+    ("bytes=-5000", [(0, 999)]),
+    ("bytes=500-2000", [(500, 999)]),
+    ("bytes=0-9, 50-59", [(0, 59)]),                      # 40 bytes apart: under RANGE_GAP
+    ("bytes=0-9, 200-209", [(0, 9), (200, 209)]),
+    ("bytes=200-209,0-9", [(0, 9), (200, 209)]),          # sorted
+    ("bytes=0-99,50-149,-10", [(0, 149), (990, 999)]),    # overlapping spans merged
+    ("bytes=0-9,5000-", [(0, 9)]),                        # unsatisfiable spec dropped
+    ("items=0-9", []),                                    # not a bytes range: whole file
+    ("bytes=9-0", []),                                    # malformed: whole file
+    ("bytes=a-b", []),
+    ("bytes=-", []),
+    ("bytes=" + ",".join(["0-1"] * (MAX_RANGES + 1)), []),
+    ("bytes=1000-", None),                                # nothing satisfiable: 416
+    ("bytes=-0", None),
+    ("bytes=5000-6000,2000-", None),
+])
+def test_byte_ranges(header, spans):
+    assert byte_ranges(header, 1000) == spans
+
+
+
+# conditional requests --------------------------------------------------------
+
+def entry(etag='"abc"', mtime=1_700_000_000):
+    return ServedFile("/x.js", 10, mtime, "text/javascript", etag)
+
+
+def test_not_modified():
+    served = entry()
+    assert not_modified(served, {"If-None-Match": '"abc"'})
+    assert not_modified(served, {"If-None-Match": '"x", W/"abc"'})      # weak comparison
+    assert not_modified(served, {"If-None-Match": "*"})
+    assert not not_modified(served, {"If-None-Match": '"x"'})
+    assert not not_modified(entry(etag=None), {"If-None-Match": '"abc"'})
+    # If-None-Match wins over a matching If-Modified-Since.
+    assert not not_modified(served, {"If-None-Match": '"x"', "If-Modified-Since": served.modified})
+    assert not_modified(served, {"If-Modified-Since": served.modified})
+    assert not not_modified(served, {"If-Modified-Since": "Mon, 01 Jan 2001 00:00:00 GMT"})
+    assert not not_modified(served, {"If-Modified-Since": "yesterday"})
+
+
+
+
+def test_if_range_holds():
+    served = entry()
+    assert if_range_holds(served, {})
+    assert if_range_holds(served, {"If-Range": '"abc"'})
+    assert not if_range_holds(served, {"If-Range": '"old"'})
+    assert not if_range_holds(entry(etag='W/"abc"'), {"If-Range": 'W/"abc"'})   # strong only
+    assert if_range_holds(served, {"If-Range": served.modified})
+    assert not if_range_holds(served, {"If-Range": "Mon, 01 Jan 2001 00:00:00 GMT"})
+
+
+
+# negotiation -----------------------------------------------------------------
+
+def test_accepted_codings():
+    assert accepted_codings("gzip, br;q=0.5, *;q=0, x;q=1..0") == \
+        {"gzip": 1.0, "br": 0.5, "*": 0.0, "x": 0.0}
+    assert accepted_codings("") == {}
+
+
+def with_variants():
+    identity = entry()
+    for coding in ("br", "gzip"):
+        identity.add_variant(ServedFile("/x.js." + coding, 5, 0, "text/javascript",
+                                        f'"{coding}"', encoding=coding))
+    return identity
+
+
+@pytest.mark.parametrize("header, chosen", [
+    ("gzip, br", "br"),
+    ("gzip", "gzip"),
+    ("gzip;q=1, br;q=0.5", "gzip"),
+    ("*", "br"),
+    ("br;q=0, *", "gzip"),
+    ("identity", None),
+    ("", None),
+])
+def test_encoding_variant(header, chosen):
+    assert encoding_variant(with_variants(), header).encoding == chosen
+
+
+
+def test_image_format():
+    png = ServedFile("/a.png", 100, 0, "image/png")
+    png.add_format(ServedFile("/a.png.avif", 40, 0, "image/avif"))
+    png.add_format(ServedFile("/a.png.webp", 60, 0, "image/webp"))
+    assert image_format(png, "image/avif,image/webp,*/*").ctype == "image/avif"
+    assert image_format(png, "image/webp,image/avif;q=0").ctype == "image/webp"
+    assert image_format(png, "image/*,*/*;q=0.8").ctype == "image/png"
+    assert png.vary == "Accept"
+
+
+@pytest.mark.parametrize("url, headers, lite", [
+    ("/v.mp4", {}, False),
+    ("/v.mp4", {"Save-Data": "on"}, True),
+    ("/v.mp4", {"ECT": "3g"}, True),
+    ("/v.mp4", {"ECT": "4g"}, False),
+    ("/v.mp4", {"Downlink": "1.5"}, True),
+    ("/v.mp4", {"Downlink": "10"}, False),
+    ("/v.mp4", {"Downlink": "fast"}, False),
+    ("/v.mp4?media=lite", {}, True),
+    ("/v.mp4?media=full", {"Save-Data": "on"}, False),
+    ("/v.mp4", {"Save-Data": "on", "If-Range": '"full"'}, False),   # a resumed range stays put
+    ("/v.mp4", {"If-Range": '"lite"'}, True),
+])
+def test_media_variant(url, headers, lite):
+    full = ServedFile("/v.mp4", 100, 0, "video/mp4", '"full"')
+    full.add_lite(ServedFile("/v.lite.mp4", 30, 0, "video/mp4", '"lite"'))
+    assert media_variant(full, url, headers) is (full.lite if lite else full)
+    assert full.vary == "Save-Data, ECT, Downlink"
+
+
+
+# metrics ---------------------------------------------------------------------
+
+@pytest.mark.parametrize("path, route", [
+    ("/js/app.js?v=3", "module"), ("/x.mjs", "module"),
+    ("/static/geom/a.bin", "geom"), ("/v.mp4", "media"),
+    ("/", "html"), ("/about.html", "html"), ("/favicon.ico", "other"),
+])
+def test_route_class(path, route):
+    assert route_class(path) == route
+
+
+def test_metrics_counts_and_buckets():
+    counters = Metrics()
+    counters.observe("/js/app.js", 200, 1000, 0.003)
+    counters.observe("/js/app.js", 200, 500, 20.0)         # past the last bound
+    counters.observe("/nope", 404, 0, 0.001)
+    counters.shedding("media")
+    counters.opened()
+    counters.opened()
+    counters.closed()
+    text = counters.render().decode()
+    lines = dict(line.rsplit(" ", 1) for line in text.splitlines()
+                 if not line.startswith("#"))
+    lines = {re.sub(r'pid="\d+",?', "", key): value for key, value in lines.items()}
+    assert lines['serve_requests_total{route="module",code="200"}'] == "2"
+    assert lines['serve_requests_total{route="other",code="404"}'] == "1"
+    assert lines['serve_response_bytes_total{route="module"}'] == "1500"
+    assert lines['serve_response_bytes_total{route="media"}'] == "0"
+    assert lines['serve_request_duration_seconds_bucket{route="module",le="0.0025"}'] == "0"
+    assert lines['serve_request_duration_seconds_bucket{route="module",le="0.005"}'] == "1"
+    assert lines['serve_request_duration_seconds_bucket{route="module",le="10.0"}'] == "1"
+    assert lines['serve_request_duration_seconds_bucket{route="module",le="+Inf"}'] == "2"
+    assert lines['serve_request_duration_seconds_count{route="module"}'] == "2"
+    assert lines['serve_request_duration_seconds_sum{route="module"}'] == "20.003000"
+    assert lines['serve_shed_total{reason="media"}'] == "1"
+    assert lines['serve_shed_total{reason="queue"}'] == "0"
+    assert lines['serve_connections_total{}'] == "2"
+    assert lines[f'serve_connections_active{{engine="{ENGINE}"}}'] == "1"
+
+
+# access log ------------------------------------------------------------------
+
+def request(status=200, path="/main.js", sent=120, **headers):
+    """What AccessLog.record reads off a handler."""
+    return SimpleNamespace(_status=status, _sent=sent, _revision="default",
+                           client_address=("203.0.113.9", 50000), command="GET",
+                           path=path, headers=headers)
+
+
+@pytest.mark.parametrize("agent, kind", [
+    ("Mozilla/5.0 (X11; Linux x86_64) Firefox/131.0", "browser"),
+    ("Mozilla/5.0 (iPhone; CPU iPhone OS 17_0) Mobile/15E148", "mobile"),
+    ("Mozilla/5.0 (compatible; Googlebot/2.1)", "bot"),
+    ("curl/8.5.0", "tool"),
+    ("Lynx/2.9", "other"),
+    ("", "-"),
+])
+def test_ua_class(agent, kind):
+    assert ua_class(agent) == kind
+
+
+def test_access_log_line_format(tmp_path):
+    log = AccessLog(str(tmp_path / "access.log"))
+    log.record(request(**{"Range": "bytes=0-99", "User-Agent": "curl/8.5.0"}), 0.0123456)
+    log.record(request(404, "/nope", 335), 0.001)
+    log.flush()
+    first, second = map(json.loads, (tmp_path / "access.log").read_text().splitlines())
+    assert re.fullmatch(r"\d{4}-\d\d-\d\dT\d\d:\d\d:\d\d\.\d{3}Z", first.pop("ts"))
+    assert first == {"remote": "203.0.113.9", "method": "GET", "path": "/main.js",
+                     "status": 200, "bytes": 120, "range": "bytes=0-99",
+                     "ms": 12.346, "ua": "tool"}
+    assert (second["status"], second["range"], second["ua"]) == (404, None, "-")
+
+
+def test_access_log_samples_successes_only(tmp_path):
+    log = AccessLog(str(tmp_path / "access.log"))
+    log.sample = 0.0
+    log.record(request(), 0.001)
+    log.record(request(503, "/v.mp4", 0), 0.001)
+    log.flush()
+    lines = (tmp_path / "access.log").read_text().splitlines()
+    assert [json.loads(line)["status"] for line in lines] == [503]
+
+
+def test_access_log_rotates_and_keeps(tmp_path, monkeypatch):
+    monkeypatch.setattr(accesslog, "ACCESS_LOG_ROTATE", 100)     # under one line
+    monkeypatch.setattr(accesslog, "ACCESS_LOG_KEEP", 2)
+    path = tmp_path / "access.log"
+    log = AccessLog(str(path))
+    for n in range(4):
+        log.record(request(path=f"/batch-{n}.js"), 0.001)
+        log.flush()
+    assert sorted(p.name for p in tmp_path.iterdir()) == \
+        ["access.log", "access.log.1", "access.log.2"]
+    assert path.read_text() == ""               # reopened empty after the last rotation
+    assert "/batch-3.js" in (tmp_path / "access.log.1").read_text()
+    assert "/batch-2.js" in (tmp_path / "access.log.2").read_text()
+
+
+# watcher ---------------------------------------------------------------------
+
+@pytest.mark.parametrize("mode", ["inotify", "poll"])
+def test_watcher_walks_only_served_trees(tmp_path, monkeypatch, mode):
+    monkeypatch.setattr(watch, "WATCH", mode)
+    for directory in ("deploy", "assets/cards", "assets/node_modules/x", "docs",
+                      ".git", "node_modules/three/build"):
+        (tmp_path / directory).mkdir(parents=True)
+    (tmp_path / "deploy" / "public-files.json").write_text(
+        '{"trees": [{"path": "assets"}, {"path": "vendor/three"}]}')
+    (tmp_path / "vendor" / "three").mkdir(parents=True)
+    watcher = watch.TreeWatcher(str(tmp_path))
+    assert watcher.watched == {str(tmp_path / d) for d in
+                               ("", "assets", "assets/cards", "vendor", "vendor/three")}
+    (tmp_path / "deploy" / "public-files.json").unlink()         # an artifact: all served
+    watcher = watch.TreeWatcher(str(tmp_path))
+    assert str(tmp_path / "docs") in watcher.watched
+    assert not any(".git" in d or "node_modules" in d for d in watcher.watched)
+
+
+# over a socket ---------------------------------------------------------------
+
+@pytest.fixture(params=["threads", "asyncio"])
+def server(request, tmp_path, monkeypatch):
+    """The port of an in-process server of each engine, answering from a
+    small tree (tmp_path/site)."""
+    site = tmp_path / "site"
+    site.mkdir()
+    (site / "index.html").write_bytes(b"<!doctype html><title>default</title>")
+    (site / "data.bin").write_bytes(BODY)
+    monkeypatch.chdir(site)
+    if request.param == "threads":
+        httpd = engines.ParallelHTTPServer(("127.0.0.1", 0), handler.NoCacheHandler)
+        threading.Thread(target=httpd.serve_forever, daemon=True).start()
+        yield httpd.server_address[1]
+        httpd.shutdown()
+        httpd.server_close()
+        return
+    loop = asyncio.new_event_loop()
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+    listening = asyncio.run_coroutine_threadsafe(asyncio.start_server(
+        engines._serve_connection, "127.0.0.1", 0), loop).result(5)
+    yield listening.sockets[0].getsockname()[1]
+
+    async def shutdown():                 # parked keep-alives included
+        listening.close()
+        tasks = asyncio.all_tasks() - {asyncio.current_task()}
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    asyncio.run_coroutine_threadsafe(shutdown(), loop).result(5)
+    loop.call_soon_threadsafe(loop.stop)
+    thread.join(5)
+    loop.close()
+
+
+@pytest.fixture
+def production(monkeypatch):
+    """SERVE_CACHING=production: validators and revalidate-always."""
+    monkeypatch.setattr(handler, "CACHING", "production")
+    monkeypatch.setattr(files, "CACHING", "production")
+
+
+def get(conn, path, **headers):
+    conn.request("GET", path, headers=headers)
+    response = conn.getresponse()
+    return response, response.read()
+
+
+def test_keep_alive_reuses_one_connection(server):
+    conn = http.client.HTTPConnection("127.0.0.1", server, timeout=5)
+    first, body = get(conn, "/data.bin")
+    sock = conn.sock
+    assert first.status == 200 and body == BODY
+    missing, _ = get(conn, "/favicon.ico")
+    assert missing.status == 404                  # a 404 keeps the connection too
+    again, body = get(conn, "/index.html")
+    assert again.status == 200 and body.endswith(b"default</title>")
+    assert conn.sock is sock
+    conn.close()
+
+
+def test_pipelined_requests_are_answered_in_order(server):
+    with socket.create_connection(("127.0.0.1", server), timeout=5) as sock:
+        sock.sendall(b"GET /index.html HTTP/1.1\r\nHost: x\r\n\r\n"
+                     b"GET /nope HTTP/1.1\r\nHost: x\r\n\r\n"
+                     b"GET /data.bin HTTP/1.1\r\nHost: x\r\nConnection: close\r\n\r\n")
+        data = b""
+        while chunk := sock.recv(65536):
+            data += chunk
+    statuses = re.findall(rb"HTTP/1\.1 (\d{3}) ", data)      # bodies run into status lines
+    assert statuses == [b"200", b"404", b"200"]
+    assert b"default</title>" in data and data.endswith(BODY)
+
+
+def test_idle_connection_is_closed(server, monkeypatch):
+    monkeypatch.setattr(handler, "IDLE_TIMEOUT", 0.2)
+    monkeypatch.setattr(engines, "IDLE_TIMEOUT", 0.2)
+    with socket.create_connection(("127.0.0.1", server), timeout=5) as sock:
+        sock.sendall(b"GET /index.html HTTP/1.1\r\nHost: x\r\n\r\n")
+        data = b""
+        while chunk := sock.recv(65536):          # the server hangs up once idle
+            data += chunk
+    assert data.startswith(b"HTTP/1.1 200") and data.endswith(b"default</title>")
+
+
+def test_production_revalidates_with_304(server, production):
+    conn = http.client.HTTPConnection("127.0.0.1", server, timeout=5)
+    full, _ = get(conn, "/data.bin")
+    etag = full.getheader("ETag")
+    assert full.getheader("Cache-Control") == "no-cache"
+    assert etag.startswith('"') and full.getheader("Last-Modified")
+    cached, body = get(conn, "/data.bin", **{"If-None-Match": etag})
+    assert cached.status == 304 and body == b"" and cached.getheader("ETag") == etag
+    since, _ = get(conn, "/data.bin", **{"If-Modified-Since": full.getheader("Last-Modified")})
+    assert since.status == 304
+    assert get(conn, "/data.bin", **{"If-None-Match": '"other"'})[0].status == 200
+    conn.close()
+
+
+def test_ranged_requests(server, production):
+    conn = http.client.HTTPConnection("127.0.0.1", server, timeout=5)
+    etag = get(conn, "/data.bin")[0].getheader("ETag")
+    part, body = get(conn, "/data.bin", Range="bytes=10-19", **{"If-Range": etag})
+    assert part.status == 206 and body == BODY[10:20]
+    assert part.getheader("Content-Range") == f"bytes 10-19/{len(BODY)}"
+    stale, body = get(conn, "/data.bin", Range="bytes=10-19", **{"If-Range": '"old"'})
+    assert stale.status == 200 and body == BODY
+    multi, body = get(conn, "/data.bin", Range="bytes=0-1,-2")
+    assert multi.status == 206
+    boundary = multi.getheader("Content-Type").split("boundary=")[1]
+    parts = body.split(b"--" + boundary.encode())
+    assert len(parts) == 4 and parts[-1] == b"--\r\n"
+    assert parts[1].endswith(b"\r\n\r\n" + BODY[:2] + b"\r\n")
+    assert b"Content-Range: bytes 10238-10239/10240" in parts[2]
+    unsatisfiable, _ = get(conn, "/data.bin", Range="bytes=99999-")
+    assert unsatisfiable.status == 416
+    assert unsatisfiable.getheader("Content-Range") == f"bytes */{len(BODY)}"
+    assert get(conn, "/index.html")[0].status == 200      # still open after the 416
+    conn.close()
+
+
+def test_revisions_route_by_cookie_and_header(server, tmp_path, monkeypatch):
+    candidate = tmp_path / "b"
+    candidate.mkdir()
+    (candidate / "index.html").write_bytes(b"<!doctype html><title>candidate</title>")
+    monkeypatch.setitem(artifact.REVISIONS, "default",
+                        artifact.Revision("default", str(tmp_path / "site"), None))
+    monkeypatch.setitem(artifact.REVISIONS, "b",
+                        artifact.Revision("b", str(candidate), None))
+    conn = http.client.HTTPConnection("127.0.0.1", server, timeout=5)
+    switch, _ = get(conn, "/__revision/b/index.html")
+    assert switch.status == 302 and switch.getheader("Location") == "/index.html"
+    cookie = switch.getheader("Set-Cookie").split(";")[0]
+    assert cookie == "serve_revision=b"
+    response, body = get(conn, "/index.html", Cookie=cookie)
+    assert body.endswith(b"candidate</title>")
+    assert "Cookie" in response.getheader("Vary")
+    assert get(conn, "/index.html", **{"X-Serve-Revision": "b"})[1].endswith(b"candidate</title>")
+    assert get(conn, "/index.html")[1].endswith(b"default</title>")
+    assert get(conn, "/index.html", Cookie="serve_revision=nope")[1].endswith(b"default</title>")
+    assert get(conn, "/__revision/nope/")[0].status == 404
+    conn.close()
+
+
+@pytest.fixture
+def one_media_slot(monkeypatch, tmp_path):
+    monkeypatch.setattr(handler, "MEDIA_SLOTS", threading.BoundedSemaphore(1))
+    (tmp_path / "site" / "clip.mp4").write_bytes(BODY)
+    (tmp_path / "site" / "app.js").write_bytes(b"export default 1;\n")
+
+
+def test_nul_in_media_path_is_404_and_frees_the_slot(server, one_media_slot):
+    conn = http.client.HTTPConnection("127.0.0.1", server, timeout=5)
+    for _ in range(2):
+        assert get(conn, "/%00.mp4")[0].status == 404     # os.stat: embedded null byte
+    clip, body = get(conn, "/clip.mp4")
+    assert clip.status == 200 and body == BODY
+    conn.close()
+
+
+def test_failed_media_request_frees_the_slot(server, one_media_slot, monkeypatch):
+    def broken(self, path):
+        raise RuntimeError("disk went away")
+    with monkeypatch.context() as patch:
+        patch.setattr(handler.NoCacheHandler, "_stat_entry", broken)
+        for _ in range(2):
+            with pytest.raises((http.client.HTTPException, ConnectionError)):
+                get(http.client.HTTPConnection("127.0.0.1", server, timeout=5), "/clip.mp4")
+    clip, _ = get(http.client.HTTPConnection("127.0.0.1", server, timeout=5), "/clip.mp4")
+    assert clip.status == 200
+
+
+# admission control -----------------------------------------------------------
+
+def test_full_pool_and_queue_shed_with_503(tmp_path, monkeypatch):
+    (tmp_path / "index.html").write_bytes(b"<!doctype html><title>default</title>")
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(engines, "POOL_THREADS", 1)
+    monkeypatch.setattr(engines, "POOL_QUEUE", 1)
+    httpd = engines.ParallelHTTPServer(("127.0.0.1", 0), handler.NoCacheHandler)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    address = httpd.server_address
+    try:
+        busy = socket.create_connection(address, timeout=5)      # holds the one thread
+        queued = socket.create_connection(address, timeout=5)
+        queued.sendall(b"GET /index.html HTTP/1.1\r\nHost: x\r\nConnection: close\r\n\r\n")
+        deadline = time.monotonic() + 5
+        while httpd.load() != (1, 1) and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert httpd.load() == (1, 1)
+        conn = http.client.HTTPConnection(*address, timeout=5)
+        shed, body = get(conn, "/index.html")
+        assert shed.status == 503 and body == b""
+        assert shed.getheader("Retry-After") == str(RETRY_AFTER)
+        assert shed.getheader("Cache-Control") == "no-store"
+        assert shed.getheader("Connection") == "close"
+        busy.close()                                             # frees the thread
+        data = b""
+        while chunk := queued.recv(65536):
+            data += chunk
+        assert data.startswith(b"HTTP/1.1 200") and data.endswith(b"default</title>")
+        queued.close()
+    finally:
+        httpd.shutdown()
+        httpd.server_close()
+
+
+def test_media_share_leaves_room_for_modules(server, one_media_slot):
+    handler.MEDIA_SLOTS.acquire()                 # another visitor's video stream
+    try:
+        shed, _ = get(http.client.HTTPConnection("127.0.0.1", server, timeout=5), "/clip.mp4")
+        assert shed.status == 503 and shed.getheader("Retry-After") == str(RETRY_AFTER)
+        module, _ = get(http.client.HTTPConnection("127.0.0.1", server, timeout=5), "/app.js")
+        assert module.status == 200
+    finally:
+        handler.MEDIA_SLOTS.release()
+    clip, _ = get(http.client.HTTPConnection("127.0.0.1", server, timeout=5), "/clip.mp4")
+    assert clip.status == 200